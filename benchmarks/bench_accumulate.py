@@ -0,0 +1,154 @@
+# Benchmark of the stream batch accumulation in hdi-dailyaggregate.
+#
+# Compares the original per-record loop (strptime, a Decimal per value and a defaultdict of
+# nested dicts per (user, date, context)) with the accumulator engine in src/accumulator.py,
+# using the scalar path and, when NumPy is installed, the columnar path.
+#
+#   python benchmarks/bench_accumulate.py --records 10000 --repeat 5
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from constants import *
+import accumulator
+from runtime import optional_module
+
+# Relative tolerance between the Decimal output of the original loop and the accumulator
+TOLERANCE = Decimal("1e-12")
+
+METRICS = [
+    (HEART_RATE, NA, BPM, lambda: str(random.randint(40, 180))),
+    (STEP_COUNT, NA, COUNT, lambda: str(random.randint(0, 500))),
+    (SPO2, NA, PERCENT, lambda: str(random.randint(90, 100))),
+    (SKIN_TEMP, NA, DEG_CELCIUS, lambda: f"{random.uniform(35, 38):.2f}"),
+    (SLEEP_COUNT, SLEEP_REM, SECONDS, lambda: str(random.randint(0, 300))),
+]
+
+# Function to generate INSERT stream records for users reporting every metric every 5 minutes.
+def generate_records(count, users):
+    records = []
+    start = datetime(2024, 10, 1)
+    for i in range(count):
+        metric, data_context, unit, quantity = METRICS[i % len(METRICS)]
+        timestamp = start + timedelta(minutes=5 * (i // (len(METRICS) * users)))
+        records.append({
+            EVENTNAME: INSERT,
+            DYNAMODB: {SEQUENCE_NUMBER: str(100000000000000000000 + i), NEWIMAGE: {
+                USERID: {STRING: str(1000000 + i % users)},
+                HD_CTX_TIME: {STRING: f"{metric}{DELIMETER}{data_context}{DELIMETER}{timestamp:%Y-%m-%d %H:%M:%S}"},
+                QUANTITY: {STRING: quantity()},
+                UNIT: {STRING: unit},
+            }},
+        })
+    return records
+
+# Function reproducing the original accumulation loop of hdi-dailyaggregate.lambda_handler.
+def legacy_accumulate(records):
+    user_data = defaultdict(lambda: {
+        HEART_RATE_SUM: Decimal(0), HEART_RATE_COUNT: 0,
+        STEPS_SUM: Decimal(0), SLEEP_SUM: Decimal(0),
+        SPO2_SUM: Decimal(0), SPO2_COUNT: 0,
+        SKIN_TEMP_SUM: Decimal(0), SKIN_TEMP_COUNT: 0,
+        UNIT: None
+    })
+    valid_sleep_contexts = [SLEEP_IN_THE_BED, SLEEP_LIGHT, SLEEP_REM, SLEEP_AWAKE, SLEEP_DEEP, SLEEP_UNSPECIFIED, SLEEP_NA]
+    for record in records:
+        if record[EVENTNAME] in [INSERT, MODIFY]:
+            new_image = record[DYNAMODB][NEWIMAGE]
+            user_id = new_image[USERID][STRING]
+            health_data = new_image[HD_CTX_TIME][STRING]
+            quantity = new_image[QUANTITY][STRING]
+            unit = new_image[UNIT][STRING]
+
+            health_data_type, data_context, timestamp_str = health_data.split(DELIMETER)
+            date_str = timestamp_str.split(' ')[0]
+            date = datetime.strptime(date_str, DATEFORMAT).date()
+
+            quantity_value = Decimal(quantity)
+            user_data[(user_id, date, data_context)][UNIT] = unit
+
+            if health_data_type == HEART_RATE and data_context == NA:
+                user_data[(user_id, date, data_context)][HEART_RATE_SUM] += quantity_value
+                user_data[(user_id, date, data_context)][HEART_RATE_COUNT] += 1
+            elif health_data_type == STEP_COUNT and data_context == NA:
+                user_data[(user_id, date, data_context)][STEPS_SUM] += quantity_value
+            elif health_data_type == SLEEP_COUNT and data_context in valid_sleep_contexts:
+                user_data[(user_id, date, data_context)][SLEEP_SUM] += quantity_value
+            elif health_data_type == SPO2 and data_context == NA:
+                user_data[(user_id, date, data_context)][SPO2_SUM] += quantity_value
+                user_data[(user_id, date, data_context)][SPO2_COUNT] += 1
+            elif health_data_type == SKIN_TEMP and data_context == NA:
+                user_data[(user_id, date, data_context)][SKIN_TEMP_SUM] += quantity_value
+                user_data[(user_id, date, data_context)][SKIN_TEMP_COUNT] += 1
+    return user_data
+
+# Function to flatten the original output into per-metric sums keyed like the accumulator output.
+def legacy_sums(user_data):
+    fields = [(HEART_RATE, HEART_RATE_SUM), (STEP_COUNT, STEPS_SUM), (SLEEP_COUNT, SLEEP_SUM),
+              (SPO2, SPO2_SUM), (SKIN_TEMP, SKIN_TEMP_SUM)]
+    sums = {}
+    for (user_id, date, data_context), data in user_data.items():
+        for metric, field in fields:
+            if data[field]:
+                sums[(user_id, date.strftime(DATEFORMAT), data_context, metric)] = data[field]
+    return sums
+
+# Function to return the largest relative difference between the two outputs.
+def max_relative_difference(expected, totals):
+    worst = Decimal(0)
+    for key, value in expected.items():
+        actual = totals[key].decimal_total()
+        worst = max(worst, abs(actual - value) / abs(value))
+    return float(worst)
+
+# Function to time a function over the records and return the best records/s of the repeats.
+def records_per_second(function, records, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function(records)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(records) / best
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hdi-dailyaggregate accumulation engine")
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(7)
+    records = generate_records(args.records, args.users)
+    expected = legacy_sums(legacy_accumulate(records))
+
+    columnar_min_records = accumulator.COLUMNAR_MIN_RECORDS
+    accumulator.COLUMNAR_MIN_RECORDS = float("inf")
+    scalar = accumulator.accumulate_records(records)
+    print(f"{'engine':<12}{'records/s':>14}{'speedup':>10}{'max rel diff':>16}")
+    before = records_per_second(legacy_accumulate, records, args.repeat)
+    print(f"{'original':<12}{before:>14,.0f}{1:>10.1f}{0:>16.1e}")
+    after = records_per_second(accumulator.accumulate_records, records, args.repeat)
+    print(f"{'scalar':<12}{after:>14,.0f}{after / before:>10.1f}{max_relative_difference(expected, scalar):>16.1e}")
+
+    accumulator.COLUMNAR_MIN_RECORDS = columnar_min_records
+    if optional_module(NUMPY) is not None:
+        columnar = accumulator.accumulate_columnar(records)
+        after = records_per_second(accumulator.accumulate_columnar, records, args.repeat)
+        print(f"{'columnar':<12}{after:>14,.0f}{after / before:>10.1f}{max_relative_difference(expected, columnar):>16.1e}")
+        assert max_relative_difference(expected, columnar) <= TOLERANCE
+    else:
+        print("columnar    skipped, NumPy is not installed")
+
+    assert max_relative_difference(expected, scalar) <= TOLERANCE
+
+if __name__ == "__main__":
+    main()
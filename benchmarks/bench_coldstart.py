@@ -0,0 +1,104 @@
+# Cold-start measurement of the Lambda handlers.
+#
+# Every handler is loaded in a fresh Python process, the way a new Lambda container loads it,
+# and the harness reports the import time, whether boto3 and NumPy were imported by the module
+# itself, and the latency of a first and a second (warm) request. Requests go to the AWS account
+# of the current credentials unless --path puts stand-in modules for boto3 first on sys.path.
+#
+#   python benchmarks/bench_coldstart.py --runs 5
+#   python benchmarks/bench_coldstart.py --events my-events.json --path /path/to/fakes
+
+import argparse
+import csv
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SRC = os.path.join(ROOT, "src")
+SAMPLE_DATA = os.path.join(ROOT, "sample-data", "hdi-raw-data-sample.txt")
+
+HANDLERS = ["hdi-importdata", "hdi-dailyaggregate", "hdi-deepinsights"]
+
+# Code run in the child process: load the handler module, then call it twice with the event
+CHILD = """
+import importlib.util, json, sys, time
+name, event = sys.argv[1], json.loads(sys.argv[2])
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location(name.replace("-", "_"), f"{sys.argv[3]}/{name}.py")
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+result = {"import_ms": (time.perf_counter() - started) * 1000,
+          "boto3_at_import": "boto3" in sys.modules, "numpy_at_import": "numpy" in sys.modules}
+for field in ["first_request_ms", "second_request_ms"]:
+    if event is None:
+        break
+    started = time.perf_counter()
+    try:
+        module.lambda_handler(event, None)
+    except Exception as error:
+        result["error"] = repr(error)
+        break
+    result[field] = (time.perf_counter() - started) * 1000
+print(json.dumps(result))
+"""
+
+# Function to build default events from the sample data: a stream batch of its first 100 rows
+# and a weekly insights request for its first user. The import handler needs an S3 object and
+# has no default event.
+def default_events():
+    with open(SAMPLE_DATA) as sample:
+        rows = list(csv.DictReader(sample))[:100]
+    records = [{
+        "eventName": "INSERT",
+        "dynamodb": {"SequenceNumber": str(100000000000000000000 + i),
+                     "NewImage": {name: {"S": value} for name, value in row.items()}},
+    } for i, row in enumerate(rows)]
+    day = rows[0]["hd-context-time"].split("#")[2][:10]
+    return {
+        "hdi-dailyaggregate": {"Records": records},
+        "hdi-deepinsights": {"insight-type": "W", "userid": rows[0]["userid"], "hd-context": "heart_rate#NA",
+                             "fromDate": day, "toDate": day},
+    }
+
+# Function to load one handler in a fresh interpreter and return its measurements.
+def measure(name, event, paths):
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(paths + [SRC]))
+    output = subprocess.run([sys.executable, "-c", CHILD, name, json.dumps(event), SRC],
+                            env=environment, capture_output=True, text=True, cwd=SRC)
+    lines = output.stdout.strip().splitlines()
+    if output.returncode or not lines:
+        return {"error": output.stderr.strip().splitlines()[-1] if output.stderr else "no output"}
+    return json.loads(lines[-1])
+
+# Function to format the median of a measurement over the runs.
+def median(results, field):
+    values = [result[field] for result in results if field in result]
+    return f"{statistics.median(values):.1f}" if values else "-"
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and first-request latency of the handlers")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per handler")
+    parser.add_argument("--events", help="JSON file mapping handler names to the event of their requests")
+    parser.add_argument("--path", action="append", default=[], help="directory put first on sys.path (repeatable)")
+    args = parser.parse_args()
+
+    events = default_events()
+    if args.events:
+        with open(args.events) as events_file:
+            events.update(json.load(events_file))
+
+    print(f"{'handler':<20}{'import ms':>11}{'first ms':>10}{'second ms':>11}{'boto3':>7}{'numpy':>7}  error")
+    for name in HANDLERS:
+        results = [measure(name, events.get(name), args.path) for _ in range(args.runs)]
+        errors = sorted({result["error"] for result in results if "error" in result})
+        boto3_loaded = any(result.get("boto3_at_import") for result in results)
+        numpy_loaded = any(result.get("numpy_at_import") for result in results)
+        print(f"{name:<20}{median(results, 'import_ms'):>11}{median(results, 'first_request_ms'):>10}"
+              f"{median(results, 'second_request_ms'):>11}{'yes' if boto3_loaded else 'no':>7}"
+              f"{'yes' if numpy_loaded else 'no':>7}  {'; '.join(errors)}")
+
+if __name__ == "__main__":
+    main()
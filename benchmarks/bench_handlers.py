@@ -0,0 +1,308 @@
+# Local benchmark of hdi-importdata, hdi-dailyaggregate and hdi-deepinsights.
+#
+# The handlers run in this process against the in-memory fakes of benchmarks/fakes.py, on the
+# synthetic data of benchmarks/datagen.py:
+#   import     one S3 event per object of --format (CSV by default, optionally gzip compressed),
+#              the rows of the users split over --objects objects
+#   aggregate  the stream events of the same rows, --batch-size records per event; with
+#              --raw-storage block the rows are imported and streamed as blocks of readings, with
+#              --raw-shards N they are written to N shards of each user (see src/sharding.py), and
+#              with --window-batches N the events form tumbling windows of N batches
+#   insights   a W, M, 6M and Y request per user and metric, ending on the last generated day;
+#              with --cohorts N the users are members of N cohorts, whose insights are requested too
+# For each handler the suite reports the throughput, the latency percentiles of the invocations,
+# the DynamoDB capacity consumed, the time of the stages recorded by src/metrics.py, and the
+# peak Python memory of an invocation (measured in a second pass under tracemalloc, without the
+# items the fakes store). Results can be saved and compared with a saved baseline;
+# the comparison exits with status 1 when a handler is slower or uses more memory than allowed.
+#
+#   python benchmarks/bench_handlers.py --users 20 --days 30
+#   python benchmarks/bench_handlers.py --save baseline.json
+#   python benchmarks/bench_handlers.py --compare baseline.json --tolerance 0.2
+#
+# boto3 must be installed: the handlers build their key conditions with it.
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+from constants import *
+import cohorts
+import metrics
+import runtime
+import sharding
+from datagen import cohort_mapping, object_bytes, generate_rows, stream_events, DEFAULT_START, FIRST_USER_ID, METRICS
+from fakes import S3_THROTTLING_ERROR, FakeDynamoDB, FakeS3, FakeSession, Faults
+
+BUCKET = "hdi-benchmark-import"
+
+# Days covered by the request of each insight type
+INSIGHT_DAYS = {WEEKLY: 7, MONTHLY: 30, SIXMONTHLY: 182, YEARLY: 365}
+
+# Measurements compared with a baseline, and whether a higher value is better
+COMPARED = {"items_per_second": True, "p95_ms": False, "peak_mib": False, "rcu": False, "wcu": False}
+
+
+# Function to load a handler module from src under its own name, so every pass starts from a
+# fresh module as a new Lambda container does.
+def load_handler(name, run):
+    spec = importlib.util.spec_from_file_location(f"{name.replace('-', '_')}_{run}", os.path.join(SRC, f"{name}.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.lambda_handler
+
+# Function to set the environment the handlers read when they are loaded: no write rate limit
+# unless one is given, the insight cache disabled unless asked for, and a function name for the
+# asynchronous invocations of range workers.
+def configure_environment(args):
+    metrics.METRICS_ENABLED = args.emit_metrics
+    write_rate = str(args.write_rate or 10 ** 9)
+    os.environ[WRITE_RATE_PER_SECOND] = write_rate
+    os.environ[WRITE_BURST] = write_rate
+    os.environ[WRITE_RATE_MAX] = write_rate
+    os.environ[INSIGHT_CACHE_ENTRIES] = os.environ.get(INSIGHT_CACHE_ENTRIES, "512") if args.insight_cache else "0"
+    os.environ.setdefault(AWS_LAMBDA_FUNCTION_NAME, "hdi-importdata")
+    os.environ[RAW_STORAGE_MODE_ENV] = args.raw_storage
+    # The shared modules are loaded once, before the arguments are parsed
+    sharding.RAW_SHARD_COUNT = args.raw_shards
+    sharding.RAW_SHARD_SCHEME = args.shard_scheme
+    cohorts.COHORT_MAPPING = ""
+    if args.cohorts:
+        cohorts.COHORT_MAPPING = os.path.join(tempfile.gettempdir(), "hdi-benchmark-cohorts.json")
+        with open(cohorts.COHORT_MAPPING, "w") as mapping_file:
+            json.dump(cohort_mapping(args.users, args.cohorts), mapping_file)
+
+# Function to return the rows of the benchmark.
+def benchmark_rows(args):
+    return generate_rows(args.users, args.days, args.interval, DEFAULT_START, args.seed)
+
+# Function to upload the rows as objects of the benchmark format, each holding the rows of a group of users, and
+# return the S3 events that import them.
+def import_events(s3, args):
+    users_per_object = max(1, -(-args.users // args.objects))
+    objects = {}
+    for row in benchmark_rows(args):
+        objects.setdefault((int(row[USERID]) - FIRST_USER_ID) // users_per_object, []).append(row)
+    events = []
+    for number, rows in sorted(objects.items()):
+        key = f"benchmark/health-data-{number:04d}.{args.format}" + (".gz" if args.gzip else "")
+        s3.put_object(Bucket=BUCKET, Key=key, Body=object_bytes(rows, args.format, args.gzip))
+        events.append({RECORDS: [{S3: {S3BUCKET: {NAME: BUCKET}, OBJECT: {S3KEY: key}}}]})
+    return events
+
+# Function to return the insight requests of every user and metric, and of every cohort and metric.
+def insight_events(args):
+    last_day = datetime.strptime(DEFAULT_START, DATEFORMAT) + timedelta(days=args.days - 1)
+    subjects = [{USERID: str(FIRST_USER_ID + user)} for user in range(args.users)]
+    subjects += [{COHORT: cohort_id} for cohort_id in cohort_mapping(args.users, args.cohorts)] if args.cohorts else []
+    events = []
+    for subject in subjects:
+        for metric, data_context, *_ in METRICS:
+            for insight_type, days in INSIGHT_DAYS.items():
+                first_day = last_day - timedelta(days=min(days, args.days) - 1)
+                events.append({
+                    INSIGHT_TYPE: insight_type, **subject, HD_CTX: f"{metric}{DELIMETER}{data_context}",
+                    FROMDATE: first_day.strftime(DATEFORMAT), TODATE: last_day.strftime(DATEFORMAT),
+                })
+    return events
+
+# Function to count the items an invocation processed and whether it failed, from its response.
+def import_outcome(response):
+    body = json.loads(response[MESSAGE_BODY])
+    return body[ROWS], body[FAILED] > 0 or body[FAILED_OBJECTS] > 0
+
+def aggregate_outcome(event, response):
+    return len(event[RECORDS]), bool(response[BATCH_ITEM_FAILURES])
+
+# Function to group stream events into tumbling windows of a number of batches, as the event
+# source mapping does with TumblingWindowInSeconds.
+def windowed_events(events, window_batches):
+    events = list(events)
+    for index, event in enumerate(events):
+        window = index // window_batches
+        final = (index + 1) % window_batches == 0 or index == len(events) - 1
+        yield {**event, WINDOW: {"start": str(window), "end": str(window + 1)}, IS_FINAL_INVOKE_FOR_WINDOW: final}
+
+# Function to wrap the aggregate handler so the state it returns is passed to its next
+# invocation, as Lambda does within a window.
+def carry_state(handler):
+    state = {}
+    def handle(event, context):
+        nonlocal state
+        response = handler({**event, STATE: state}, context)
+        state = response.get(STATE, {})
+        return response
+    return handle
+
+def insights_outcome(response):
+    return 1, response.get(STATUS_CODE) == 500
+
+# Function to return the value at a percentile of sorted values (nearest rank).
+def percentile(values, fraction):
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+# Function to invoke a handler with each event and measure the invocations.
+# With trace_memory the peak is taken per invocation, above the memory allocated before it.
+def run_invocations(handler, events, outcome, trace_memory=False):
+    latencies = []
+    items = 0
+    errors = 0
+    peak = 0
+    capacity = {READ_CAPACITY_UNITS: 0.0, WRITE_CAPACITY_UNITS: 0.0}
+    stage_millis = {}
+    started = time.perf_counter()
+    for event in events:
+        if trace_memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        invoked = time.perf_counter()
+        response = handler(event, None)
+        latencies.append((time.perf_counter() - invoked) * 1000)
+        if trace_memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        count, failed = outcome(event, response)
+        items += count
+        errors += failed
+        invocation = metrics.current()
+        for name, units in invocation.capacity.items():
+            capacity[name] += units
+        for name, millis in invocation.stage_millis.items():
+            stage_millis[name] = stage_millis.get(name, 0.0) + millis
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "invocations": len(latencies), "items": items, "errors": errors,
+        "items_per_second": items / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50), "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99), "max_ms": latencies[-1],
+        "peak_mib": peak / 2 ** 20,
+        "rcu": capacity[READ_CAPACITY_UNITS], "wcu": capacity[WRITE_CAPACITY_UNITS],
+        "stage_ms": stage_millis,
+    }
+
+# Function to run the three handlers once, in order, against new fakes.
+def run_suite(args, run, trace_memory=False):
+    dynamodb = FakeDynamoDB(Faults(args.dynamodb_latency / 1000, args.dynamodb_throttle))
+    s3 = FakeS3(Faults(args.s3_latency / 1000, args.s3_throttle, S3_THROTTLING_ERROR))
+    runtime.use_session(FakeSession(dynamodb, s3))
+    handlers = {name: load_handler(name, run) for name in ["hdi-importdata", "hdi-dailyaggregate", "hdi-deepinsights"]}
+
+    # The raw items are not read back, and keeping them would count as memory of the import
+    dynamodb.Table(HEALTH_RAW_DATA_TABLE).retain_items = not trace_memory
+    aggregate_events = stream_events(benchmark_rows(args), args.batch_size, blocks=args.raw_storage == BLOCK_STORAGE_MODE)
+    if args.raw_storage == BLOCK_STORAGE_MODE:
+        # Packing needs all rows; it is done before the memory of the handlers is traced
+        aggregate_events = list(aggregate_events)
+    aggregate_handler = handlers["hdi-dailyaggregate"]
+    if args.window_batches:
+        aggregate_events = list(windowed_events(aggregate_events, args.window_batches))
+        aggregate_handler = carry_state(aggregate_handler)
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        results = {
+            "import": run_invocations(handlers["hdi-importdata"], import_events(s3, args),
+                                      lambda event, response: import_outcome(response), trace_memory),
+            "aggregate": run_invocations(aggregate_handler, aggregate_events, aggregate_outcome, trace_memory),
+            "insights": run_invocations(handlers["hdi-deepinsights"], insight_events(args),
+                                        lambda event, response: insights_outcome(response), trace_memory),
+        }
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    results["import"]["written"] = dynamodb.Table(HEALTH_RAW_DATA_TABLE).write_count
+    return results
+
+# Function to run the timing pass and, unless disabled, the memory pass.
+def benchmark(args):
+    configure_environment(args)
+    results = run_suite(args, "timing")
+    if args.memory:
+        for name, memory in run_suite(args, "memory", trace_memory=True).items():
+            results[name]["peak_mib"] = memory["peak_mib"]
+    return results
+
+# Function to list the measurements that regressed by more than the tolerance against a baseline.
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, measurements in results.items():
+        for field, higher_is_better in COMPARED.items():
+            before = baseline.get(name, {}).get(field)
+            after = measurements.get(field)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                found.append(f"{name} {field}: {before:.2f} -> {after:.2f} ({change:+.0%})")
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import, aggregation and insight handlers locally")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--interval", type=int, default=5, help="minutes between the readings of a metric")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--objects", type=int, default=4, help="objects the rows are split into")
+    parser.add_argument("--format", choices=[CSV_FORMAT, JSON_FORMAT, JSONL_FORMAT], default=CSV_FORMAT,
+                        help="format of the imported objects")
+    parser.add_argument("--gzip", action="store_true", help="gzip compress the imported objects")
+    parser.add_argument("--batch-size", type=int, default=100, help="records per stream event")
+    parser.add_argument("--raw-storage", choices=[ITEM_STORAGE_MODE, BLOCK_STORAGE_MODE], default=ITEM_STORAGE_MODE,
+                        help="storage mode of the raw readings")
+    parser.add_argument("--raw-shards", type=int, default=1, help="shards of each user's raw items, 1 for none")
+    parser.add_argument("--shard-scheme", choices=[HASH_SHARDING, DAY_SHARDING], default=HASH_SHARDING,
+                        help="how the shard of a raw item is chosen")
+    parser.add_argument("--cohorts", type=int, default=0, help="cohorts the users are members of, none by default")
+    parser.add_argument("--window-batches", type=int, default=0,
+                        help="stream batches per tumbling window of the aggregation, no window by default")
+    parser.add_argument("--write-rate", type=float, help="write rate limit of the import, unlimited by default")
+    parser.add_argument("--insight-cache", action="store_true", help="keep the insight cache enabled")
+    parser.add_argument("--dynamodb-latency", type=float, default=0.0, help="milliseconds added to each DynamoDB call")
+    parser.add_argument("--dynamodb-throttle", type=float, default=0.0, help="share of DynamoDB requests throttled")
+    parser.add_argument("--s3-latency", type=float, default=0.0, help="milliseconds added to each S3 call")
+    parser.add_argument("--s3-throttle", type=float, default=0.0, help="share of S3 requests throttled")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the memory pass")
+    parser.add_argument("--emit-metrics", action="store_true", help="print the EMF line of every invocation")
+    parser.add_argument("--save", help="JSON file to save the results to")
+    parser.add_argument("--compare", help="JSON file of baseline results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args()
+
+    results = benchmark(args)
+
+    print(f"{'handler':<11}{'calls':>7}{'items':>9}{'errors':>8}{'items/s':>11}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'max ms':>9}{'peak MiB':>10}{'RCU':>9}{'WCU':>9}")
+    for name, result in results.items():
+        peak = f"{result['peak_mib']:.2f}" if args.memory else "-"
+        print(f"{name:<11}{result['invocations']:>7}{result['items']:>9}{result['errors']:>8}"
+              f"{result['items_per_second']:>11.0f}{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}"
+              f"{result['p99_ms']:>9.1f}{result['max_ms']:>9.1f}{peak:>10}{result['rcu']:>9.1f}{result['wcu']:>9.0f}")
+    print("stage time in ms, summed over threads:")
+    for name, result in results.items():
+        print(f"  {name:<11}" + ", ".join(f"{stage_name} {millis:.0f}" for stage_name, millis in result["stage_ms"].items()))
+
+    if args.save:
+        with open(args.save, "w") as output:
+            json.dump({"arguments": vars(args), "results": results}, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+        print(f"No regression beyond {args.tolerance:.0%} against {args.compare}")
+
+if __name__ == "__main__":
+    main()
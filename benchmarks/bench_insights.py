@@ -0,0 +1,116 @@
+# Benchmark of the period aggregation in hdi-deepinsights.
+#
+# Compares the original calculate_aggregates loop (strptime and a per-period list per item, then
+# min/max/average re-parsed from the formatted bar values) with the insight engine in
+# src/insight_engine.py, in decimal mode, in float mode and, when NumPy is installed, in the
+# columnar float mode. Each day is one daily item, so multi-year ranges are --days long.
+#
+#   python benchmarks/bench_insights.py --days 3650 --repeat 5
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from constants import *
+from aggregates import item_value
+import insight_engine
+from runtime import optional_module
+
+# Relative tolerance between the Decimal output of the original loop and the float modes
+TOLERANCE = Decimal("1e-12")
+
+# Function to generate the daily heart rate items of consecutive days, as read from hdi-aggregated-daily.
+def generate_items(days):
+    start = date(2015, 1, 1)
+    return [{
+        HD_CTX_DATE: f"{HEART_RATE}{DELIMETER}{NA}{DELIMETER}{(start + timedelta(days=i)).strftime(DATEFORMAT)}",
+        SUM: Decimal(random.randint(50, 150) * 288),
+        COUNT: Decimal(288),
+        UNIT: BPM,
+    } for i in range(days)]
+
+# Function reproducing the original calculate_aggregates and summary statistics of hdi-deepinsights.
+def legacy_insights(items, granularity):
+    data_by_period = {}
+    for item in items:
+        date_str = item[HD_CTX_DATE].split(DELIMETER)[-1]
+        day = datetime.strptime(date_str, DATEFORMAT).date()
+        if granularity == MONTHLY:
+            period_key = day.replace(day=1)
+        elif granularity == WEEKLY:
+            period_key = day - timedelta(days=day.weekday())
+        else:
+            period_key = day
+        data_by_period.setdefault(period_key, []).append(item_value(item, HEART_RATE))
+
+    values = [str(sum(vals) / len(vals)) for vals in data_by_period.values()]
+    values_list = [Decimal(value) for value in values]
+    stats = (sum(values_list) / len(values_list), min(values_list), max(values_list), values_list[-1] - values_list[0])
+    return list(data_by_period), values_list, stats
+
+# Function to compute the same output with the insight engine.
+def engine_insights(items, granularity, precision):
+    periods = insight_engine.period_values(items, HEART_RATE, granularity, precision)
+    values = [value for _, value in periods]
+    return [period for period, _ in periods], values, insight_engine.summary_stats(values)
+
+# Function to return the largest relative difference between the period values of two outputs.
+def max_relative_difference(expected, actual):
+    assert expected[0] == actual[0]
+    return max(float(abs(Decimal(b) - a) / abs(a)) for a, b in zip(expected[1], actual[1]))
+
+# Function to time a function over the items and return the best microseconds per item of the repeats.
+def micros_per_item(function, items, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(items) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hdi-deepinsights aggregation engine")
+    parser.add_argument("--days", type=int, default=3650)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(7)
+    items = generate_items(args.days)
+    columnar_min_items = insight_engine.COLUMNAR_MIN_ITEMS
+
+    print(f"{'granularity':<13}{'engine':<12}{'us/item':>10}{'speedup':>10}{'max rel diff':>16}")
+    for granularity in [DAILY, WEEKLY, MONTHLY]:
+        expected = legacy_insights(items, granularity)
+        before = micros_per_item(lambda: legacy_insights(items, granularity), items, args.repeat)
+        print(f"{granularity:<13}{'original':<12}{before:>10.2f}{1:>10.1f}{0:>16.1e}")
+
+        decimal = engine_insights(items, granularity, DECIMAL_PRECISION)
+        assert decimal[1] == expected[1] and decimal[2] == expected[2]
+        after = micros_per_item(lambda: engine_insights(items, granularity, DECIMAL_PRECISION), items, args.repeat)
+        print(f"{'':<13}{'decimal':<12}{after:>10.2f}{before / after:>10.1f}{0:>16.1e}")
+
+        insight_engine.COLUMNAR_MIN_ITEMS = float("inf")
+        scalar = engine_insights(items, granularity, FLOAT_PRECISION)
+        after = micros_per_item(lambda: engine_insights(items, granularity, FLOAT_PRECISION), items, args.repeat)
+        print(f"{'':<13}{'float':<12}{after:>10.2f}{before / after:>10.1f}{max_relative_difference(expected, scalar):>16.1e}")
+        assert max_relative_difference(expected, scalar) <= TOLERANCE
+
+        insight_engine.COLUMNAR_MIN_ITEMS = columnar_min_items
+        if optional_module(NUMPY) is not None:
+            columnar = insight_engine.period_values_columnar(items, HEART_RATE, granularity)
+            columnar = ([period for period, _ in columnar], [value for _, value in columnar])
+            after = micros_per_item(lambda: insight_engine.period_values_columnar(items, HEART_RATE, granularity), items, args.repeat)
+            print(f"{'':<13}{'columnar':<12}{after:>10.2f}{before / after:>10.1f}{max_relative_difference(expected, columnar):>16.1e}")
+            assert max_relative_difference(expected, columnar) <= TOLERANCE
+        else:
+            print(f"{'':<13}columnar    skipped, NumPy is not installed")
+
+if __name__ == "__main__":
+    main()
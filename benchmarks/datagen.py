@@ -0,0 +1,185 @@
+# Synthetic health data in the format of sample-data/hdi-raw-data-sample.txt.
+#
+# Every user reports each metric of METRICS once per sampling interval for the given number of
+# days; sleep is reported at night only. The rows are produced as CSV, as the JSON or JSON Lines
+# device exports of sample-data/sample-raw-data-input.json, optionally gzip compressed, ready to
+# upload to the import bucket, or as the DynamoDB Streams events hdi-health-data sends to
+# hdi-dailyaggregate.
+#
+#   python benchmarks/datagen.py --users 10 --days 30 --interval 5 --csv data.csv
+#   python benchmarks/datagen.py --users 10 --days 30 --format jsonl --gzip --output data.jsonl.gz
+#   python benchmarks/datagen.py --users 10 --days 1 --events events.json --batch-size 100
+
+import argparse
+import base64
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from constants import *
+from reading_blocks import pack_readings
+from sharding import shard_item
+
+# Columns of the sample data
+COLUMNS = [USERID, HD_CTX_TIME, QUANTITY, UNIT, "device_name", "device_make", "device_type",
+           "hardware_version", "software_version"]
+DEVICE = {"device_name": "My Watch", "device_make": "HDI", "device_type": "Watch",
+          "hardware_version": "1", "software_version": "2"}
+
+# (metric, context, unit, lowest reading, highest reading) of each reported metric
+METRICS = [
+    (HEART_RATE, NA, BPM, 50, 180),
+    (STEP_COUNT, NA, COUNT, 0, 120),
+    (SPO2, NA, PERCENT, 90, 100),
+    (SKIN_TEMP, NA, "°C", 33, 38),
+]
+SLEEP_CONTEXTS = [SLEEP_LIGHT, SLEEP_DEEP, SLEEP_REM, SLEEP_AWAKE]
+SLEEP_HOURS = range(0, 7)
+
+DEFAULT_START = "2024-10-01"
+FIRST_USER_ID = 1234567
+FIRST_SEQUENCE_NUMBER = 100000000000000000000
+
+
+# Function to generate the rows of users × days, one reading per metric every interval minutes.
+# The same arguments and seed always produce the same rows.
+def generate_rows(users, days, interval=5, start=DEFAULT_START, seed=7):
+    rng = random.Random(seed)
+    first_day = datetime.strptime(start, DATEFORMAT)
+    for user in range(users):
+        user_id = str(FIRST_USER_ID + user)
+        for minute in range(0, days * 24 * 60, interval):
+            timestamp = first_day + timedelta(minutes=minute)
+            time_str = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+            for metric, data_context, unit, low, high in METRICS:
+                yield {USERID: user_id, HD_CTX_TIME: f"{metric}{DELIMETER}{data_context}{DELIMETER}{time_str}",
+                       QUANTITY: str(rng.randint(low, high)), UNIT: unit, **DEVICE}
+            if timestamp.hour in SLEEP_HOURS:
+                sleep_context = rng.choice(SLEEP_CONTEXTS)
+                yield {USERID: user_id, HD_CTX_TIME: f"{SLEEP_COUNT}{DELIMETER}{sleep_context}{DELIMETER}{time_str}",
+                       QUANTITY: str(interval * 60), UNIT: SECONDS, **DEVICE}
+
+# Function to assign the users to cohorts in turn, as the cohort mapping of hdi-dailyaggregate.
+def cohort_mapping(users, cohorts):
+    mapping = {f"cohort-{cohort}": [] for cohort in range(cohorts)}
+    for user in range(users):
+        mapping[f"cohort-{user % cohorts}"].append(str(FIRST_USER_ID + user))
+    return mapping
+
+# Function to write rows as CSV with the header of the sample data.
+def write_csv(rows, output):
+    writer = csv.DictWriter(output, fieldnames=COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    writer.writerows(rows)
+
+# Function to return rows as the bytes of a CSV object.
+def csv_bytes(rows):
+    output = io.StringIO()
+    write_csv(rows, output)
+    return output.getvalue().encode(UTF8)
+
+# Function to turn rows into device export records, with health_metric, metric_context and
+# timestamp fields in place of the hd-context-time key.
+def device_records(rows):
+    for row in rows:
+        record = dict(row)
+        health_metric, metric_context, timestamp = record.pop(HD_CTX_TIME).split(DELIMETER, 2)
+        record[HEALTH_METRIC] = health_metric
+        record[METRIC_CONTEXT] = metric_context
+        record[TIMESTAMP] = timestamp
+        yield record
+
+# Function to return rows as the bytes of an object in the given format, optionally gzip compressed.
+def object_bytes(rows, data_format=CSV_FORMAT, compress=False):
+    if data_format == JSON_FORMAT:
+        data = json.dumps(list(device_records(rows)), indent=1).encode(UTF8)
+    elif data_format == JSONL_FORMAT:
+        data = "".join(json.dumps(record) + "\n" for record in device_records(rows)).encode(UTF8)
+    else:
+        data = csv_bytes(rows)
+    return gzip.compress(data) if compress else data
+
+# Function to convert an item to a stream image. Lambda delivers binary values base64 encoded.
+def stream_image(item):
+    image = {}
+    for name, value in item.items():
+        if isinstance(value, bytes):
+            image[name] = {BINARY: base64.b64encode(value).decode()}
+        elif isinstance(value, str):
+            image[name] = {STRING: value}
+        else:
+            image[name] = {NUMBER: str(value)}
+    return image
+
+# Function to pack rows into the blocks of readings hdi-importdata writes with RAW_STORAGE_MODE=block.
+def block_items(rows):
+    blocks = {}
+    pack_readings(rows, blocks)
+    return [block.to_item() for block in blocks.values()]
+
+# Function to turn items into the INSERT stream records of the items hdi-importdata writes, with
+# increasing sequence numbers as on a single shard.
+def stream_records(items, first_sequence=FIRST_SEQUENCE_NUMBER):
+    for sequence, item in enumerate(items, first_sequence):
+        yield {
+            EVENTNAME: INSERT,
+            DYNAMODB: {
+                SEQUENCE_NUMBER: str(sequence),
+                NEWIMAGE: stream_image(item),
+            },
+        }
+
+# Function to group stream records into the events of batch_size records Lambda delivers.
+# With blocks, the rows are packed into one record per user, metric context and hour. The items
+# are keyed by the shard hdi-importdata writes them to.
+def stream_events(rows, batch_size=100, first_sequence=FIRST_SEQUENCE_NUMBER, blocks=False):
+    records = []
+    items = block_items(rows) if blocks else (shard_item(dict(row)) for row in rows)
+    for record in stream_records(items, first_sequence):
+        records.append(record)
+        if len(records) == batch_size:
+            yield {RECORDS: records}
+            records = []
+    if records:
+        yield {RECORDS: records}
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic health data as CSV or DynamoDB Streams events")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--interval", type=int, default=5, help="minutes between the readings of a metric")
+    parser.add_argument("--start", default=DEFAULT_START, help="first day, YYYY-MM-DD")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--csv", help="CSV file to write, '-' for stdout")
+    parser.add_argument("--events", help="JSON file to write the list of stream events to")
+    parser.add_argument("--output", help="file to write the rows to in --format")
+    parser.add_argument("--format", choices=[CSV_FORMAT, JSON_FORMAT, JSONL_FORMAT], default=CSV_FORMAT)
+    parser.add_argument("--gzip", action="store_true", help="gzip compress the --output file")
+    parser.add_argument("--batch-size", type=int, default=100, help="records per stream event")
+    parser.add_argument("--blocks", action="store_true", help="write the stream events of blocks of readings")
+    args = parser.parse_args()
+
+    if not args.csv and not args.events and not args.output:
+        parser.error("give --csv, --output, --events or several of them")
+    rows = lambda: generate_rows(args.users, args.days, args.interval, args.start, args.seed)
+    if args.csv == "-":
+        write_csv(rows(), sys.stdout)
+    elif args.csv:
+        with open(args.csv, "w", newline="") as output:
+            write_csv(rows(), output)
+    if args.output:
+        with open(args.output, "wb") as output:
+            output.write(object_bytes(rows(), args.format, args.gzip))
+    if args.events:
+        with open(args.events, "w") as output:
+            json.dump(list(stream_events(rows(), args.batch_size, blocks=args.blocks)), output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,788 @@
+# In-memory stand-ins for the AWS services used by the handlers, for local benchmarks.
+#
+# A FakeSession is installed with runtime.use_session(); the handlers then read and write
+# FakeTable objects, a FakeS3 object store and a FakeLambda client instead of AWS. The fakes
+# implement the calls and the expression syntax the handlers use, page query and scan results
+# at DynamoDB's 1 MB limit, and can add latency to every call and throttle a share of them.
+#
+# Key conditions are the boto3 Key() conditions the handlers build, so boto3 must be installed.
+
+import bisect
+import hashlib
+import random
+import re
+import threading
+import time
+import zlib
+from decimal import Decimal
+from constants import *
+from runtime import MAX_ATTEMPTS
+
+# Key schema of the tables, as deployed by template.yaml
+KEY_SCHEMA = {
+    HEALTH_RAW_DATA_TABLE: (USERID, HD_CTX_TIME),
+    DAILY_AGGREGATED_TABLE: (USERID, HD_CTX_DATE),
+    IMPORT_CHECKPOINT_TABLE: (IMPORT_ID, BYTE_RANGE),
+}
+
+# Service limits
+PAGE_BYTES = 1024 * 1024
+BATCH_WRITE_LIMIT = 25
+BATCH_GET_LIMIT = 100
+
+# Bytes covered by a write capacity unit and by a strongly consistent read capacity unit
+WRITE_UNIT_BYTES = 1024
+READ_UNIT_BYTES = 4096
+
+# Error codes of throttled requests
+DYNAMODB_THROTTLING_ERROR = "ProvisionedThroughputExceededException"
+S3_THROTTLING_ERROR = "SlowDown"
+
+# Backoff of the retries the SDK makes when a request is throttled
+SDK_BACKOFF_BASE_SECONDS = 0.025
+SDK_BACKOFF_MAX_SECONDS = 1.0
+
+# Tokens of condition, update and projection expressions: operators, names, #placeholders and :values
+TOKEN = re.compile(r"\s*(<>|<=|>=|[=<>(),+\-]|[#:]?\w[\w\-]*(?:\.#?\w[\w\-]*)*)")
+
+
+# Error raised by the fakes, shaped like a botocore ClientError.
+class FakeClientError(Exception):
+
+    def __init__(self, code, message, item=None):
+        super().__init__(f"An error occurred ({code}): {message}")
+        self.response = {'Error': {'Code': code, 'Message': message}}
+        if item is not None:
+            # Items of failed condition checks are returned in the low-level format
+            self.response[ITEM] = {name: low_level(value) for name, value in item.items()}
+
+
+# Latency and throttling injected into the calls of a service, with call counters.
+class Faults:
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, throttle_code=DYNAMODB_THROTTLING_ERROR):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.throttle_code = throttle_code
+        self.calls = {}
+        self.throttles = 0
+        self._lock = threading.Lock()
+
+    # Function to return True for the share of requests that is throttled.
+    def throttled(self):
+        if self.throttle_rate and random.random() < self.throttle_rate:
+            with self._lock:
+                self.throttles += 1
+            return True
+        return False
+
+    # Function to count and delay a call. Throttled calls are retried with backoff like the SDK
+    # does, and fail once the SDK would give up. Batch calls throttle their items instead.
+    # Returns the number of retried attempts, as ResponseMetadata.RetryAttempts reports them.
+    def call(self, operation, throttle=True):
+        for attempt in range(MAX_ATTEMPTS):
+            with self._lock:
+                self.calls[operation] = self.calls.get(operation, 0) + 1
+            if self.latency:
+                time.sleep(self.latency)
+            if not (throttle and self.throttled()):
+                return attempt
+            time.sleep(random.uniform(0, min(SDK_BACKOFF_MAX_SECONDS, SDK_BACKOFF_BASE_SECONDS * 2 ** attempt)))
+        raise FakeClientError(self.throttle_code, f"{operation} was throttled {MAX_ATTEMPTS} times")
+
+
+# Function to copy a value into or out of a table, with numbers as Decimal like boto3 returns them.
+def stored(value):
+    if isinstance(value, bool) or value is None or isinstance(value, (str, bytes, Decimal)):
+        return value
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, dict):
+        return {name: stored(member) for name, member in value.items()}
+    if isinstance(value, list):
+        return [stored(member) for member in value]
+    if isinstance(value, (set, frozenset)):
+        return {stored(member) for member in value}
+    raise TypeError(f"Unsupported type {type(value).__name__} for value {value!r}")
+
+# Function to convert a value to the low-level attribute value format.
+def low_level(value):
+    if isinstance(value, bool):
+        return {'BOOL': value}
+    if value is None:
+        return {'NULL': True}
+    if isinstance(value, str):
+        return {STRING: value}
+    if isinstance(value, bytes):
+        return {'B': value}
+    if isinstance(value, (int, Decimal)):
+        return {NUMBER: str(value)}
+    if isinstance(value, dict):
+        return {'M': {name: low_level(member) for name, member in value.items()}}
+    if isinstance(value, list):
+        return {'L': [low_level(member) for member in value]}
+    if all(isinstance(member, str) for member in value):
+        return {'SS': sorted(value)}
+    return {'NS': sorted(str(member) for member in value)}
+
+# Function to estimate the stored size of an item, for the 1 MB page limit.
+def item_size(value):
+    if isinstance(value, dict):
+        return sum(len(name) + item_size(member) for name, member in value.items()) + 3
+    if isinstance(value, (list, set, frozenset)):
+        return sum(item_size(member) for member in value) + 3
+    if isinstance(value, Decimal):
+        return len(str(value)) // 2 + 1
+    return len(value) if isinstance(value, (str, bytes)) else 1
+
+# Function to compute the capacity units of writing, or reading, an item or page of size bytes.
+# Eventually consistent reads cost half.
+def capacity_units(size, unit_bytes, consistent=True):
+    units = max(1, -(-size // unit_bytes))
+    return units if consistent or unit_bytes == WRITE_UNIT_BYTES else units / 2
+
+# Function to add the ConsumedCapacity of a call to its response, when the call asked for it.
+def with_capacity(response, table_name, units, return_consumed_capacity):
+    if return_consumed_capacity in (TOTAL_CAPACITY, "INDEXES"):
+        response[CONSUMED_CAPACITY] = {'TableName': table_name, CAPACITY_UNITS: float(units)}
+    return response
+
+
+# Parser and evaluator of the condition, update and projection expressions of a request.
+class Expression:
+
+    def __init__(self, text, names=None, values=None):
+        self.tokens = []
+        position = 0
+        text = text.rstrip()
+        while position < len(text):
+            match = TOKEN.match(text, position)
+            if not match:
+                raise FakeClientError("ValidationException", f"Invalid expression at {text[position:]!r}")
+            self.tokens.append(match.group(1))
+            position = match.end()
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        return self.tokens[self.position].upper() if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise FakeClientError("ValidationException", f"Expected {expected or 'a token'} in {' '.join(self.tokens)}")
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    # Function to resolve the next token to a document path, a list of attribute names.
+    def path(self):
+        return [self.names.get(part, part) for part in self.take().split(".")]
+
+    # Function to read the next operand: a :value, or the value of a path in the item.
+    def operand(self, item):
+        if self.peek().startswith(":"):
+            return self.values[self.take()]
+        return get_path(item, self.path())
+
+    # Function to evaluate a condition expression against an item (an empty dict if it does not exist).
+    def condition(self, item):
+        result = self.conjunction(item)
+        while self.peek() == "OR":
+            self.take()
+            right = self.conjunction(item)
+            result = result or right
+        return result
+
+    def conjunction(self, item):
+        result = self.negation(item)
+        while self.peek() == "AND":
+            self.take()
+            right = self.negation(item)
+            result = result and right
+        return result
+
+    def negation(self, item):
+        token = self.peek()
+        if token == "NOT":
+            self.take()
+            return not self.negation(item)
+        if token == "(":
+            self.take()
+            result = self.condition(item)
+            self.take(")")
+            return result
+        if token in ("ATTRIBUTE_EXISTS", "ATTRIBUTE_NOT_EXISTS", "BEGINS_WITH", "CONTAINS"):
+            self.take()
+            self.take("(")
+            value = get_path(item, self.path())
+            if token in ("BEGINS_WITH", "CONTAINS"):
+                self.take(",")
+                argument = self.operand(item)
+            self.take(")")
+            if token == "ATTRIBUTE_EXISTS":
+                return value is not None
+            if token == "ATTRIBUTE_NOT_EXISTS":
+                return value is None
+            if token == "BEGINS_WITH":
+                return isinstance(value, str) and value.startswith(argument)
+            return value is not None and argument in value
+        return self.comparison(item)
+
+    def comparison(self, item):
+        left = self.operand(item)
+        operator = self.take()
+        if operator.upper() == "BETWEEN":
+            low = self.operand(item)
+            self.take("AND")
+            high = self.operand(item)
+            return compare(low, "<=", left) and compare(left, "<=", high)
+        return compare(left, operator, self.operand(item))
+
+    # Function to apply an update expression to a copy of an item and return the copy.
+    # Every value on the right-hand side is read from the item before the update; the names of the
+    # top-level attributes it updates are kept in updated_names.
+    def update(self, item):
+        updated = stored(item)
+        self.updated_names = set()
+        while self.peek() is not None:
+            clause = self.take().upper()
+            while True:
+                path = self.path()
+                self.updated_names.add(path[0])
+                if clause == "SET":
+                    self.take("=")
+                    set_path(updated, path, self.set_value(item))
+                elif clause == "ADD":
+                    value = self.operand(item)
+                    existing = get_path(item, path)
+                    if existing is None:
+                        set_path(updated, path, value)
+                    elif isinstance(existing, set):
+                        set_path(updated, path, existing | value)
+                    else:
+                        set_path(updated, path, existing + value)
+                elif clause == "DELETE":
+                    set_path(updated, path, (get_path(item, path) or set()) - self.operand(item))
+                elif clause == "REMOVE":
+                    remove_path(updated, path)
+                else:
+                    raise FakeClientError("ValidationException", f"Unsupported update clause {clause}")
+                if self.peek() != ",":
+                    break
+                self.take()
+        return stored(updated)
+
+    def set_value(self, item):
+        value = self.set_operand(item)
+        if self.peek() in ("+", "-"):
+            operator = self.take()
+            right = self.set_operand(item)
+            value = value + right if operator == "+" else value - right
+        return value
+
+    def set_operand(self, item):
+        function = self.peek()
+        if function in ("IF_NOT_EXISTS", "LIST_APPEND"):
+            self.take()
+            self.take("(")
+            if function == "IF_NOT_EXISTS":
+                existing = get_path(item, self.path())
+                self.take(",")
+                default = self.operand(item)
+                value = default if existing is None else existing
+            else:
+                first = self.operand(item)
+                self.take(",")
+                value = first + self.operand(item)
+            self.take(")")
+            return value
+        return self.operand(item)
+
+    # Function to return the attributes of an item named by a projection expression.
+    def project(self, item):
+        projected = {}
+        while self.peek() is not None:
+            path = self.path()
+            if path[0] in item:
+                projected[path[0]] = item[path[0]]
+            if self.peek() == ",":
+                self.take()
+        return projected
+
+
+# Function to compare two values; values of different types never match, as in DynamoDB.
+def compare(left, operator, right):
+    if left is None or right is None:
+        return operator == "<>" and (left is None) != (right is None)
+    if isinstance(left, str) != isinstance(right, str):
+        return operator == "<>"
+    return {"=": left == right, "<>": left != right, "<": left < right,
+            "<=": left <= right, ">": left > right, ">=": left >= right}[operator]
+
+def get_path(item, path):
+    value = item
+    for name in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value
+
+def set_path(item, path, value):
+    for name in path[:-1]:
+        item = item.setdefault(name, {})
+    item[path[-1]] = value
+
+def remove_path(item, path):
+    parent = get_path(item, path[:-1]) if len(path) > 1 else item
+    if isinstance(parent, dict):
+        parent.pop(path[-1], None)
+
+# Function to evaluate an optional condition expression, raising the error of a failed check.
+def check_condition(item, condition, names, values, return_item=None):
+    if condition and not Expression(condition, names, values).condition(item or {}):
+        raise FakeClientError(CONDITIONAL_CHECK_FAILED, "The conditional request failed",
+                              (item or {}) if return_item == "ALL_OLD" else None)
+
+# Function to read a boto3 Key() condition into {attribute name: (operator, operands)}.
+def key_conditions(condition):
+    expression = condition.get_expression()
+    if expression['operator'] == "AND":
+        conditions = {}
+        for part in expression['values']:
+            conditions.update(key_conditions(part))
+        return conditions
+    return {expression['values'][0].name: (expression['operator'], expression['values'][1:])}
+
+
+# In-memory DynamoDB table. Each partition keeps its sort keys in order, so queries bisect
+# to their key range instead of scanning the partition.
+class FakeTable:
+
+    def __init__(self, name, key_names, faults=None):
+        self.name = name
+        self.partition_key, self.sort_key = key_names
+        self.faults = faults or Faults()
+        self.partitions = {}
+        self.write_count = 0
+        # With retain_items False writes are only counted, e.g. to measure the memory of a handler
+        # without the items it wrote
+        self.retain_items = True
+        self._lock = threading.RLock()
+
+    # Function to split a key or item into its partition and sort key values.
+    def _key(self, key):
+        try:
+            return key[self.partition_key], key[self.sort_key]
+        except KeyError:
+            raise FakeClientError("ValidationException", f"The key of {self.name} is {self.partition_key}, {self.sort_key}")
+
+    def _get(self, key):
+        partition_value, sort_value = self._key(key)
+        return self.partitions.get(partition_value, ([], {}))[1].get(sort_value)
+
+    def _put(self, item):
+        partition_value, sort_value = self._key(item)
+        self.write_count += 1
+        if not self.retain_items:
+            return
+        sort_values, items = self.partitions.setdefault(partition_value, ([], {}))
+        if sort_value not in items:
+            bisect.insort(sort_values, sort_value)
+        items[sort_value] = item
+
+    def _delete(self, key):
+        partition_value, sort_value = self._key(key)
+        sort_values, items = self.partitions.get(partition_value, ([], {}))
+        if items.pop(sort_value, None) is not None:
+            sort_values.remove(sort_value)
+
+    # Function to return the number of items in the table.
+    def item_count(self):
+        with self._lock:
+            return sum(len(items) for _, items in self.partitions.values())
+
+    # Function to return a copy of every item, in key order.
+    def all_items(self):
+        with self._lock:
+            return [stored(items[sort_value]) for partition_value in sorted(self.partitions)
+                    for sort_values, items in [self.partitions[partition_value]] for sort_value in sort_values]
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                 ReturnValuesOnConditionCheckFailure=None, ReturnConsumedCapacity=None, **kwargs):
+        retries = self.faults.call("PutItem")
+        item = stored(Item)
+        with self._lock:
+            existing = self._get(item)
+            check_condition(existing, ConditionExpression, ExpressionAttributeNames,
+                            ExpressionAttributeValues, ReturnValuesOnConditionCheckFailure)
+            self._put(item)
+        units = capacity_units(max(item_size(item), item_size(existing or {})), WRITE_UNIT_BYTES)
+        return with_capacity({RESPONSE_METADATA: {RETRY_ATTEMPTS: retries}}, self.name, units, ReturnConsumedCapacity)
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False,
+                 ReturnConsumedCapacity=None, **kwargs):
+        self.faults.call("GetItem")
+        with self._lock:
+            item = self._get(Key)
+            units = capacity_units(item_size(item or {}), READ_UNIT_BYTES, ConsistentRead)
+            if item is None:
+                return with_capacity({}, self.name, units, ReturnConsumedCapacity)
+            if ProjectionExpression:
+                item = Expression(ProjectionExpression, ExpressionAttributeNames).project(item)
+            return with_capacity({ITEM: stored(item)}, self.name, units, ReturnConsumedCapacity)
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues="NONE", ReturnValuesOnConditionCheckFailure=None,
+                    ReturnConsumedCapacity=None, **kwargs):
+        self.faults.call("UpdateItem")
+        values = stored(ExpressionAttributeValues or {})
+        with self._lock:
+            existing = self._get(Key)
+            check_condition(existing, ConditionExpression, ExpressionAttributeNames, values,
+                            ReturnValuesOnConditionCheckFailure)
+            expression = Expression(UpdateExpression, ExpressionAttributeNames, values)
+            item = expression.update(existing or stored(Key))
+            if self._key(item) != self._key(Key):
+                raise FakeClientError("ValidationException", "Cannot update attribute of the key")
+            self._put(item)
+        response = {}
+        if ReturnValues == "ALL_NEW":
+            response[ATTRIBUTES] = stored(item)
+        elif ReturnValues == "UPDATED_NEW":
+            response[ATTRIBUTES] = stored({name: item[name] for name in expression.updated_names if name in item})
+        elif ReturnValues == "ALL_OLD" and existing is not None:
+            response[ATTRIBUTES] = stored(existing)
+        units = capacity_units(max(item_size(item), item_size(existing or {})), WRITE_UNIT_BYTES)
+        return with_capacity(response, self.name, units, ReturnConsumedCapacity)
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnConsumedCapacity=None, **kwargs):
+        self.faults.call("DeleteItem")
+        with self._lock:
+            existing = self._get(Key)
+            check_condition(existing, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            self._delete(Key)
+        units = capacity_units(item_size(existing or {}), WRITE_UNIT_BYTES)
+        return with_capacity({}, self.name, units, ReturnConsumedCapacity)
+
+    # Function to return the positions of the sort keys that match a key condition on the sort key.
+    def _sort_range(self, sort_values, condition):
+        if condition is None:
+            return 0, len(sort_values)
+        operator, operands = condition
+        first = operands[0]
+        if operator == "=":
+            return bisect.bisect_left(sort_values, first), bisect.bisect_right(sort_values, first)
+        if operator == "<":
+            return 0, bisect.bisect_left(sort_values, first)
+        if operator == "<=":
+            return 0, bisect.bisect_right(sort_values, first)
+        if operator == ">":
+            return bisect.bisect_right(sort_values, first), len(sort_values)
+        if operator == ">=":
+            return bisect.bisect_left(sort_values, first), len(sort_values)
+        if operator == "BETWEEN":
+            return bisect.bisect_left(sort_values, first), bisect.bisect_right(sort_values, operands[1])
+        if operator == "begins_with":
+            return bisect.bisect_left(sort_values, first), bisect.bisect_left(sort_values, first + chr(0x10FFFF))
+        raise FakeClientError("ValidationException", f"Unsupported key condition {operator}")
+
+    # Function to fill one page from (partition value, sort value) pairs, stopping at the Limit or
+    # at 1 MB. The read capacity is charged for every item read, including the filtered ones.
+    def _page(self, keys, limit, filter_expression, projection, names, values, consistent, return_consumed_capacity):
+        page = []
+        scanned = 0
+        size = 0
+        last_key = None
+        for partition_value, sort_value in keys:
+            if (limit is not None and scanned == limit) or size >= PAGE_BYTES:
+                break
+            item = self.partitions[partition_value][1][sort_value]
+            scanned += 1
+            size += item_size(item)
+            last_key = {self.partition_key: partition_value, self.sort_key: sort_value}
+            if filter_expression and not Expression(filter_expression, names, values).condition(item):
+                continue
+            page.append(stored(Expression(projection, names).project(item) if projection else item))
+        else:
+            last_key = None
+        response = {ITEMS: page, 'Count': len(page), 'ScannedCount': scanned}
+        if last_key is not None:
+            response[LAST_EVALUATED_KEY] = last_key
+        return with_capacity(response, self.name, capacity_units(size, READ_UNIT_BYTES, consistent),
+                             return_consumed_capacity)
+
+    def query(self, KeyConditionExpression, ExclusiveStartKey=None, Limit=None, ScanIndexForward=True,
+              FilterExpression=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, ConsistentRead=False, ReturnConsumedCapacity=None, **kwargs):
+        self.faults.call("Query")
+        conditions = key_conditions(KeyConditionExpression)
+        operator, operands = conditions.pop(self.partition_key, (None, None))
+        if operator != "=" or set(conditions) - {self.sort_key}:
+            raise FakeClientError("ValidationException", "Query condition missed key schema element")
+        values = stored(ExpressionAttributeValues or {})
+        with self._lock:
+            partition_value = operands[0]
+            sort_values = self.partitions.get(partition_value, ([], {}))[0]
+            start, end = self._sort_range(sort_values, conditions.get(self.sort_key))
+            if ExclusiveStartKey:
+                if ScanIndexForward:
+                    start = max(start, bisect.bisect_right(sort_values, ExclusiveStartKey[self.sort_key]))
+                else:
+                    end = min(end, bisect.bisect_left(sort_values, ExclusiveStartKey[self.sort_key]))
+            positions = range(start, end) if ScanIndexForward else range(end - 1, start - 1, -1)
+            keys = ((partition_value, sort_values[position]) for position in positions)
+            return self._page(keys, Limit, FilterExpression, ProjectionExpression, ExpressionAttributeNames, values,
+                              ConsistentRead, ReturnConsumedCapacity)
+
+    def scan(self, Segment=0, TotalSegments=1, ExclusiveStartKey=None, Limit=None, FilterExpression=None,
+             ProjectionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+             ConsistentRead=False, ReturnConsumedCapacity=None, **kwargs):
+        self.faults.call("Scan")
+        values = stored(ExpressionAttributeValues or {})
+        with self._lock:
+            partition_values = sorted(value for value in self.partitions
+                                      if zlib.crc32(str(value).encode()) % TotalSegments == Segment)
+            start_key = self._key(ExclusiveStartKey) if ExclusiveStartKey else None
+
+            def keys():
+                for partition_value in partition_values:
+                    if start_key and partition_value < start_key[0]:
+                        continue
+                    sort_values = self.partitions[partition_value][0]
+                    start = 0
+                    if start_key and partition_value == start_key[0]:
+                        start = bisect.bisect_right(sort_values, start_key[1])
+                    for sort_value in sort_values[start:]:
+                        yield partition_value, sort_value
+
+            return self._page(keys(), Limit, FilterExpression, ProjectionExpression, ExpressionAttributeNames, values,
+                              ConsistentRead, ReturnConsumedCapacity)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return FakeBatchWriter(self, overwrite_by_pkeys)
+
+
+# Buffered writer returned by FakeTable.batch_writer(), flushing every 25 requests.
+class FakeBatchWriter:
+
+    def __init__(self, table, overwrite_by_pkeys=None):
+        self.table = table
+        self.overwrite_by_pkeys = overwrite_by_pkeys
+        self.requests = {}
+
+    def _add(self, key, request):
+        key = tuple(key[name] for name in self.overwrite_by_pkeys) if self.overwrite_by_pkeys else len(self.requests)
+        self.requests[key] = request
+        if len(self.requests) >= BATCH_WRITE_LIMIT:
+            self._flush()
+
+    def put_item(self, Item):
+        self._add(Item, (True, stored(Item)))
+
+    def delete_item(self, Key):
+        self._add(Key, (False, stored(Key)))
+
+    def _flush(self):
+        if not self.requests:
+            return
+        self.table.faults.call("BatchWriteItem")
+        with self.table._lock:
+            for is_put, item in self.requests.values():
+                if is_put:
+                    self.table._put(item)
+                else:
+                    self.table._delete(item)
+        self.requests = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._flush()
+
+
+# In-memory DynamoDB service resource.
+class FakeDynamoDB:
+
+    def __init__(self, faults=None, key_schema=None):
+        self.faults = faults or Faults()
+        self.key_schema = key_schema or KEY_SCHEMA
+        self.tables = {}
+        self._lock = threading.Lock()
+
+    def Table(self, name):
+        with self._lock:
+            if name not in self.tables:
+                self.tables[name] = FakeTable(name, self.key_schema[name], self.faults)
+            return self.tables[name]
+
+    # Function to write up to 25 put or delete requests; throttled requests are returned as UnprocessedItems.
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity=None, **kwargs):
+        if sum(len(requests) for requests in RequestItems.values()) > BATCH_WRITE_LIMIT:
+            raise FakeClientError("ValidationException", "Too many items requested for the BatchWriteItem call")
+        self.faults.call("BatchWriteItem", throttle=False)
+        unprocessed = {}
+        consumed = []
+        for table_name, requests in RequestItems.items():
+            table = self.Table(table_name)
+            units = 0
+            with table._lock:
+                for request in requests:
+                    if self.faults.throttled():
+                        unprocessed.setdefault(table_name, []).append(request)
+                    elif PUT_REQUEST in request:
+                        item = stored(request[PUT_REQUEST][ITEM])
+                        units += capacity_units(item_size(item), WRITE_UNIT_BYTES)
+                        table._put(item)
+                    else:
+                        units += capacity_units(item_size(table._get(request['DeleteRequest'][KEY]) or {}), WRITE_UNIT_BYTES)
+                        table._delete(request['DeleteRequest'][KEY])
+            consumed.append(with_capacity({}, table_name, units, TOTAL_CAPACITY)[CONSUMED_CAPACITY])
+        response = {UNPROCESSED_ITEMS: unprocessed}
+        if ReturnConsumedCapacity in (TOTAL_CAPACITY, "INDEXES"):
+            response[CONSUMED_CAPACITY] = consumed
+        return response
+
+    # Function to read up to 100 keys; throttled keys are returned as UnprocessedKeys.
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity=None, **kwargs):
+        if sum(len(request['Keys']) for request in RequestItems.values()) > BATCH_GET_LIMIT:
+            raise FakeClientError("ValidationException", "Too many items requested for the BatchGetItem call")
+        self.faults.call("BatchGetItem", throttle=False)
+        responses = {}
+        unprocessed = {}
+        consumed = []
+        for table_name, request in RequestItems.items():
+            table = self.Table(table_name)
+            projection = request.get('ProjectionExpression')
+            consistent = request.get('ConsistentRead', False)
+            responses[table_name] = []
+            units = 0
+            with table._lock:
+                for key in request['Keys']:
+                    if self.faults.throttled():
+                        unprocessed.setdefault(table_name, {**request, 'Keys': []})['Keys'].append(key)
+                        continue
+                    item = table._get(key)
+                    units += capacity_units(item_size(item or {}), READ_UNIT_BYTES, consistent)
+                    if item is not None:
+                        if projection:
+                            item = Expression(projection, request.get('ExpressionAttributeNames')).project(item)
+                        responses[table_name].append(stored(item))
+            consumed.append(with_capacity({}, table_name, units, TOTAL_CAPACITY)[CONSUMED_CAPACITY])
+        response = {RESPONSES: responses, UNPROCESSED_KEYS: unprocessed}
+        if ReturnConsumedCapacity in (TOTAL_CAPACITY, "INDEXES"):
+            response[CONSUMED_CAPACITY] = consumed
+        return response
+
+
+# Streaming body of a FakeS3 object. It reads from a view of the stored object, so like a
+# real body it only holds the chunks that were read.
+class FakeStreamingBody:
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._position = 0
+
+    def read(self, amt=None):
+        end = len(self._data) if amt is None or amt < 0 else self._position + amt
+        chunk = self._data[self._position:end].tobytes()
+        self._position += len(chunk)
+        return chunk
+
+    def iter_chunks(self, chunk_size=1024):
+        return iter(lambda: self.read(chunk_size), b"")
+
+    def close(self):
+        self._data.release()
+
+
+# In-memory S3 object store.
+class FakeS3:
+
+    def __init__(self, faults=None):
+        self.faults = faults or Faults(throttle_code=S3_THROTTLING_ERROR)
+        self.objects = {}
+        self.etags = {}
+
+    def put_object(self, Bucket, Key, Body=b"", **kwargs):
+        self.faults.call("PutObject")
+        data = Body.encode(UTF8) if isinstance(Body, str) else bytes(Body)
+        self.objects[(Bucket, Key)] = data
+        self.etags[(Bucket, Key)] = f'"{hashlib.md5(data).hexdigest()}"'
+        return {ETAG: self.etags[(Bucket, Key)]}
+
+    def _object(self, bucket_name, key):
+        if (bucket_name, key) not in self.objects:
+            raise FakeClientError("NoSuchKey", f"The specified key does not exist: {key}")
+        return self.objects[(bucket_name, key)]
+
+    def _etag(self, bucket_name, key):
+        self._object(bucket_name, key)
+        return self.etags[(bucket_name, key)]
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.faults.call("HeadObject")
+        return {CONTENT_LENGTH: len(self._object(Bucket, Key)), ETAG: self._etag(Bucket, Key)}
+
+    # Function to return an object, or the part of it selected by a "bytes=start-end" Range.
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        self.faults.call("GetObject")
+        data = memoryview(self._object(Bucket, Key))
+        if Range:
+            start, end = Range.split("=", 1)[1].split("-")
+            data = data[int(start):int(end) + 1 if end else None]
+        return {BODY: FakeStreamingBody(data), CONTENT_LENGTH: len(data), ETAG: self._etag(Bucket, Key)}
+
+    def get_paginator(self, operation_name):
+        if operation_name != LIST_OBJECTS_V2:
+            raise ValueError(f"Unsupported paginator {operation_name}")
+        return FakeListPaginator(self)
+
+
+# Paginator of FakeS3.list_objects_v2, 1000 keys per page.
+class FakeListPaginator:
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix="", **kwargs):
+        keys = sorted(key for bucket_name, key in self.s3.objects if bucket_name == Bucket and key.startswith(Prefix))
+        for start in range(0, max(len(keys), 1), 1000):
+            self.s3.faults.call("ListObjectsV2")
+            contents = [{KEYNAME: key, 'Size': len(self.s3.objects[(Bucket, key)])} for key in keys[start:start + 1000]]
+            yield {CONTENTS: contents} if contents else {}
+
+
+# Lambda client that records asynchronous invocations instead of running them.
+class FakeLambda:
+
+    def __init__(self):
+        self.invocations = []
+
+    def invoke(self, FunctionName, Payload=b"", InvocationType="RequestResponse", **kwargs):
+        self.invocations.append((FunctionName, InvocationType, Payload))
+        return {'StatusCode': 202 if InvocationType == INVOCATION_TYPE_EVENT else 200}
+
+
+# Session handing out the fakes, installed with runtime.use_session().
+class FakeSession:
+
+    def __init__(self, dynamodb=None, s3=None, lambda_client=None):
+        self.dynamodb = dynamodb or FakeDynamoDB()
+        self.s3 = s3 or FakeS3()
+        self.lambda_client = lambda_client or FakeLambda()
+
+    def resource(self, service_name, config=None, **kwargs):
+        if service_name != DYNAMODB:
+            raise ValueError(f"No fake resource for {service_name}")
+        return self.dynamodb
+
+    def client(self, service_name, config=None, **kwargs):
+        clients = {S3: self.s3, LAMBDA: self.lambda_client}
+        if service_name not in clients:
+            raise ValueError(f"No fake client for {service_name}")
+        return clients[service_name]
@@ -0,0 +1,317 @@
+import logging
+import zlib
+from decimal import Decimal
+from constants import *
+from aggregates import AGGREGATED_CONTEXTS
+from reading_blocks import decode_readings, is_block
+from runtime import optional_module
+from sharding import user_of
+
+# NumPy is optional: it is not part of the Lambda Python runtime, and batches are
+# accumulated by the scalar path when it is not available. It is imported with the first
+# batch large enough for the columnar path, so small batches never pay for the import.
+# Stream batches of hdi-daily-aggregate hold at most BatchSize (100) records, so the deployed
+# function always takes the scalar path and is not given the NumPy layer.
+
+# Batches with at least this many records use the columnar NumPy path when it is available
+COLUMNAR_MIN_RECORDS = 2000
+
+# Significant digits kept when a sum of fractional readings is converted back to Decimal.
+# Sums of integer readings are exact; sums with fractional readings are accumulated in binary
+# floating point and match the Decimal arithmetic to a relative difference below 1e-12.
+FLOAT_SIGNIFICANT_DIGITS = 15
+
+CHANGE_EVENTS = frozenset([INSERT, MODIFY])
+
+# Stream sequence numbers have up to 40 digits, more than a DynamoDB number holds, so they are
+# stored and compared as strings zero-padded to this width
+SEQUENCE_WIDTH = 40
+
+logger = logging.getLogger()
+
+
+# Raised for a stream record whose sequence number is not after the one of the record before it
+# from the same partition key; the record is reported as a failure of its own.
+class RecordOutOfOrder(Exception):
+    pass
+
+# Running total of one (user, date, context, metric) key within a stream batch, with the
+# sequence number of the first record that contributed to it, the first and last sequence
+# numbers of the records of each hdi-health-data partition key (a user, or a shard of a user)
+# that contributed to it, and the id of the stream shard the records were read from.
+class MetricTotal:
+    __slots__ = ("total", "count", "unit", "first_sequence", "sources", "stream_shard")
+
+    def __init__(self, unit, sequence, total=0, count=0, sources=None, stream_shard=""):
+        self.unit = unit
+        self.total = total
+        self.count = count
+        self.first_sequence = sequence
+        self.sources = {} if sources is None else sources
+        self.stream_shard = stream_shard
+
+    # Function to record the sequence number of a record of a partition key. The last applied
+    # sequence numbers of a daily item are only a valid replay guard if the records of each
+    # partition key come in order, which they do within one stream shard.
+    def add_sequence(self, source, sequence):
+        sequences = self.sources.get(source)
+        if sequences is None:
+            self.sources[source] = [sequence, sequence]
+            return
+        if padded_sequence(sequence) <= padded_sequence(sequences[1]):
+            raise RecordOutOfOrder(f"Stream record {sequence} of {source} is not after {sequences[1]}")
+        sequences[1] = sequence
+
+    # Function to convert the total to the Decimal stored in DynamoDB.
+    def decimal_total(self):
+        if isinstance(self.total, int):
+            return Decimal(self.total)
+        return Decimal(format(self.total, f".{FLOAT_SIGNIFICANT_DIGITS}g"))
+
+
+# Function to pad a stream sequence number so that sequence numbers compare as strings.
+def padded_sequence(sequence):
+    return sequence.zfill(SEQUENCE_WIDTH)
+
+# Sequence numbers are only comparable within a stream shard: when a table partition splits, the
+# records of a partition key continue in child shards. A daily item therefore stores the position
+# of the last applied record, its padded sequence number after the id of its stream shard, e.g.
+# "shardId-00000001...#000...0123". Lambda names the shard in the events of a tumbling window;
+# events without one store the padded sequence number alone.
+
+# Function to return the stored position of a record of a stream shard.
+def stream_position(stream_shard, sequence):
+    return f"{stream_shard}{DELIMETER}{padded_sequence(sequence)}" if stream_shard else padded_sequence(sequence)
+
+# Function to return the position applied from a partition key if it was applied from the given
+# stream shard, or "" when nothing was: positions of other shards are not compared.
+def position_in_shard(applied, source, stream_shard):
+    stored = applied.get(source, "")
+    if stream_shard:
+        return stored if stored.startswith(f"{stream_shard}{DELIMETER}") else ""
+    return "" if DELIMETER in stored else stored
+
+# Function to select the records of a stream shard that come after the position applied from their
+# partition key, given as a dict of partition keys and stored positions.
+def records_after(records, applied, stream_shard=""):
+    return [record for record in records
+            if stream_position(stream_shard, record[DYNAMODB][SEQUENCE_NUMBER])
+            > position_in_shard(applied, record_source(record), stream_shard)]
+
+# Function to add readings to the MetricTotal of their (user_id, date, data_context, metric) key:
+# one reading, or the sum of several (of a block) with their number in readings.
+# The date is the "YYYY-MM-DD" prefix of the timestamp. Raises KeyError or ValueError for a malformed reading.
+def add_reading(totals, user_id, context_time, quantity, unit, sequence=None, readings=1, source=None, stream_shard=""):
+    metric, data_context, timestamp_str = context_time.split(DELIMETER)
+    if (metric, data_context) not in AGGREGATED_CONTEXTS:
+        return
+    key = (user_id, timestamp_str[:10], data_context, metric)
+    # Integer readings are kept as exact integers
+    value = int(quantity) if quantity.lstrip("-").isdigit() else float(quantity)
+    total = totals.get(key)
+    if total is None:
+        total = totals[key] = MetricTotal(unit, sequence, stream_shard=stream_shard)
+    if sequence is not None:
+        total.add_sequence(source, sequence)
+    total.total += value
+    total.count += readings
+
+# Function to read what a stream record adds to its key, as (user_id, context_time, quantity,
+# readings, unit), or None when it adds nothing.
+# A new reading adds its quantity. A block of readings (see reading_blocks.py), or a reading
+# written again, adds the difference between its new and old image, so readings merged into a
+# block or rewritten with the same quantity are not counted twice. Copies written by
+# hdi-migrate-shards.py add nothing, and the user id is read without the shard of its partition.
+def record_change(record):
+    new_image = record[DYNAMODB][NEWIMAGE]
+    old_image = record[DYNAMODB].get(OLDIMAGE, {})
+    if SHARD_MIGRATED in new_image:
+        return None
+    user_id = user_of(new_image[USERID][STRING])
+    if READINGS in new_image:
+        quantity = Decimal(new_image[SUM][NUMBER]) - Decimal(old_image.get(SUM, {NUMBER: "0"})[NUMBER])
+        readings = int(new_image[COUNT][NUMBER]) - int(old_image.get(COUNT, {NUMBER: "0"})[NUMBER])
+    elif QUANTITY in old_image:
+        quantity = Decimal(new_image[QUANTITY][STRING]) - Decimal(old_image[QUANTITY][STRING])
+        readings = 0
+    else:
+        return user_id, new_image[HD_CTX_TIME][STRING], new_image[QUANTITY][STRING], 1, new_image[UNIT][STRING]
+    if not quantity and not readings:
+        return None
+    return user_id, new_image[HD_CTX_TIME][STRING], str(quantity), readings, new_image[UNIT][STRING]
+
+# Function to return the hdi-health-data partition key of a stream record, with its shard if any.
+def record_source(record):
+    return record[DYNAMODB][NEWIMAGE][USERID][STRING]
+
+# Function to accumulate the aggregated readings of a stream batch into one MetricTotal per
+# (user_id, date, data_context, metric) key.
+# Records of a shard arrive in sequence order, so the first and last sequence numbers of a key
+# are the ones of its first and last record. Malformed records can never succeed on a retry;
+# they are logged and skipped instead of failing the batch. A record out of order is left out of
+# its key and its sequence number added to out_of_order, to be reported as a failure of its own.
+def accumulate_records(records, stream_shard="", out_of_order=None):
+    if len(records) >= COLUMNAR_MIN_RECORDS and optional_module(NUMPY) is not None:
+        return accumulate_columnar(records, stream_shard, out_of_order)
+
+    totals = {}
+    for record in records:
+        if record[EVENTNAME] not in CHANGE_EVENTS:
+            continue
+        try:
+            change = record_change(record)
+            if change is not None:
+                user_id, context_time, quantity, readings, unit = change
+                add_reading(totals, user_id, context_time, quantity, unit, record[DYNAMODB][SEQUENCE_NUMBER], readings,
+                            record_source(record), stream_shard)
+        except RecordOutOfOrder as error:
+            out_of_order_record(record, error, out_of_order)
+        except (KeyError, ValueError, ArithmeticError) as error:
+            logger.error(f"Skipping malformed stream record {record.get(DYNAMODB, {}).get(SEQUENCE_NUMBER)}: {error!r}")
+    return totals
+
+# Function to log a record out of order and add its sequence number to the given list.
+def out_of_order_record(record, error, out_of_order):
+    logger.error(f"{error} - Reporting the record as failed")
+    if out_of_order is not None:
+        out_of_order.append(record[DYNAMODB][SEQUENCE_NUMBER])
+
+# Function to accumulate items read from hdi-health-data (for example by a Scan) into the given totals.
+# Blocks of readings are decoded, so a rebuild adds the readings they hold rather than the sum and
+# count stored next to them; items of every shard add to their user.
+def accumulate_items(items, totals=None):
+    totals = {} if totals is None else totals
+    for item in items:
+        try:
+            user_id = user_of(item[USERID])
+            if is_block(item):
+                readings = decode_readings(bytes(item[READINGS]))
+                if readings:
+                    total = sum((value for _, value in readings), Decimal(0))
+                    add_reading(totals, user_id, item[HD_CTX_TIME], str(total), item[UNIT], readings=len(readings))
+            else:
+                add_reading(totals, user_id, item[HD_CTX_TIME], str(item[QUANTITY]), item[UNIT])
+        except (KeyError, ValueError, IndexError, zlib.error) as error:
+            logger.error(f"Skipping malformed item {item.get(USERID)} {item.get(HD_CTX_TIME)}: {error!r}")
+    return totals
+
+# Function to merge the totals of one accumulation into another. The other totals come from
+# later records, so their last sequence numbers win.
+def merge_totals(totals, other):
+    for key, total in other.items():
+        existing = totals.get(key)
+        if existing is None:
+            totals[key] = total
+        else:
+            for source, (first_sequence, last_sequence) in total.sources.items():
+                existing.add_sequence(source, first_sequence)
+                existing.sources[source][1] = last_sequence
+            existing.total += total.total
+            existing.count += total.count
+    return totals
+
+# The state Lambda carries between the invocations of a tumbling window keeps what each record
+# added, not only the totals: per key its unit and one [partition key, sequence number, quantity,
+# readings] entry per record. When the stored sequence numbers of a key fall inside the window,
+# e.g. when a flush was partly applied and retried with more records, the part of the window that
+# was not applied is then totalled exactly from the entries after them.
+
+# Function to add the records of a stream batch to the entries of a window, by key.
+def add_entries(entries, records):
+    for record in records:
+        for key, total in accumulate_records([record]).items():
+            ((source, (sequence, _)),) = total.sources.items()
+            key_entries = entries.setdefault(key, [total.unit, []])
+            key_entries[0] = total.unit
+            key_entries[1].append([source, sequence, total.total, total.count])
+    return entries
+
+# Function to total the entries of a window of a stream shard by key, or only the entries after
+# the positions applied from their partition keys.
+def totals_from_entries(entries, applied=None, stream_shard=""):
+    totals = {}
+    for key, (unit, key_entries) in entries.items():
+        for source, sequence, quantity, readings in key_entries:
+            if (applied is not None and
+                    stream_position(stream_shard, sequence) <= position_in_shard(applied, source, stream_shard)):
+                continue
+            total = totals.get(key)
+            if total is None:
+                total = totals[key] = MetricTotal(unit, sequence, stream_shard=stream_shard)
+            total.add_sequence(source, sequence)
+            total.total += quantity
+            total.count += readings
+    return totals
+
+# Function to convert the entries of a window into its JSON state: one [user_id, date,
+# data_context, metric, unit, entries] list per key.
+def entries_to_state(entries):
+    return {ENTRIES: [[*key, unit, key_entries] for key, (unit, key_entries) in entries.items()]}
+
+# Function to read the entries of a window state. The lists are copied, as a failed invocation
+# returns the state it was given.
+def entries_from_state(state):
+    return {(user_id, date, data_context, metric): [unit, list(key_entries)]
+            for user_id, date, data_context, metric, unit, key_entries in (state or {}).get(ENTRIES, [])}
+
+# Function to accumulate a large batch column-wise: the keys are mapped to integer ids and the
+# quantities are parsed and summed per id by NumPy instead of per record in Python.
+def accumulate_columnar(records, stream_shard="", out_of_order=None):
+    numpy = optional_module(NUMPY)
+    key_ids = {}
+    units = []
+    sequences = []
+    ids = []
+    quantities = []
+    readings_counts = []
+    for record in records:
+        if record[EVENTNAME] not in CHANGE_EVENTS:
+            continue
+        try:
+            change = record_change(record)
+            if change is None:
+                continue
+            user_id, context_time, quantity, readings, unit = change
+            metric, data_context, timestamp_str = context_time.split(DELIMETER)
+            if (metric, data_context) not in AGGREGATED_CONTEXTS:
+                continue
+
+            key = (user_id, timestamp_str[:10], data_context, metric)
+            float(quantity)
+            sequence = record[DYNAMODB][SEQUENCE_NUMBER]
+            source = record_source(record)
+        except (KeyError, ValueError, ArithmeticError) as error:
+            logger.error(f"Skipping malformed stream record {record.get(DYNAMODB, {}).get(SEQUENCE_NUMBER)}: {error!r}")
+            continue
+
+        key_id = key_ids.get(key)
+        if key_id is None:
+            key_id = key_ids[key] = len(units)
+            units.append(None)
+            sequences.append(MetricTotal(unit, sequence))
+        try:
+            sequences[key_id].add_sequence(source, sequence)
+        except RecordOutOfOrder as error:
+            out_of_order_record(record, error, out_of_order)
+            continue
+        units[key_id] = unit
+        ids.append(key_id)
+        quantities.append(quantity)
+        readings_counts.append(readings)
+
+    if not ids:
+        return {}
+
+    ids = numpy.array(ids, dtype=numpy.int64)
+    values = numpy.array(quantities, dtype=numpy.float64)
+    sums = numpy.bincount(ids, weights=values, minlength=len(units))
+    counts = numpy.bincount(ids, weights=numpy.array(readings_counts, dtype=numpy.float64), minlength=len(units))
+    # Keys whose readings are all integers are returned as exact integer sums
+    fractional = numpy.bincount(ids, weights=(values != numpy.floor(values)), minlength=len(units))
+
+    totals = {}
+    for key, key_id in key_ids.items():
+        total = float(sums[key_id]) if fractional[key_id] else int(sums[key_id])
+        totals[key] = MetricTotal(units[key_id], sequences[key_id].first_sequence, total, int(counts[key_id]),
+                                  sequences[key_id].sources, stream_shard)
+    return totals
@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from constants import *
+from batch_writer import error_code
+
+# Metrics aggregated as a daily average of the readings; every other metric is a daily sum
+AVERAGED_METRICS = [HEART_RATE, SPO2, SKIN_TEMP]
+
+# Contexts in which sleep is aggregated; the other metrics are only aggregated without a context
+VALID_SLEEP_CONTEXTS = [SLEEP_IN_THE_BED, SLEEP_LIGHT, SLEEP_REM, SLEEP_AWAKE, SLEEP_DEEP, SLEEP_UNSPECIFIED, SLEEP_NA]
+
+# (metric, context) pairs that are aggregated into daily items
+AGGREGATED_CONTEXTS = frozenset(
+    [(HEART_RATE, NA), (STEP_COUNT, NA), (SPO2, NA), (SKIN_TEMP, NA)]
+    + [(SLEEP_COUNT, sleep_context) for sleep_context in VALID_SLEEP_CONTEXTS]
+)
+
+# Function to read the running sum and count of a daily item.
+# Items written before the sum/count storage mode keep the daily value in `quantity`
+# (and the number of readings behind an average in `hd_referred_count`); they are folded in,
+# so partly migrated items read correctly.
+def item_sum_count(item, metric):
+    total = Decimal(item.get(SUM, 0))
+    count = int(item.get(COUNT, 0))
+    if QUANTITY in item:
+        legacy_count = int(item.get(HD_REFF_COUNT, '1'))
+        if metric in AVERAGED_METRICS:
+            total += Decimal(item[QUANTITY]) * legacy_count
+        else:
+            total += Decimal(item[QUANTITY])
+        count += legacy_count
+    return total, count
+
+# Function to derive the daily value of a metric from its running sum and count.
+def metric_value(metric, total, count):
+    if metric in AVERAGED_METRICS:
+        return total / Decimal(count) if count else Decimal(0)
+    return total
+
+# Function to derive the daily value of an aggregated item.
+def item_value(item, metric):
+    return metric_value(metric, *item_sum_count(item, metric))
+
+# Function to build the sort keys of the monthly and weekly rollup items that contain a day.
+# Rollups are sorted after the daily items of the same metric context ("M" and "W" sort after
+# the digits of a date), so daily range queries never read them.
+def rollup_sort_keys(metric_code_context, date_str):
+    date = datetime.strptime(date_str, DATEFORMAT).date()
+    week_start = date - timedelta(days=date.weekday())
+    return [
+        f"{metric_code_context}{DELIMETER}{MONTHLY}{DELIMETER}{date.replace(day=1).strftime(DATEFORMAT)}",
+        f"{metric_code_context}{DELIMETER}{WEEKLY}{DELIMETER}{week_start.strftime(DATEFORMAT)}",
+    ]
+
+# Function to expand a rollup item into daily items between two dates. A rollup keeps the running
+# sum and count of each of its days in an attribute named after the day; the days of a cohort
+# also keep its number of members.
+def expand_rollup(item, metric_code_context, start_date, end_date):
+    return [
+        {HD_CTX_DATE: f"{metric_code_context}{DELIMETER}{name}", SUM: value[SUM], COUNT: value[COUNT], UNIT: item.get(UNIT),
+         **({MEMBERS: value[MEMBERS]} if MEMBERS in value else {})}
+        for name, value in sorted(item.items())
+        if isinstance(value, dict) and start_date <= name <= end_date
+    ]
+
+# Function to set days of a rollup item in one update. With only_newer, a day is only set where
+# the stored entry has no more readings, as hdi-dailyaggregate does, so a rebuild running next to
+# the stream never replaces a newer day; when that fails for some days, the others are set one by one.
+def set_rollup_days(rollup_table, user_id, sort_key, unit, days, only_newer=False):
+    names = sorted(days)
+    update_args = {
+        'Key': {USERID: user_id, HD_CTX_DATE: sort_key},
+        'UpdateExpression': "SET #unit = :unit, " + ", ".join(f"#d{i} = :d{i}" for i in range(len(names))),
+        'ExpressionAttributeValues': {':unit': unit, **{f":d{i}": days[day] for i, day in enumerate(names)}},
+        'ExpressionAttributeNames': {'#unit': UNIT, **{f"#d{i}": day for i, day in enumerate(names)}},
+    }
+    if only_newer:
+        update_args['ConditionExpression'] = " AND ".join(
+            f"(attribute_not_exists(#d{i}) OR #d{i}.#count <= :c{i})" for i in range(len(names)))
+        update_args['ExpressionAttributeValues'].update({f":c{i}": days[day][COUNT] for i, day in enumerate(names)})
+        update_args['ExpressionAttributeNames']['#count'] = COUNT
+    try:
+        rollup_table.update_item(**update_args)
+    except Exception as error:
+        if not only_newer or error_code(error) != CONDITIONAL_CHECK_FAILED:
+            raise
+        if len(names) > 1:
+            for day in names:
+                set_rollup_days(rollup_table, user_id, sort_key, unit, {day: days[day]}, only_newer)
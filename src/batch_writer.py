@@ -0,0 +1,131 @@
+import random
+import time
+import logging
+from collections import OrderedDict
+from constants import *
+from metrics import count, record_capacity, stage
+
+logger = logging.getLogger()
+
+# Maximum number of put requests accepted by a single BatchWriteItem call
+BATCH_SIZE = 25
+
+# Retry settings for items returned in UnprocessedItems
+MAX_BATCH_RETRIES = 8
+BACKOFF_BASE_SECONDS = 0.05
+BACKOFF_MAX_SECONDS = 5.0
+
+# Number of recently written keys remembered to drop duplicate rows across batches
+DEDUPE_WINDOW = 100000
+
+# Error codes returned by DynamoDB when a request is throttled
+THROTTLING_ERRORS = [
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+]
+
+# Function to create an empty set of write counters.
+def new_write_counts():
+    return {ROWS: 0, WRITTEN: 0, DUPLICATES: 0, RETRIED: 0, FAILED: 0}
+
+# Function to add the counters of a batch to the running totals.
+def merge_write_counts(totals, counts):
+    for name, value in counts.items():
+        totals[name] = totals.get(name, 0) + value
+    return totals
+
+# Function to read the error code of a botocore ClientError without importing botocore.
+def error_code(error):
+    return getattr(error, "response", {}).get("Error", {}).get("Code")
+
+# Function to return True if the SDK retried a call before it succeeded, which for DynamoDB
+# writes is mostly throttling that the caller would not see otherwise.
+def sdk_retried(response):
+    return response.get(RESPONSE_METADATA, {}).get(RETRY_ATTEMPTS, 0) > 0
+
+# Function to compute a jittered exponential backoff delay for a retry attempt.
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt)))
+
+# Function to group items into BatchWriteItem sized batches, dropping duplicate keys.
+# A batch must not contain the same key twice, so the last item seen for a key wins within a batch.
+# Keys of recently written batches are remembered (bounded by dedupe_window) so repeated rows
+# in an export are not written again and do not produce extra stream records.
+def chunk_items(items, key_names=(USERID, HD_CTX_TIME), batch_size=BATCH_SIZE, dedupe_window=DEDUPE_WINDOW):
+    recent_keys = OrderedDict()
+    batch = {}
+    duplicates = 0
+    for item in items:
+        key = tuple(item[name] for name in key_names)
+        if key in recent_keys:
+            duplicates += 1
+            continue
+        if key in batch:
+            duplicates += 1
+        batch[key] = item
+        if len(batch) == batch_size:
+            yield list(batch.values()), duplicates
+            for written_key in batch:
+                recent_keys[written_key] = None
+            while len(recent_keys) > dedupe_window:
+                recent_keys.popitem(last=False)
+            batch = {}
+            duplicates = 0
+    if batch or duplicates:
+        yield list(batch.values()), duplicates
+
+# Function to write one batch with BatchWriteItem, retrying UnprocessedItems with jittered backoff.
+# Every item ends up counted as written or failed; each resubmission is counted as a retry.
+# When a shared rate limiter is given, each call first takes one token per item and
+# reports back whether DynamoDB throttled it, in UnprocessedItems or in attempts the SDK retried. The items are logged one by one at debug level only.
+def write_batch(dynamodb, table_name, items, duplicates=0, limiter=None):
+    counts = new_write_counts()
+    counts[ROWS] = len(items) + duplicates
+    counts[DUPLICATES] = duplicates
+
+    pending = [{PUT_REQUEST: {ITEM: item}} for item in items]
+    attempt = 0
+    while pending:
+        if limiter:
+            with stage(THROTTLE_STAGE):
+                limiter.acquire(len(pending))
+        try:
+            with stage(WRITE_STAGE):
+                response = dynamodb.batch_write_item(RequestItems={table_name: pending},
+                                                     ReturnConsumedCapacity=TOTAL_CAPACITY)
+            record_capacity(response, WRITE_CAPACITY_UNITS)
+            unprocessed = response.get(UNPROCESSED_ITEMS, {}).get(table_name, [])
+            # UnprocessedItems are returned when the table throttles part of the batch
+            throttled = bool(unprocessed) or sdk_retried(response)
+        except Exception as error:
+            if error_code(error) not in THROTTLING_ERRORS:
+                logger.error(f"{error} - Error writing batch of {len(pending)} items to {table_name}")
+                break
+            unprocessed = pending
+            throttled = True
+
+        if limiter:
+            if throttled:
+                limiter.on_throttle()
+            else:
+                limiter.on_success()
+
+        counts[WRITTEN] += len(pending) - len(unprocessed)
+        pending = unprocessed
+        if not pending or attempt == MAX_BATCH_RETRIES:
+            break
+
+        attempt += 1
+        counts[RETRIED] += len(pending)
+        count(RETRIES_METRIC, len(pending))
+        with stage(THROTTLE_STAGE):
+            time.sleep(backoff_delay(attempt))
+
+    counts[FAILED] += len(pending)
+    if pending:
+        logger.error(f"Failed to write {len(pending)} items to {table_name} after {attempt} retries")
+    elif logger.isEnabledFor(logging.DEBUG):
+        for item in items:
+            logger.debug(f"{SUCCESSFULLY_INSERTED}: {item}")
+    return counts
@@ -0,0 +1,130 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from decimal import Decimal
+from constants import *
+from aggregates import AVERAGED_METRICS
+from runtime import client
+
+# Cohort rollups: hdi-dailyaggregate keeps the daily sum and count of every cohort, e.g. the
+# patients of a clinic, in hdi-aggregated-daily items, so population insights are read from a few
+# partitions instead of one query per member. The members are spread over COHORT_SHARD_COUNT
+# shards by a hash of their user id, and each shard keeps the days of its members:
+#
+#   userid          cohort#clinic-a#3
+#   hd-context-date heart_rate#NA#2024-10-01
+#   sum, count      the totals of the readings of the shard's members of the day
+#   members         the number of the shard's members with readings of the day
+#   m#<user id>     the sum and count of the member, as last added to the totals
+#
+# Every update of a shard's day rewrites its item, member attributes included, so the shards keep
+# the item, and the write cost of an update, bounded to the members of one shard, and spread the
+# writes of a cohort over as many partitions. The rollups and versions are kept per shard as well;
+# readers sum the days and versions of all shards.
+#
+# The membership is read from COHORT_MAPPING, a JSON object of cohort ids and the user ids of
+# their members ({"clinic-a": ["1234567", "1234568"]}), in a file of the deployment package or
+# an s3://bucket/key object. It is reloaded every COHORT_MAPPING_TTL_SECONDS, and a new member
+# adds the days updated after it joined.
+
+logger = logging.getLogger()
+
+COHORT_MAPPING = os.environ.get(COHORT_MAPPING_ENV, "")
+COHORT_MAPPING_TTL_SECONDS = int(os.environ.get(COHORT_MAPPING_TTL_SECONDS_ENV, 300))
+# At most 100, the keys a BatchGetItem reads, as the versions of all shards are read with one.
+# It must not change once cohort items are written.
+COHORT_SHARD_COUNT = min(100, max(1, int(os.environ.get(COHORT_SHARD_COUNT_ENV, 16))))
+
+# Members per shard above which a cohort is logged when the mapping is loaded: about 50 bytes each,
+# so past this a shard item takes more than 10 write capacity units per update
+MAX_MEMBERS_PER_SHARD = 200
+
+# Prefix of the attributes holding the contribution of each member to a cohort day
+MEMBER_PREFIX = "m#"
+
+_memberships = {}
+_loaded_at = None
+_lock = threading.Lock()
+
+
+# Function to read the cohort mapping from a file or an S3 object.
+def load_mapping(location):
+    if location.startswith("s3://"):
+        bucket_name, key = location[len("s3://"):].split("/", 1)
+        return json.loads(client(S3).get_object(Bucket=bucket_name, Key=key)[BODY].read())
+    with open(location) as mapping_file:
+        return json.load(mapping_file)
+
+# Function to invert a mapping of cohorts to members into the cohorts of each user.
+def memberships(mapping):
+    cohorts = {}
+    for cohort_id, user_ids in mapping.items():
+        if len(user_ids) > COHORT_SHARD_COUNT * MAX_MEMBERS_PER_SHARD:
+            logger.warning(f"Cohort {cohort_id} has {len(user_ids)} members, more than {MAX_MEMBERS_PER_SHARD} "
+                           f"per shard with {COHORT_SHARD_COUNT_ENV}={COHORT_SHARD_COUNT}")
+        for user_id in user_ids:
+            cohorts.setdefault(str(user_id), []).append(cohort_id)
+    return {user_id: tuple(sorted(cohort_ids)) for user_id, cohort_ids in cohorts.items()}
+
+# Function to return the cohorts of a user. A mapping that cannot be reloaded is logged and the
+# one loaded before is kept.
+def cohorts_of(user_id):
+    global _memberships, _loaded_at
+    if not COHORT_MAPPING:
+        return ()
+    with _lock:
+        if _loaded_at is None or time.monotonic() - _loaded_at >= COHORT_MAPPING_TTL_SECONDS:
+            try:
+                _memberships = memberships(load_mapping(COHORT_MAPPING))
+            except Exception as error:
+                logger.error(f"{error!r} - Error loading the cohort mapping {COHORT_MAPPING}")
+            _loaded_at = time.monotonic()
+        return _memberships.get(user_id, ())
+
+# Function to return the key a cohort's insights are requested and cached under; its items are
+# stored under the keys of its shards.
+def cohort_key(cohort_id):
+    return f"{COHORT}{DELIMETER}{cohort_id}"
+
+def is_cohort_key(partition_key):
+    return partition_key.startswith(f"{COHORT}{DELIMETER}")
+
+# Function to return the partition key of the shard of a cohort that a member's days are added to.
+def member_shard_key(cohort_id, user_id):
+    return f"{cohort_key(cohort_id)}{DELIMETER}{zlib.crc32(user_id.encode()) % COHORT_SHARD_COUNT}"
+
+# Function to return the partition keys of every shard of a cohort.
+def shard_keys(cohort):
+    return [f"{cohort}{DELIMETER}{shard}" for shard in range(COHORT_SHARD_COUNT)]
+
+# Function to sum the days read from the shards of a cohort, each in date order, into the days of
+# the cohort, in date order.
+def merge_shard_days(shard_days):
+    merged = heapq.merge(*shard_days, key=lambda item: item[HD_CTX_DATE])
+    for sort_key, items in itertools.groupby(merged, key=lambda item: item[HD_CTX_DATE]):
+        items = list(items)
+        yield {
+            HD_CTX_DATE: sort_key,
+            SUM: sum(Decimal(item.get(SUM, 0)) for item in items),
+            COUNT: sum(int(item.get(COUNT, 0)) for item in items),
+            MEMBERS: sum(int(item.get(MEMBERS, 0)) for item in items),
+            UNIT: next((item[UNIT] for item in items if item.get(UNIT)), None),
+        }
+
+# Function to return the name of the attribute holding a member's contribution to a cohort day.
+def member_attribute(user_id):
+    return f"{MEMBER_PREFIX}{user_id}"
+
+# Function to turn a cohort day into the day of an average member: averaged metrics are averaged
+# over the readings of all members already, summed metrics (steps, sleep) are divided by the
+# number of members with readings of the day.
+def member_average(item, metric):
+    members = int(item.get(MEMBERS, 0))
+    if metric in AVERAGED_METRICS or not members:
+        return item
+    return {**item, SUM: Decimal(item.get(SUM, 0)) / members}
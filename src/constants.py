@@ -11,10 +11,18 @@ BUCKETNAME = "Bucket"
 FILENAME = "Name"
 KEYNAME = "Key"
 UTF8 = "utf-8"
+UTF8_SIG = "utf-8-sig"
+ETAG = "ETag"
+CONTENT_LENGTH = "ContentLength"
+LAMBDA = "lambda"
+INVOCATION_TYPE_EVENT = "Event"
+AWS_LAMBDA_FUNCTION_NAME = "AWS_LAMBDA_FUNCTION_NAME"
 
 DYNAMODB = "dynamodb"
 ITEM = "Item"
 ITEMS = "Items"
+LAST_EVALUATED_KEY = "LastEvaluatedKey"
+EXCLUSIVE_START_KEY = "ExclusiveStartKey"
 VALUE = "value"
 KEY = "Key"
 USERID = "userid"
@@ -23,15 +31,81 @@ MODIFY = "MODIFY"
 RECORDS = "Records"
 EVENTNAME = "eventName"
 NEWIMAGE = "NewImage"
+OLDIMAGE = "OldImage"
 STRING = "S"
 NUMBER = "N"
+MAP = "M"
+BINARY = "B"
 QUANTITY = "quantity"
+SUM = "sum"
+LAST_SEQUENCE = "last_sequence"
+SEQUENCE_NUMBER = "SequenceNumber"
+BATCH_ITEM_FAILURES = "batchItemFailures"
+ITEM_IDENTIFIER = "itemIdentifier"
 SOURCE_TABLE_NAME = "SOURCE_TABLE_NAME"
+WRITE_RATE_PER_SECOND = "WRITE_RATE_PER_SECOND"
+WRITE_BURST = "WRITE_BURST"
+WRITE_RATE_MIN = "WRITE_RATE_MIN"
+WRITE_RATE_MAX = "WRITE_RATE_MAX"
+IMPORT_WORKERS_ENV = "IMPORT_WORKERS"
+FANOUT_MIN_BYTES_ENV = "FANOUT_MIN_BYTES"
+IMPORT_WORKER_MODE_ENV = "IMPORT_WORKER_MODE"
+WORKER_MODE_LAMBDA = "lambda"
+WORKER_MODE_LOCAL = "local"
 DESTINATION_TABLE_NAME = "DESTINATION_TABLE_NAME"
+AGGREGATION_MODE_ENV = "AGGREGATION_MODE"
+SUM_COUNT_MODE = "sum_count"
+AVERAGE_MODE = "average"
+WINDOW_STATE_MAX_BYTES_ENV = "WINDOW_STATE_MAX_BYTES"
+WINDOW = "window"
+STATE = "state"
+IS_FINAL_INVOKE_FOR_WINDOW = "isFinalInvokeForWindow"
+IS_WINDOW_TERMINATED_EARLY = "isWindowTerminatedEarly"
+SHARD_ID = "shardId"
+RAW_STORAGE_MODE_ENV = "RAW_STORAGE_MODE"
+ITEM_STORAGE_MODE = "item"
+BLOCK_STORAGE_MODE = "block"
+READINGS = "readings"
+RAW_SHARD_COUNT_ENV = "RAW_SHARD_COUNT"
+RAW_SHARD_SCHEME_ENV = "RAW_SHARD_SCHEME"
+HASH_SHARDING = "hash"
+DAY_SHARDING = "day"
+SHARD_MIGRATED = "shard_migrated"
+COHORT_MAPPING_ENV = "COHORT_MAPPING"
+COHORT_MAPPING_TTL_SECONDS_ENV = "COHORT_MAPPING_TTL_SECONDS"
+COHORT_SHARD_COUNT_ENV = "COHORT_SHARD_COUNT"
+COHORT = "cohort"
+MEMBERS = "members"
 HEALTH_RAW_DATA_TABLE = "hdi-health-data"
 DAILY_AGGREGATED_TABLE = "hdi-aggregated-daily"
+IMPORT_CHECKPOINT_TABLE = "hdi-import-checkpoints"
+CONDITIONAL_CHECK_FAILED = "ConditionalCheckFailedException"
+PUT_REQUEST = "PutRequest"
+UNPROCESSED_ITEMS = "UnprocessedItems"
+UNPROCESSED_KEYS = "UnprocessedKeys"
+RESPONSES = "Responses"
+ATTRIBUTES = "Attributes"
 
 HD_CTX_DATE = "hd-context-date"
+IMPORT_ID = "import-id"
+BYTE_RANGE = "byte-range"
+COMMITTED_OFFSET = "committed-offset"
+CHECKPOINT_STATUS = "status"
+UPDATED_AT = "updated-at"
+IN_PROGRESS = "IN_PROGRESS"
+COMPLETE = "COMPLETE"
+IMPORT_RANGE = "importRange"
+RANGE_START = "start"
+RANGE_END = "end"
+DATA_START = "dataStart"
+HEADER = "header"
+RANGES = "ranges"
+MANIFEST = "manifest"
+PREFIX = "prefix"
+OBJECTS = "objects"
+FAILED_OBJECTS = "failedObjects"
+CONTENTS = "Contents"
+LIST_OBJECTS_V2 = "list_objects_v2"
 HD_CTX_TIME = "hd-context-time"
 HEART_RATE = "heart_rate"
 HEART_RATE_SUM = "heart_rate_sum"
@@ -65,6 +139,84 @@ DELIMETER = "#"
 AGGREGATION_PROCESSING_SUCCESSFULL = "Aggregation completed successfully"
 FILE_PROCESSING_SUCCESSFULL = "CSV File processing completed successfully"
 SUCCESSFULLY_INSERTED = "Successfully inserted"
+ROWS = "rows"
+WRITTEN = "written"
+DUPLICATES = "duplicates"
+RETRIED = "retried"
+FAILED = "failed"
+MIGRATED = "migrated"
+SKIPPED = "skipped"
+RATE = "rate"
+SUCCESSES = "successes"
+THROTTLES = "throttles"
+WAITED_SECONDS = "waitedSeconds"
+RATE_LIMITER = "rateLimiter"
+SEGMENTS = "segments"
+TOTALS = "totals"
+CHECKPOINT_ID = "checkpointId"
+GENERATION = "generation"
+CHUNKS = "chunks"
+CHUNK = "chunk"
+DRY_RUN = "dryRun"
+ROLLUPS_ONLY = "rollupsOnly"
+NEW = "new"
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+DIFFERENCES = "differences"
+ROLLUPS = "rollups"
+COHORT_DAYS = "cohortDays"
+ENTRIES = "entries"
+HITS = "hits"
+MISSES = "misses"
+EVICTIONS = "evictions"
+VERSION = "version"
+DAILY = "D"
+REQUESTS = "requests"
+RESULTS = "results"
+INSIGHT_PRECISION_ENV = "INSIGHT_PRECISION"
+DECIMAL_PRECISION = "decimal"
+FLOAT_PRECISION = "float"
+MAX_POOL_CONNECTIONS = "max_pool_connections"
+MAX_POOL_CONNECTIONS_ENV = "AWS_MAX_POOL_CONNECTIONS"
+SESSION = "session"
+CLIENT = "client"
+RESOURCE = "resource"
+TABLE = "table"
+NUMPY = "numpy"
+METRICS_NAMESPACE_ENV = "METRICS_NAMESPACE"
+METRICS_ENABLED_ENV = "METRICS_ENABLED"
+LOG_LEVEL_ENV = "LOG_LEVEL"
+CONSUMED_CAPACITY = "ConsumedCapacity"
+RESPONSE_METADATA = "ResponseMetadata"
+RETRY_ATTEMPTS = "RetryAttempts"
+CAPACITY_UNITS = "CapacityUnits"
+TOTAL_CAPACITY = "TOTAL"
+READ_CAPACITY_UNITS = "ReadCapacityUnits"
+WRITE_CAPACITY_UNITS = "WriteCapacityUnits"
+PARSE_STAGE = "Parse"
+READ_STAGE = "Read"
+WRITE_STAGE = "Write"
+ROLLUP_STAGE = "Rollup"
+AGGREGATE_STAGE = "Aggregate"
+THROTTLE_STAGE = "Throttle"
+RECORDS_METRIC = "Records"
+KEYS_METRIC = "Keys"
+ITEMS_METRIC = "Items"
+ROWS_METRIC = "Rows"
+WRITTEN_METRIC = "Written"
+DUPLICATES_METRIC = "Duplicates"
+RETRIES_METRIC = "Retries"
+CONFLICTS_METRIC = "Conflicts"
+FAILURES_METRIC = "Failures"
+REQUESTS_METRIC = "Requests"
+CACHE_HITS_METRIC = "CacheHits"
+CACHE_MISSES_METRIC = "CacheMisses"
+WINDOW_FLUSHES_METRIC = "WindowFlushes"
+EARLY_FLUSHES_METRIC = "EarlyFlushes"
+INSIGHT_CACHE_ENTRIES = "INSIGHT_CACHE_ENTRIES"
+INSIGHT_CACHE_TTL_SECONDS = "INSIGHT_CACHE_TTL_SECONDS"
+INSIGHT_CACHE_OPEN_TTL_SECONDS = "INSIGHT_CACHE_OPEN_TTL_SECONDS"
+DAYS = "days"
 START_DATE = "startDate"
 END_DATE = "endDate"
 LABEL = "label"
@@ -96,3 +248,18 @@ ERROR_TYPE = "errorType"
 STACK_TRACE = "stackTrace"
 STATUS_CODE = "statusCode"
 MESSAGE_BODY = "body"
+MESSAGE = "message"
+
+CSV_FORMAT = "csv"
+JSON_FORMAT = "json"
+JSONL_FORMAT = "jsonl"
+PARQUET_FORMAT = "parquet"
+GZIP = "gzip"
+ZSTD = "zstd"
+HEALTH_METRIC = "health_metric"
+METRIC_CONTEXT = "metric_context"
+TIMESTAMP = "timestamp"
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+PYARROW_PARQUET = "pyarrow.parquet"
+ZSTANDARD = "zstandard"
+COMPRESSION_ZSTD = "compression.zstd"
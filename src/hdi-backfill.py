@@ -0,0 +1,552 @@
+import argparse
+import json
+import os
+import sys
+import time
+import threading
+import traceback
+import zlib
+import concurrent.futures
+import logging
+from datetime import datetime
+from decimal import Decimal
+from constants import *
+from accumulator import accumulate_items, merge_totals, MetricTotal
+from aggregates import AGGREGATED_CONTEXTS, AVERAGED_METRICS, item_sum_count, metric_value, rollup_sort_keys, set_rollup_days
+from batch_writer import chunk_items, error_code, merge_write_counts, new_write_counts, write_batch
+from cohorts import MEMBER_PREFIX, cohorts_of, member_attribute, member_shard_key
+from rate_limiter import AdaptiveRateLimiter
+from runtime import client, configure, dynamodb, limited_dynamodb, table
+from sharding import partition_keys
+
+# Rebuild of hdi-aggregated-daily from hdi-health-data, for when the aggregation rules change or
+# stream records were lost. The raw table is read with parallel Scan segments, or with a Query per
+# user and metric for a targeted date range; the readings are accumulated in memory with the same
+# rules as hdi-dailyaggregate and the daily items are replaced with BatchWriteItem; the days of the
+# monthly and weekly rollup items are set from them. With COHORT_MAPPING set, the contributions of
+# the rebuilt members to the days of their cohort shards are replaced too. The items are written in the format of
+# AGGREGATION_MODE, which must be that of hdi-dailyaggregate: with average, as a quantity and
+# a reading count, and without rollups, which only the sum_count mode keeps up to date.
+# Pause the stream trigger of hdi-daily-aggregate while a backfill runs: readings aggregated by
+# both would be counted twice.
+#
+#   python src/hdi-backfill.py --segments 16 --checkpoint backfill.json --dry-run
+#   python src/hdi-backfill.py --user-id 1234567 --start-date 2024-10-01 --end-date 2024-10-31
+#
+# With --rollups-only the daily items are left as they are and the rollup items are rebuilt from
+# them, e.g. once after rollups are deployed, so the days written before are in their rollups too.
+# Days are only set where the stream has not written a day with more readings, so the stream
+# trigger can keep running.
+#
+#   python src/hdi-backfill.py --rollups-only --segments 16
+#
+# The Lambda function keeps the progress of a whole-table backfill in hdi-import-checkpoints, and
+# hands the rest of the Scan to a new invocation before its time runs out.
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+AGGREGATION_MODE = os.environ.get(AGGREGATION_MODE_ENV, SUM_COUNT_MODE)
+
+# Default number of Scan segments, each read by its own thread
+DEFAULT_SEGMENTS = 8
+
+# Number of threads writing daily items
+WRITE_THREADS = 10
+
+# Minimum number of seconds between two saves of the checkpoint file
+CHECKPOINT_INTERVAL_SECONDS = 30
+
+# Remaining time of an invocation below which the Scan stops and continues in a new invocation
+RESUME_MARGIN_MILLIS = 60000
+
+# Bytes of the compressed totals saved per item of hdi-import-checkpoints, below the 400 KB item limit
+CHECKPOINT_CHUNK_BYTES = 350000
+
+# Maximum number of keys accepted by a single BatchGetItem call
+BATCH_GET_SIZE = 100
+
+# Number of differing items listed in a dry-run report
+DIFF_SAMPLE_SIZE = 20
+
+# Attempts to rewrite the day of a cohort shard that the stream updated after it was read
+MAX_CONFLICT_RETRIES = 5
+
+# Attributes read from hdi-health-data: those of single readings and of blocks of readings
+RAW_PROJECTION = "#userid, #time, #quantity, #unit, #readings"
+RAW_PROJECTION_NAMES = {'#userid': USERID, '#time': HD_CTX_TIME, '#quantity': QUANTITY, '#unit': UNIT,
+                        '#readings': READINGS}
+
+write_limiter = AdaptiveRateLimiter.from_environment()
+
+# Function to process errors that occur during the execution of the lambda function.
+def process_error() -> dict:
+    exType, exValue, exTraceback = sys.exc_info()
+    tracebackString = traceback.format_exception(exType, exValue, exTraceback)
+    errorMsg = json.dumps(
+        {
+            ERROR_TYPE: exType.__name__,
+            ERROR_MESSAGE: str(exValue),
+            STACK_TRACE: tracebackString,
+        }
+    )
+    return errorMsg
+
+# Progress of a Scan backfill: the last evaluated key of every segment and the totals accumulated
+# from the pages read so far. Both are updated together, so a saved checkpoint resumes without
+# counting a page twice.
+class ScanCheckpoint:
+
+    def __init__(self, path, segments):
+        self.path = path
+        self.segments = {segment: {LAST_EVALUATED_KEY: None, COMPLETE: False} for segment in range(segments)}
+        self.totals = {}
+        self._saved_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Function to load a checkpoint written by a run with the same number of segments.
+    def load(self):
+        state = self.read_state() if self.path else None
+        if state is None:
+            return
+        if len(state[SEGMENTS]) != len(self.segments):
+            raise ValueError(f"{self.path} was written with {len(state[SEGMENTS])} segments, not {len(self.segments)}")
+        self.segments = {int(segment): progress for segment, progress in state[SEGMENTS].items()}
+        for user_id, date, data_context, metric, unit, total, count in state[TOTALS]:
+            self.totals[(user_id, date, data_context, metric)] = MetricTotal(unit, None, total, count)
+        logger.info(f"Resuming from {self.path}: {len(self.totals)} daily totals")
+
+    # Function to add the totals of a page and move its segment forward.
+    def commit_page(self, segment, totals, last_key):
+        with self._lock:
+            merge_totals(self.totals, totals)
+            self.segments[segment] = {LAST_EVALUATED_KEY: last_key, COMPLETE: last_key is None}
+            if time.monotonic() - self._saved_at >= CHECKPOINT_INTERVAL_SECONDS:
+                self._save()
+
+    # Function to tell whether every segment was read to its end.
+    def complete(self):
+        return all(progress[COMPLETE] for progress in self.segments.values())
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self._saved_at = time.monotonic()
+        if not self.path:
+            return
+        self.write_state({
+            SEGMENTS: self.segments,
+            TOTALS: [[*key, total.unit, total.total, total.count] for key, total in self.totals.items()],
+        })
+
+    # Function to read the state of a checkpoint file, or None if there is none.
+    def read_state(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as checkpoint_file:
+            return json.load(checkpoint_file)
+
+    # Function to write the state to a new file and rename it, so an interrupted save keeps the previous checkpoint.
+    def write_state(self, state):
+        with open(self.path + ".tmp", "w") as checkpoint_file:
+            json.dump(state, checkpoint_file, default=str)
+        os.replace(self.path + ".tmp", self.path)
+
+# Progress of a Scan backfill run by the Lambda function, kept in hdi-import-checkpoints under the
+# import id backfill#<checkpoint id>. The totals outgrow an item, so they are saved as zlib
+# compressed JSON in chunks of one generation; the state item, written last, names the generation
+# and holds the last evaluated keys. A save interrupted before it keeps the previous checkpoint.
+class TableScanCheckpoint(ScanCheckpoint):
+
+    def __init__(self, checkpoint_id, segments):
+        super().__init__(checkpoint_id, segments)
+        self.generation = 0
+        self.chunk_count = 0
+
+    def key(self, byte_range):
+        return {IMPORT_ID: f"backfill{DELIMETER}{self.path}", BYTE_RANGE: byte_range}
+
+    def chunk_key(self, generation, number):
+        return self.key(f"{TOTALS}{DELIMETER}{generation:09d}{DELIMETER}{number:06d}")
+
+    def read_state(self):
+        checkpoints = table(IMPORT_CHECKPOINT_TABLE)
+        item = checkpoints.get_item(Key=self.key(STATE), ConsistentRead=True).get(ITEM)
+        if item is None:
+            return None
+        self.generation, self.chunk_count = int(item[GENERATION]), int(item[CHUNKS])
+        data = b"".join(bytes(checkpoints.get_item(Key=self.chunk_key(self.generation, number), ConsistentRead=True)[ITEM][CHUNK])
+                        for number in range(self.chunk_count))
+        return {SEGMENTS: json.loads(item[SEGMENTS]), TOTALS: json.loads(zlib.decompress(data))}
+
+    def write_state(self, state):
+        checkpoints = table(IMPORT_CHECKPOINT_TABLE)
+        generation = self.generation + 1
+        data = zlib.compress(json.dumps(state[TOTALS], default=str).encode())
+        chunks = [data[i:i + CHECKPOINT_CHUNK_BYTES] for i in range(0, len(data), CHECKPOINT_CHUNK_BYTES)]
+        for number, chunk in enumerate(chunks):
+            checkpoints.put_item(Item={**self.chunk_key(generation, number), CHUNK: chunk})
+        checkpoints.put_item(Item={**self.key(STATE), GENERATION: generation, CHUNKS: len(chunks),
+                                   SEGMENTS: json.dumps(state[SEGMENTS], default=str), UPDATED_AT: int(time.time())})
+        # The chunks of the previous generation are no longer read
+        for number in range(self.chunk_count):
+            checkpoints.delete_item(Key=self.chunk_key(self.generation, number))
+        self.generation, self.chunk_count = generation, len(chunks)
+
+# Function to read one Scan segment page by page from its last evaluated key, until it ends or
+# should_stop returns True.
+def scan_segment(checkpoint, segment, total_segments, should_stop=None):
+    progress = checkpoint.segments[segment]
+    if progress[COMPLETE]:
+        return
+    scan_args = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'ProjectionExpression': RAW_PROJECTION,
+        'ExpressionAttributeNames': RAW_PROJECTION_NAMES,
+    }
+    last_key = progress[LAST_EVALUATED_KEY]
+    while True:
+        if last_key:
+            scan_args[EXCLUSIVE_START_KEY] = last_key
+        response = table(HEALTH_RAW_DATA_TABLE).scan(**scan_args)
+        last_key = response.get(LAST_EVALUATED_KEY)
+        checkpoint.commit_page(segment, accumulate_items(response.get(ITEMS, [])), last_key)
+        if last_key is None or (should_stop and should_stop()):
+            break
+
+# Function to accumulate the whole raw table with parallel Scan segments, resuming from a checkpoint
+# file or, with checkpoint_id, from hdi-import-checkpoints. Returns the checkpoint, whose segments
+# are not all complete when should_stop stopped the Scan.
+def scan_totals(segments, checkpoint_path=None, checkpoint_id=None, should_stop=None):
+    checkpoint = TableScanCheckpoint(checkpoint_id, segments) if checkpoint_id else ScanCheckpoint(checkpoint_path, segments)
+    checkpoint.load()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(scan_segment, checkpoint, segment, segments, should_stop) for segment in range(segments)]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        finally:
+            checkpoint.save()
+    return checkpoint
+
+# Function to read the readings of one user, metric and context between two dates, from every
+# shard of the user. The range starts at the bare date, so the block of the first hour, which
+# sorts before its readings, is read too.
+def query_metric(user_id, metric, data_context, start_date, end_date):
+    from boto3.dynamodb.conditions import Key # type: ignore
+    prefix = f"{metric}{DELIMETER}{data_context}{DELIMETER}"
+    totals = {}
+    for partition_key in partition_keys(user_id, start_date, end_date):
+        query_args = {
+            'KeyConditionExpression': Key(USERID).eq(partition_key) &
+                                      Key(HD_CTX_TIME).between(f"{prefix}{start_date}", f"{prefix}{end_date} 23:59:59"),
+            'ProjectionExpression': RAW_PROJECTION,
+            'ExpressionAttributeNames': RAW_PROJECTION_NAMES,
+        }
+        while True:
+            response = table(HEALTH_RAW_DATA_TABLE).query(**query_args)
+            accumulate_items(response.get(ITEMS, []), totals)
+            if LAST_EVALUATED_KEY not in response:
+                break
+            query_args[EXCLUSIVE_START_KEY] = response[LAST_EVALUATED_KEY]
+    return totals
+
+# Function to accumulate the readings of the given users between two dates, one Query per
+# user and aggregated (metric, context) pair.
+def query_totals(user_ids, start_date, end_date, threads):
+    totals = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(query_metric, user_id, metric, data_context, start_date, end_date)
+                   for user_id in user_ids for metric, data_context in sorted(AGGREGATED_CONTEXTS)]
+        for future in concurrent.futures.as_completed(futures):
+            merge_totals(totals, future.result())
+    return totals
+
+# Function to build the daily items of the accumulated totals, in the format written by hdi-dailyaggregate.
+def daily_items(totals):
+    for (user_id, date, data_context, metric), total in totals.items():
+        item = {USERID: user_id, HD_CTX_DATE: f"{metric}{DELIMETER}{data_context}{DELIMETER}{date}", UNIT: total.unit}
+        if AGGREGATION_MODE == SUM_COUNT_MODE:
+            yield {**item, SUM: total.decimal_total(), COUNT: total.count}
+        elif metric in AVERAGED_METRICS:
+            yield {**item, QUANTITY: str(metric_value(metric, total.decimal_total(), total.count)), HD_REFF_COUNT: str(total.count)}
+        else:
+            yield {**item, QUANTITY: str(total.decimal_total())}
+
+# Function to replace the daily items with BatchWriteItem.
+def write_items(items, threads):
+    counts = new_write_counts()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(write_batch, limited_dynamodb(), DAILY_AGGREGATED_TABLE, batch, duplicates, write_limiter)
+                   for batch, duplicates in chunk_items(items, key_names=(USERID, HD_CTX_DATE))]
+        for future in concurrent.futures.as_completed(futures):
+            merge_write_counts(counts, future.result())
+    return counts
+
+# Function to group the rebuilt days of the members of cohorts by the day of their cohort shard:
+# its unit and the sum and count of each member, keyed by the shard's partition and sort key.
+def cohort_contributions(items):
+    contributions = {}
+    for item in items:
+        for cohort_id in cohorts_of(item[USERID]):
+            key = (member_shard_key(cohort_id, item[USERID]), item[HD_CTX_DATE])
+            contributions.setdefault(key, (item.get(UNIT), {}))[1][item[USERID]] = (item[SUM], item[COUNT])
+    return contributions
+
+# Function to replace the contributions of rebuilt members in the day of a cohort shard and
+# recompute its totals from the contributions of all its members; members outside a targeted
+# backfill keep theirs. The write is conditional on the totals that were read, so a day the stream
+# updates in the meantime is read again. Returns the written day.
+def write_cohort_day(partition_key, sort_key, unit, members):
+    aggregated = table(DAILY_AGGREGATED_TABLE)
+    for attempt in range(MAX_CONFLICT_RETRIES + 1):
+        stored = aggregated.get_item(Key={USERID: partition_key, HD_CTX_DATE: sort_key}, ConsistentRead=True).get(ITEM)
+        day = {**(stored or {}), USERID: partition_key, HD_CTX_DATE: sort_key, UNIT: unit}
+        for user_id, (day_total, day_count) in members.items():
+            day[member_attribute(user_id)] = {SUM: day_total, COUNT: day_count}
+        contributions = [value for name, value in day.items() if name.startswith(MEMBER_PREFIX)]
+        day[SUM] = sum((Decimal(contribution[SUM]) for contribution in contributions), Decimal(0))
+        day[COUNT] = sum(int(contribution[COUNT]) for contribution in contributions)
+        day[MEMBERS] = len(contributions)
+        if stored is None:
+            condition = {'ConditionExpression': "attribute_not_exists(#userid)", 'ExpressionAttributeNames': {'#userid': USERID}}
+        else:
+            condition = {
+                'ConditionExpression': "#sum = :sum AND #count = :count AND #members = :members",
+                'ExpressionAttributeNames': {'#sum': SUM, '#count': COUNT, '#members': MEMBERS},
+                'ExpressionAttributeValues': {':sum': stored.get(SUM, 0), ':count': stored.get(COUNT, 0),
+                                              ':members': stored.get(MEMBERS, 0)},
+            }
+        write_limiter.acquire(1)
+        try:
+            aggregated.put_item(Item=day, **condition)
+            return day
+        except Exception as error:
+            if error_code(error) != CONDITIONAL_CHECK_FAILED or attempt == MAX_CONFLICT_RETRIES:
+                raise
+
+# Function to write the rebuilt days of the cohort shards. Returns the written days, whose
+# rollups and versions are refreshed like those of the members.
+def write_cohort_days(contributions, threads):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(write_cohort_day, partition_key, sort_key, unit, members)
+                   for (partition_key, sort_key), (unit, members) in contributions.items()]
+        return [future.result() for future in futures]
+
+# Function to group the daily totals by monthly and weekly rollup item. The days of a cohort also
+# keep its number of members.
+def rollup_days(items):
+    rollups = {}
+    for item in items:
+        metric, data_context, date = item[HD_CTX_DATE].split(DELIMETER)
+        for sort_key in rollup_sort_keys(f"{metric}{DELIMETER}{data_context}", date):
+            rollup = rollups.setdefault((item[USERID], sort_key), {UNIT: item.get(UNIT), DAYS: {}})
+            day_total, day_count = item_sum_count(item, metric)
+            rollup[DAYS][date] = {SUM: day_total, COUNT: day_count, **({MEMBERS: item[MEMBERS]} if MEMBERS in item else {})}
+    return rollups
+
+# Function to set the rebuilt days of one rollup item; days outside the backfilled range are kept.
+def write_rollup(user_id, sort_key, rollup, only_newer=False):
+    write_limiter.acquire(1)
+    set_rollup_days(table(DAILY_AGGREGATED_TABLE), user_id, sort_key, rollup[UNIT], rollup[DAYS], only_newer)
+
+# Function to write the rollup items of the rebuilt days.
+def write_rollups(rollups, threads, only_newer=False):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(write_rollup, user_id, sort_key, rollup, only_newer)
+                   for (user_id, sort_key), rollup in rollups.items()]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    return len(futures)
+
+# Function to tell whether a sort key of hdi-aggregated-daily is that of a daily item
+# (metric#context#date), not of a rollup or version item.
+def is_daily_sort_key(sort_key):
+    parts = sort_key.split(DELIMETER)
+    if len(parts) != 3:
+        return False
+    try:
+        datetime.strptime(parts[2], DATEFORMAT)
+        return True
+    except ValueError:
+        return False
+
+# Function to read one Scan segment of hdi-aggregated-daily and return its daily items.
+def scan_daily_segment(segment, total_segments):
+    scan_args = {'Segment': segment, 'TotalSegments': total_segments}
+    items = []
+    while True:
+        response = table(DAILY_AGGREGATED_TABLE).scan(**scan_args)
+        items.extend(item for item in response.get(ITEMS, []) if is_daily_sort_key(item[HD_CTX_DATE]))
+        if LAST_EVALUATED_KEY not in response:
+            return items
+        scan_args[EXCLUSIVE_START_KEY] = response[LAST_EVALUATED_KEY]
+
+# Function to read the daily items of users and cohorts from hdi-aggregated-daily with parallel Scan segments.
+def scan_daily_items(segments):
+    items = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+        for future in [executor.submit(scan_daily_segment, segment, segments) for segment in range(segments)]:
+            items.extend(future.result())
+    return items
+
+# Function to rebuild the rollup items from the daily items as they are stored.
+def backfill_rollups(segments=DEFAULT_SEGMENTS, dry_run=False, threads=WRITE_THREADS):
+    if AGGREGATION_MODE != SUM_COUNT_MODE:
+        raise ValueError(f"Rollups are only kept with {AGGREGATION_MODE_ENV}={SUM_COUNT_MODE}")
+    configure(max(segments, threads))
+    items = scan_daily_items(segments)
+    rollups = rollup_days(items)
+    logger.info(f"Rebuilt {len(rollups)} rollup items from {len(items)} daily items")
+    if dry_run:
+        return {ROLLUPS: len(rollups)}
+    counts = {ROLLUPS: write_rollups(rollups, threads, only_newer=True)}
+    bump_versions(items, threads)
+    return counts
+
+# Function to bump the data version of every rebuilt metric context, so cached insights are refreshed.
+def bump_versions(items, threads):
+    contexts = {(item[USERID], item[HD_CTX_DATE].rsplit(DELIMETER, 1)[0]) for item in items}
+
+    def bump(user_id, metric_code_context):
+        table(DAILY_AGGREGATED_TABLE).update_item(
+            Key={USERID: user_id, HD_CTX_DATE: f"{metric_code_context}{DELIMETER}{VERSION}"},
+            UpdateExpression="ADD #version :one",
+            ExpressionAttributeValues={':one': 1},
+            ExpressionAttributeNames={'#version': VERSION}
+        )
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(bump, user_id, context) for user_id, context in contexts]:
+            future.result()
+
+# Function to read the existing daily items with the given keys.
+def fetch_existing_items(keys):
+    existing = {}
+    for i in range(0, len(keys), BATCH_GET_SIZE):
+        request = {DAILY_AGGREGATED_TABLE: {'Keys': keys[i:i + BATCH_GET_SIZE], 'ConsistentRead': True}}
+        while request:
+            response = dynamodb().batch_get_item(RequestItems=request)
+            for item in response.get(RESPONSES, {}).get(DAILY_AGGREGATED_TABLE, []):
+                existing[(item[USERID], item[HD_CTX_DATE])] = item
+            request = response.get(UNPROCESSED_KEYS)
+    return existing
+
+# Function to compare the rebuilt daily items with the stored ones without writing anything.
+def diff_items(items):
+    existing = fetch_existing_items([{USERID: item[USERID], HD_CTX_DATE: item[HD_CTX_DATE]} for item in items])
+    report = {NEW: 0, CHANGED: 0, UNCHANGED: 0, DIFFERENCES: []}
+    for item in items:
+        stored = existing.get((item[USERID], item[HD_CTX_DATE]))
+        if stored is None:
+            report[NEW] += 1
+            continue
+        metric = item[HD_CTX_DATE].split(DELIMETER)[0]
+        stored_sum, stored_count = item_sum_count(stored, metric)
+        item_sum, item_count = item_sum_count(item, metric)
+        if stored_sum == item_sum and stored_count == item_count:
+            report[UNCHANGED] += 1
+            continue
+        report[CHANGED] += 1
+        if len(report[DIFFERENCES]) < DIFF_SAMPLE_SIZE:
+            report[DIFFERENCES].append({
+                USERID: item[USERID], HD_CTX_DATE: item[HD_CTX_DATE],
+                SUM: [str(stored_sum), str(item_sum)], COUNT: [stored_count, item_count],
+            })
+    return report
+
+# Function to run a backfill; user_id selects a targeted Query backfill between start_date and end_date.
+# A Scan stopped by should_stop writes nothing and returns the IN_PROGRESS status of its checkpoint.
+def backfill(segments=DEFAULT_SEGMENTS, user_id=None, start_date=None, end_date=None,
+             checkpoint_path=None, dry_run=False, threads=WRITE_THREADS, checkpoint_id=None, should_stop=None):
+    configure(max(segments, threads))
+    if user_id:
+        totals = query_totals(user_id if isinstance(user_id, list) else [user_id], start_date, end_date, threads)
+    else:
+        checkpoint = scan_totals(segments, checkpoint_path, checkpoint_id, should_stop)
+        if not checkpoint.complete():
+            logger.info(f"Stopped the Scan with {len(checkpoint.totals)} daily totals; it continues from its checkpoint")
+            return {CHECKPOINT_STATUS: IN_PROGRESS}
+        totals = checkpoint.totals
+    items = list(daily_items(totals))
+    logger.info(f"Rebuilt {len(items)} daily items")
+
+    # Cohort days, like rollups, are only kept in sum_count mode
+    sum_count = AGGREGATION_MODE == SUM_COUNT_MODE
+    contributions = cohort_contributions(items) if sum_count else {}
+
+    if dry_run:
+        return {**diff_items(items), ROLLUPS: len(rollup_days(items)) if sum_count else 0, COHORT_DAYS: len(contributions)}
+    counts = write_items(items, threads)
+    cohort_days = write_cohort_days(contributions, threads)
+    counts[COHORT_DAYS] = len(cohort_days)
+    counts[ROLLUPS] = write_rollups(rollup_days(items + cohort_days), threads) if sum_count else 0
+    bump_versions(items + cohort_days, threads)
+    logger.info(f"Backfilled {DAILY_AGGREGATED_TABLE}: {counts}, write rate: {write_limiter.stats()}")
+    return counts
+
+# Lambda handler
+# Expects {"userid": ..., "fromDate": "YYYY-MM-DD", "toDate": "YYYY-MM-DD", "dryRun": false}
+# for a targeted backfill, {"segments": N} to rebuild the whole table, or {"rollupsOnly": true} to
+# rebuild the rollups from the daily items. A whole-table Scan saves its progress under the
+# "checkpointId" of the event, the request id of its first invocation by default, and continues
+# in a new asynchronous invocation with that id when less than RESUME_MARGIN_MILLIS are left.
+def lambda_handler(event, context):
+    try:
+        if event.get(ROLLUPS_ONLY):
+            result = backfill_rollups(int(event.get(SEGMENTS, DEFAULT_SEGMENTS)), bool(event.get(DRY_RUN, False)))
+            return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps(result, default=str)}
+        checkpoint_id = None if event.get(USERID) else event.get(CHECKPOINT_ID) or getattr(context, "aws_request_id", None)
+
+        def should_stop():
+            return context is not None and context.get_remaining_time_in_millis() < RESUME_MARGIN_MILLIS
+
+        result = backfill(
+            segments=int(event.get(SEGMENTS, DEFAULT_SEGMENTS)),
+            user_id=event.get(USERID),
+            start_date=event.get(FROMDATE),
+            end_date=event.get(TODATE),
+            dry_run=bool(event.get(DRY_RUN, False)),
+            checkpoint_id=checkpoint_id,
+            should_stop=should_stop,
+        )
+        if result.get(CHECKPOINT_STATUS) == IN_PROGRESS:
+            client(LAMBDA).invoke(
+                FunctionName=os.environ[AWS_LAMBDA_FUNCTION_NAME],
+                InvocationType=INVOCATION_TYPE_EVENT,
+                Payload=json.dumps({**event, CHECKPOINT_ID: checkpoint_id})
+            )
+            result[CHECKPOINT_ID] = checkpoint_id
+        return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps(result, default=str)}
+    except:
+        errorMsg = process_error()
+        logger.error(errorMsg)
+
+    return {STATUS_CODE: 500, MESSAGE_BODY: json.dumps(PROCESSING_FAILED)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Rebuild {DAILY_AGGREGATED_TABLE} from {HEALTH_RAW_DATA_TABLE}")
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS, help="number of parallel Scan segments")
+    parser.add_argument("--threads", type=int, default=WRITE_THREADS, help="number of Query and write threads")
+    parser.add_argument("--user-id", action="append", help="backfill only this user (repeatable), with Query")
+    parser.add_argument("--start-date", help="first day of a --user-id backfill, YYYY-MM-DD")
+    parser.add_argument("--end-date", help="last day of a --user-id backfill, YYYY-MM-DD")
+    parser.add_argument("--checkpoint", help="file recording the Scan progress, used to resume an interrupted run")
+    parser.add_argument("--dry-run", action="store_true", help="compare with the existing items instead of writing")
+    parser.add_argument("--rollups-only", action="store_true", help="rebuild only the rollup items, from the daily items")
+    args = parser.parse_args()
+    if args.user_id and not (args.start_date and args.end_date):
+        parser.error("--user-id requires --start-date and --end-date")
+    if args.rollups_only and (args.user_id or args.checkpoint):
+        parser.error("--rollups-only scans the whole table and takes no --user-id or --checkpoint")
+
+    logging.basicConfig()
+    if args.rollups_only:
+        result = backfill_rollups(args.segments, args.dry_run, args.threads)
+    else:
+        result = backfill(args.segments, args.user_id, args.start_date, args.end_date,
+                          args.checkpoint, args.dry_run, args.threads)
+    print(json.dumps(result, indent=2, default=str))
@@ -1,20 +1,37 @@
 import json
+import os
 import sys
 import traceback
-import boto3 # type: ignore
 import logging
 from constants import *
-from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timezone
 from decimal import Decimal
+from accumulator import (accumulate_records, add_entries, entries_from_state, entries_to_state, position_in_shard,
+                         records_after, stream_position, totals_from_entries)
+from batch_writer import error_code
+from cohorts import cohorts_of, member_attribute, member_shard_key
+from aggregates import AVERAGED_METRICS, item_sum_count, rollup_sort_keys
+from runtime import table
+from metrics import count, instrumented, record_capacity, stage
 
 
-# Initialize the DynamoDB client
-dynamodb = boto3.resource(DYNAMODB)
-destination_table = dynamodb.Table(DAILY_AGGREGATED_TABLE)
+# The DynamoDB table is created on first use and shared by warm invocations (see runtime.py)
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get(LOG_LEVEL_ENV, "INFO"))
+
+# "sum_count" keeps a running sum and count per daily item, updated with a single atomic ADD.
+# "average" is the original read-modify-write of the daily average in `quantity`.
+AGGREGATION_MODE = os.environ.get(AGGREGATION_MODE_ENV, SUM_COUNT_MODE)
+
+# With a tumbling window on the event source mapping (TumblingWindowInSeconds), the totals of a
+# shard are carried in the window state and written once when the window closes. The state is
+# written early when it grows past this size, below the 1 MB Lambda allows.
+WINDOW_STATE_MAX_BYTES = int(os.environ.get(WINDOW_STATE_MAX_BYTES_ENV, 768 * 1024))
+
+# Attempts to add a member's day to a cohort day whose stored contribution of the member differs
+# from the expected one
+MAX_CONFLICT_RETRIES = 5
 
 # Function to process errors that occur during the execution of the lambda function.
 def process_error() -> dict:
@@ -30,169 +47,410 @@ def process_error() -> dict:
     return errorMsg
 
 # Lambda handler
+# Each daily key is updated on its own. A key that fails reports the sequence number of its first
+# record, so Lambda retries the batch from the earliest failing record only; the keys that were
+# already applied are replayed and skipped by their last-applied sequence number. A record out of
+# order within its partition key reports its own sequence number without failing the other keys.
+@instrumented("hdi-dailyaggregate")
 def lambda_handler(event, context):
-    
+    if WINDOW in event:
+        return aggregate_window(event)
+
+    records = event[RECORDS]
+    stream_shard = event.get(SHARD_ID, "")
+    failures = []
+
     try:
-        user_data = defaultdict(lambda: {
-            HEART_RATE_SUM: Decimal(0), HEART_RATE_COUNT: 0,
-            STEPS_SUM: Decimal(0), SLEEP_SUM: Decimal(0),
-            SPO2_SUM: Decimal(0), SPO2_COUNT: 0,
-            SKIN_TEMP_SUM: Decimal(0), SKIN_TEMP_COUNT: 0,
-            UNIT: None
-        })
-        
-        # logger.info(f"Received event: {event}")
-        
-        valid_sleep_contexts = [SLEEP_IN_THE_BED, SLEEP_LIGHT, SLEEP_REM, SLEEP_AWAKE, SLEEP_DEEP, SLEEP_UNSPECIFIED, SLEEP_NA]
-        
-        for record in event[RECORDS]:
-            if record[EVENTNAME] in [INSERT, MODIFY]:
-                new_image = record[DYNAMODB][NEWIMAGE]
-                user_id = new_image[USERID][STRING]
-                health_data = new_image[HD_CTX_TIME][STRING]
-                quantity = new_image[QUANTITY][STRING]
-                unit = new_image[UNIT][STRING]
-                
-                health_data_type, data_context, timestamp_str = health_data.split(DELIMETER)
-                date_str = timestamp_str.split(' ')[0]
-                date = datetime.strptime(date_str, DATEFORMAT).date()
-
-                quantity_value = Decimal(quantity)
-                user_data[(user_id, date, data_context)][UNIT] = unit
-
-                if health_data_type == HEART_RATE and data_context == NA:
-                    user_data[(user_id, date, data_context)][HEART_RATE_SUM] += quantity_value
-                    user_data[(user_id, date, data_context)][HEART_RATE_COUNT] += 1
-                elif health_data_type == STEP_COUNT and data_context == NA:
-                    user_data[(user_id, date, data_context)][STEPS_SUM] += quantity_value
-                elif health_data_type == SLEEP_COUNT and data_context in valid_sleep_contexts:
-                    user_data[(user_id, date, data_context)][SLEEP_SUM] += quantity_value
-                elif health_data_type == SPO2 and data_context == NA:
-                    user_data[(user_id, date, data_context)][SPO2_SUM] += quantity_value
-                    user_data[(user_id, date, data_context)][SPO2_COUNT] += 1
-                elif health_data_type == SKIN_TEMP and data_context == NA:
-                    user_data[(user_id, date, data_context)][SKIN_TEMP_SUM] += quantity_value
-                    user_data[(user_id, date, data_context)][SKIN_TEMP_COUNT] += 1
-
-        for (user_id, date, data_context), data in user_data.items():
-            
-            unit = data[UNIT]
-
-            heart_rate_count = data[HEART_RATE_COUNT]
-            steps_sum = data[STEPS_SUM]
-            sleep_sum = data[SLEEP_SUM]
-            spo2_count = data[SPO2_COUNT]
-            skin_temp_count = data[SKIN_TEMP_COUNT]
-            
-            # Handle heart rate average data with existing values
-            if heart_rate_count > 0:
-                metric_code_heart_rate = f"{HEART_RATE}{DELIMETER}{data_context}{DELIMETER}{date}"
-                existing_avg_hr, existing_hr_count = fetch_existing_data(user_id, metric_code_heart_rate)
-                
-                # Recalculate the heart rate average including the existing data
-                total_heart_rate_sum = data[HEART_RATE_SUM] + (Decimal(existing_avg_hr) * Decimal(existing_hr_count))
-                total_heart_rate_count = heart_rate_count + existing_hr_count
-                average_heart_rate = total_heart_rate_sum / Decimal(total_heart_rate_count)
-                
-                # Save the updated hear rate average
-                save_to_dynamodb(user_id, metric_code_heart_rate, unit, str(average_heart_rate), total_heart_rate_count)
-            
-            # Handle step count data with existing values
-            if steps_sum > 0:
-                metric_code_steps = f"{STEP_COUNT}{DELIMETER}{data_context}{DELIMETER}{date}"
-                existing_steps_sum = fetch_existing_data(user_id, metric_code_steps, is_sum=True)
-
-                # Recalculate the total step count including the existing data
-                total_steps_sum = steps_sum + Decimal(existing_steps_sum)
-
-                # Save the updated step count sum
-                save_to_dynamodb(user_id, metric_code_steps, unit, str(total_steps_sum))
-
-            # Handle sleep count data with existing values
-            if sleep_sum > 0:
-                metric_code_sleep = f"{SLEEP_COUNT}{DELIMETER}{data_context}{DELIMETER}{date}"
-                existing_sleep_sum = fetch_existing_data(user_id, metric_code_sleep, is_sum=True)
-                
-                # Recalculate the total sleep count including the existing data
-                total_sleep_sum = sleep_sum + Decimal(existing_sleep_sum)
-
-                # Save the updated sleep count sum
-                save_to_dynamodb(user_id, metric_code_sleep, unit, str(total_sleep_sum))
-
-            # Handle spo2 data with existing values
-            if spo2_count > 0:
-                metric_code_spo2 = f"{SPO2}{DELIMETER}{data_context}{DELIMETER}{date}"
-                existing_avg_spo2, existing_spo2_count = fetch_existing_data(user_id, metric_code_spo2)
-                
-                # Recalculate the spo2 average including the existing data
-                total_spo2_sum = data[SPO2_SUM] + (Decimal(existing_avg_spo2) * Decimal(existing_spo2_count))
-                total_spo2_count = spo2_count + existing_spo2_count
-                average_spo2 = total_spo2_sum / Decimal(total_spo2_count)
-                
-                # Save the updated spo2 average
-                save_to_dynamodb(user_id, metric_code_spo2, unit, str(average_spo2), total_spo2_count)
-
-            # Handle skin temeprature data with existing values
-            if skin_temp_count > 0:
-                metric_code_skin_temp = f"{SKIN_TEMP}{DELIMETER}{data_context}{DELIMETER}{date}"
-                existing_avg_skin_temp, existing_skin_temp_count = fetch_existing_data(user_id, metric_code_skin_temp)
-                
-                # Recalculate the skin temerature average including the existing data
-                total_skin_temp_sum = data[SKIN_TEMP_SUM] + (Decimal(existing_avg_skin_temp) * Decimal(existing_skin_temp_count))
-                total_skin_temp_count = skin_temp_count + existing_skin_temp_count
-                average_skin_temp = total_skin_temp_sum / Decimal(total_skin_temp_count)
-                
-                # Save the updated skin temerature average
-                save_to_dynamodb(user_id, metric_code_skin_temp, unit, str(average_skin_temp), total_skin_temp_count)
-
-        return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps(AGGREGATION_PROCESSING_SUCCESSFULL)}
-    
-    except: 
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Received event: {event}")
+
+        with stage(PARSE_STAGE):
+            out_of_order = []
+            totals = accumulate_records(records, stream_shard, out_of_order)
+        count(RECORDS_METRIC, len(records))
+        count(KEYS_METRIC, len(totals))
+
+        failures = apply_totals(totals, records) + out_of_order
+
+    except:
         errorMsg = process_error()
         logger.error(errorMsg)
+        failures = [records[0][DYNAMODB][SEQUENCE_NUMBER]] if records else []
 
-    return {STATUS_CODE: 500, MESSAGE_BODY: json.dumps(PROCESSING_FAILED)}
+    if failures:
+        count(FAILURES_METRIC, len(failures))
+        return {
+            STATUS_CODE: 500,
+            MESSAGE_BODY: json.dumps(PROCESSING_FAILED),
+            BATCH_ITEM_FAILURES: [{ITEM_IDENTIFIER: sequence} for sequence in failures]
+        }
+    return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps(AGGREGATION_PROCESSING_SUCCESSFULL), BATCH_ITEM_FAILURES: []}
 
-# Function to fetch existing data for the metric code to correctly perform the aggregaton.
-def fetch_existing_data(user_id, metric_code, is_sum=False):
+# Function to aggregate a batch of a tumbling window. The records of the batch are added to the
+# state of the window, which is only written to DynamoDB by the final invocation of the window,
+# or early when the state gets too large or Lambda ends the window early; the state then starts
+# empty again.
+# A failed write fails the whole batch: Lambda retries it with the state it started with, and
+# the entries of the keys that were already written are skipped by their last applied sequence numbers.
+def aggregate_window(event):
+    records = event.get(RECORDS, [])
+    state = event.get(STATE) or {}
+    stream_shard = event.get(SHARD_ID, "")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Received window event: {event}")
     try:
-        response = destination_table.get_item(
-            Key={USERID: user_id, HD_CTX_DATE: metric_code},
-            ConsistentRead=True
-        )
-        if ITEM in response:
-            if not is_sum:
-                avg_value = Decimal(response[ITEM][QUANTITY])
-                referred_count = int(response[ITEM].get(HD_REFF_COUNT, '1'))
-                return avg_value, referred_count
-            else:
-                return Decimal(response[ITEM][QUANTITY])
-        else:
-            return (Decimal(0), 0) if not is_sum else Decimal(0)
+        with stage(PARSE_STAGE):
+            entries = add_entries(entries_from_state(state), records)
+            totals = totals_from_entries(entries, stream_shard=stream_shard)
+        count(RECORDS_METRIC, len(records))
+        window_state = entries_to_state(entries)
+
+        # A window Lambda terminates early, as its state outgrew the 1 MB Lambda carries, is not
+        # continued: its state is written now instead of being dropped
+        final = event.get(IS_FINAL_INVOKE_FOR_WINDOW, False) or event.get(IS_WINDOW_TERMINATED_EARLY, False)
+        if not final and len(json.dumps(window_state)) < WINDOW_STATE_MAX_BYTES:
+            return {STATE: window_state, BATCH_ITEM_FAILURES: []}
+
+        if not final:
+            count(EARLY_FLUSHES_METRIC)
+            logger.info(f"Writing the window state of {len(totals)} keys early")
+        count(WINDOW_FLUSHES_METRIC)
+        count(KEYS_METRIC, len(totals))
+        failed = bool(apply_totals(totals, records, entries))
     except:
         errorMsg = process_error()
-        logger.error(f"{errorMsg} - Error fetching data for {user_id} and {metric_code}")
-        return (Decimal(0), 0) if not is_sum else Decimal(0)
+        logger.error(errorMsg)
+        failed = True
+
+    if failed:
+        count(FAILURES_METRIC)
+        if not records:
+            # The final invocation of a window may have no records to report; failing it retries it
+            raise RuntimeError(f"{PROCESSING_FAILED}: the window state could not be written")
+        return {
+            STATUS_CODE: 500,
+            MESSAGE_BODY: json.dumps(PROCESSING_FAILED),
+            STATE: state,
+            BATCH_ITEM_FAILURES: [{ITEM_IDENTIFIER: records[0][DYNAMODB][SEQUENCE_NUMBER]}]
+        }
+    return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps(AGGREGATION_PROCESSING_SUCCESSFULL), STATE: {}, BATCH_ITEM_FAILURES: []}
+
+# Function to apply the totals of a batch or window, key by key; a window also passes the entries
+# of its records. Returns the first sequence number of every key that failed.
+def apply_totals(totals, records, entries=None):
+    failures = []
+    for key, total in totals.items():
+        try:
+            apply_total(key, total, records, entries)
+        except:
+            errorMsg = process_error()
+            logger.error(f"{errorMsg} - Error aggregating {key}")
+            failures.append(total.first_sequence)
+    return failures
+
+# Function to apply the total of one (user_id, date, data_context, metric) key of a batch.
+def apply_total(key, total, records, entries=None):
+    user_id, date, data_context, metric = key
+    metric_code_context = f"{metric}{DELIMETER}{data_context}"
+    metric_code = f"{metric_code_context}{DELIMETER}{date}"
+    # Insights of closed periods are cached until the version of their metric context changes;
+    # readings of today only affect open periods, which are cached for a short time instead
+    closed = date < datetime.now(timezone.utc).strftime(DATEFORMAT)
+    if AGGREGATION_MODE == SUM_COUNT_MODE:
+        added = total
+        applied, item = add_to_dynamodb(user_id, metric_code, total)
+        if applied is not None:
+            # A retried batch that was partly applied before: add only the records after the stored sequences
+            added = pending_total(key, total, records, applied, entries)
+            if added is not None:
+                applied, item = add_to_dynamodb(user_id, metric_code, added, applied)
+        # Rollups and cohorts are refreshed from the current daily totals even when the records were
+        # already applied, so a batch that failed between the updates completes them on its retry.
+        # The totals include a legacy quantity the item still holds, as the daily insights read it.
+        day_total, day_count = day_sum_count(item, metric)
+        update_rollups(user_id, metric_code_context, date, total.unit, day_total, day_count)
+        for cohort_id in cohorts_of(user_id):
+            # The cohort most likely holds the day of the member as it was before this batch
+            previous = (day_total - added.decimal_total(), day_count - added.count) if added else (day_total, day_count)
+            if update_cohort(cohort_id, user_id, metric_code_context, date, total.unit, day_total, day_count, previous) and closed:
+                bump_version(member_shard_key(cohort_id, user_id), metric_code_context)
+    else:
+        save_average(key, metric_code, total, records, entries)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Aggregated {total.count} readings of {metric_code} for {user_id}")
+
+    if closed:
+        bump_version(user_id, metric_code_context)
+
+# Function to bump the data version of a metric context after a past day was updated.
+def bump_version(user_id, metric_code_context):
+    with stage(WRITE_STAGE):
+        response = table(DAILY_AGGREGATED_TABLE).update_item(
+            Key={USERID: user_id, HD_CTX_DATE: f"{metric_code_context}{DELIMETER}{VERSION}"},
+            UpdateExpression="ADD #version :one",
+            ExpressionAttributeValues={':one': 1},
+            ExpressionAttributeNames={'#version': VERSION},
+            ReturnConsumedCapacity=TOTAL_CAPACITY
+        )
+    record_capacity(response, WRITE_CAPACITY_UNITS)
+
+# Function to return the part of a key's total that was not applied yet, or None if all of it was.
+# applied holds the last position applied from each partition key; only the positions of the stream
+# shard of the total are compared. The rest of a window is totalled from its entries, which include
+# the records of its earlier invocations.
+def pending_total(key, total, records, applied, entries=None):
+    shard = total.stream_shard
+    sequences = [(position_in_shard(applied, source, shard), stream_position(shard, first), stream_position(shard, last))
+                 for source, (first, last) in total.sources.items()]
+    if all(stored >= last for stored, first, last in sequences):
+        return None
+    if all(stored < first for stored, first, last in sequences):
+        return total
+    if entries is not None:
+        return totals_from_entries({key: entries[key]}, applied, shard).get(key)
+    return accumulate_records(records_after(records, applied, shard), shard).get(key)
 
-# Function to save the aggregated data.
-def save_to_dynamodb(user_id, metric_code, unit, quantity, referred_count=None):
+# Function to read an attribute of an item; items returned on a failed condition check are
+# in the low-level attribute value format.
+def attribute_value(item, name, default=None):
+    value = item.get(name, default)
+    if isinstance(value, dict):
+        return value[STRING] if STRING in value else Decimal(value[NUMBER])
+    return value
+
+# Function to return the running sum and count of a daily item as returned by an update, with
+# the legacy quantity and referred count of an item not migrated yet folded in.
+def day_sum_count(item, metric):
+    values = {name: attribute_value(item, name) for name in (SUM, COUNT, QUANTITY, HD_REFF_COUNT) if name in item}
+    return item_sum_count(values, metric)
+
+# Function to return the attribute of a daily item that holds the last sequence number applied
+# from a partition key of hdi-health-data: last_sequence for the partition of the user, and
+# last_sequence#<shard> for each shard of the user (see sharding.py). Records of different shards
+# go to different stream shards, whose sequence numbers cannot be compared.
+def sequence_attribute(source):
+    shard = source.partition(DELIMETER)[2]
+    return f"{LAST_SEQUENCE}{DELIMETER}{shard}" if shard else LAST_SEQUENCE
+
+# Function to read the last applied sequence numbers of an item, by partition key.
+def applied_sequences(user_id, item):
+    applied = {}
+    for name in item:
+        if name == LAST_SEQUENCE:
+            applied[user_id] = attribute_value(item, name)
+        elif name.startswith(f"{LAST_SEQUENCE}{DELIMETER}"):
+            applied[f"{user_id}{name[len(LAST_SEQUENCE):]}"] = attribute_value(item, name)
+    return applied
+
+# Function to build the part of an update that records the last position applied from each
+# partition key of a total. Without applied positions the condition is that the records of every
+# partition key come after its stored position, unless that was stored from another stream shard;
+# with them, that the stored positions are still the ones that were read. Returns the SET clauses,
+# the condition, and the attribute names and values they use.
+def sequence_guard(total, applied=None):
+    shard = total.stream_shard
+    clauses, conditions, names, values = [], [], {}, {}
+    for number, (source, (first, last)) in enumerate(total.sources.items()):
+        name = f"#seq{number}"
+        names[name] = sequence_attribute(source)
+        values[f":last{number}"] = stream_position(shard, last)
+        clauses.append(f"{name} = :last{number}")
+        if applied is None:
+            other_shard = f"NOT begins_with({name}, :shard{number})" if shard else f"contains({name}, :shard{number})"
+            conditions.append(f"(attribute_not_exists({name}) OR {other_shard} OR {name} < :first{number})")
+            values[f":shard{number}"] = f"{shard}{DELIMETER}" if shard else DELIMETER
+            values[f":first{number}"] = stream_position(shard, first)
+        elif source in applied:
+            conditions.append(f"{name} = :applied{number}")
+            values[f":applied{number}"] = applied[source]
+        else:
+            conditions.append(f"attribute_not_exists({name})")
+    return ", ".join(clauses), " AND ".join(conditions), names, values
+
+# Function to recalculate the daily average or sum of a metric from the existing item and save it.
+def save_average(key, metric_code, total, records, entries=None):
+    user_id, metric = key[0], key[3]
+    existing_value, existing_count, applied, stored_quantity = fetch_existing_data(user_id, metric_code)
+    total = pending_total(key, total, records, applied, entries)
+    if total is None:
+        return
+    batch_total = total.decimal_total()
+
+    if metric in AVERAGED_METRICS:
+        # Recalculate the average including the existing data
+        total_sum = batch_total + (existing_value * Decimal(existing_count))
+        total_count = total.count + existing_count
+        if total_count <= 0:
+            # A rewritten reading or block whose day has no readings stored has no average to
+            # update; it would fail the key on every retry
+            logger.warning(f"Skipping {total.count} readings of {metric_code} for {user_id}: the day has no readings")
+            return
+        average = total_sum / Decimal(total_count)
+
+        # Save the updated average
+        save_to_dynamodb(user_id, metric_code, total, str(average), applied, stored_quantity, total_count)
+
+    elif batch_total > 0:
+        # Recalculate the total including the existing data
+        total_sum = batch_total + existing_value
+
+        # Save the updated sum
+        save_to_dynamodb(user_id, metric_code, total, str(total_sum), applied, stored_quantity)
+
+# Function to fetch existing data for the metric code to correctly perform the aggregaton.
+# Returns the stored value, the number of readings behind it, the last applied sequence numbers
+# and the stored quantity as written.
+def fetch_existing_data(user_id, metric_code):
+    with stage(READ_STAGE):
+        response = table(DAILY_AGGREGATED_TABLE).get_item(
+            Key={USERID: user_id, HD_CTX_DATE: metric_code},
+            ConsistentRead=True,
+            ReturnConsumedCapacity=TOTAL_CAPACITY
+        )
+    record_capacity(response, READ_CAPACITY_UNITS)
+    if ITEM in response:
+        item = response[ITEM]
+        return Decimal(item[QUANTITY]), int(item.get(HD_REFF_COUNT, '1')), applied_sequences(user_id, item), item[QUANTITY]
+    return Decimal(0), 0, {}, None
+
+# Function to add a sum and a count to the running totals of an aggregated item.
+# ADD is commutative, so concurrent batches for the same key never lose an update. The condition
+# on the last applied sequence number makes a replayed record a no-op. Returns None and the updated
+# item, or, when the condition fails, the stored sequence numbers and the stored item so the caller
+# can apply what is left.
+def add_to_dynamodb(user_id, metric_code, total, applied=None):
+    # A record at or before the stored position of its partition key in the same stream shard is
+    # taken as applied. That only holds if the records of each partition key come in order from the
+    # shard: MetricTotal.add_sequence checks it within a batch, and the event source mapping keeps
+    # ParallelizationFactor at 1, as Lambda only orders the records of one item, not of one
+    # partition key, across concurrent batches of a shard.
+    # With applied sequence numbers, the update is only valid if no other invocation moved them since they were read.
+    sequence_clauses, condition, expression_names, expression_values = sequence_guard(total, applied)
     try:
-        
-        update_expression = "SET #quantity = :quantity, #unit = :unit"
-        expression_values = {':quantity': quantity, ':unit': unit}
-        expression_names = {'#quantity': 'quantity', '#unit': 'unit'}
-
-        if referred_count is not None:
-            update_expression += ", #count = :referred_count"
-            expression_values[':referred_count'] = str(referred_count)
-            expression_names['#count'] = HD_REFF_COUNT
-        
-        destination_table.update_item(
+        with stage(WRITE_STAGE):
+            response = table(DAILY_AGGREGATED_TABLE).update_item(
+                Key={USERID: user_id, HD_CTX_DATE: metric_code},
+                UpdateExpression=f"ADD #sum :sum, #count :count SET #unit = :unit, {sequence_clauses}",
+                ConditionExpression=condition,
+                ExpressionAttributeValues={**expression_values, ':sum': total.decimal_total(), ':count': total.count,
+                                           ':unit': total.unit},
+                ExpressionAttributeNames={**expression_names, '#sum': SUM, '#count': COUNT, '#unit': UNIT},
+                ReturnValues="ALL_NEW",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+                ReturnConsumedCapacity=TOTAL_CAPACITY
+            )
+        record_capacity(response, WRITE_CAPACITY_UNITS)
+        return None, response[ATTRIBUTES]
+    except Exception as error:
+        if error_code(error) != CONDITIONAL_CHECK_FAILED or applied is not None:
+            raise
+        count(CONFLICTS_METRIC)
+        item = error.response.get(ITEM, {})
+        return applied_sequences(user_id, item), item
+
+# Function to record the running sum and count of a day in its monthly and weekly rollup items.
+# SET is idempotent, and the count of a day only grows, so the condition keeps a slower invocation
+# from overwriting a day with older totals. A day updated late simply replaces its entry.
+# The days of a cohort also record its number of members.
+def update_rollups(user_id, metric_code_context, date, unit, total, day_count, members=None):
+    day = {SUM: total, COUNT: day_count}
+    if members is not None:
+        day[MEMBERS] = members
+    for sort_key in rollup_sort_keys(metric_code_context, date):
+        try:
+            with stage(ROLLUP_STAGE):
+                response = table(DAILY_AGGREGATED_TABLE).update_item(
+                    Key={USERID: user_id, HD_CTX_DATE: sort_key},
+                    UpdateExpression="SET #day = :day, #unit = :unit",
+                    ConditionExpression="attribute_not_exists(#day) OR #day.#count <= :count",
+                    ExpressionAttributeValues={':day': day, ':count': day_count, ':unit': unit},
+                    ExpressionAttributeNames={'#day': date, '#count': COUNT, '#unit': UNIT},
+                    ReturnConsumedCapacity=TOTAL_CAPACITY
+                )
+            record_capacity(response, WRITE_CAPACITY_UNITS)
+        except Exception as error:
+            if error_code(error) != CONDITIONAL_CHECK_FAILED:
+                raise
+            count(CONFLICTS_METRIC)
+
+# Function to add the day of a member to the day of its shard of a cohort (see cohorts.py). The item
+# keeps the sum and count each member last added, and only the difference is ADDed, conditional on
+# the stored contribution being the expected one: members updating the same cohort day concurrently
+# condition on different attributes and never conflict, and a retried update adds nothing twice.
+# On a conflict the stored contribution is returned with the failed condition check and the update
+# is made again; a contribution with fewer readings than the stored one is older and not applied.
+# Returns the sum, count and members of the shard's day, or None when nothing was applied.
+def update_cohort(cohort_id, user_id, metric_code_context, date, unit, total, day_count, previous=None):
+    partition_key = member_shard_key(cohort_id, user_id)
+    member = member_attribute(user_id)
+    expected = previous if previous and previous[1] else None
+    for attempt in range(MAX_CONFLICT_RETRIES + 1):
+        if expected is None:
+            condition = "attribute_not_exists(#member)"
+            expression_values = {':sum': total, ':count': day_count, ':members': 1}
+        else:
+            condition = "#member.#sum = :stored_sum AND #member.#count = :stored_count"
+            expression_values = {':sum': total - expected[0], ':count': day_count - expected[1], ':members': 0,
+                                 ':stored_sum': expected[0], ':stored_count': expected[1]}
+        try:
+            with stage(ROLLUP_STAGE):
+                response = table(DAILY_AGGREGATED_TABLE).update_item(
+                    Key={USERID: partition_key, HD_CTX_DATE: f"{metric_code_context}{DELIMETER}{date}"},
+                    # ADD of no new member still returns the number of members with the updated attributes
+                    UpdateExpression="SET #member = :member, #unit = :unit ADD #sum :sum, #count :count, #members :members",
+                    ConditionExpression=condition,
+                    ExpressionAttributeValues={**expression_values, ':member': {SUM: total, COUNT: day_count}, ':unit': unit},
+                    ExpressionAttributeNames={'#member': member, '#sum': SUM, '#count': COUNT, '#members': MEMBERS, '#unit': UNIT},
+                    ReturnValues="UPDATED_NEW",
+                    ReturnValuesOnConditionCheckFailure="ALL_OLD",
+                    ReturnConsumedCapacity=TOTAL_CAPACITY
+                )
+            record_capacity(response, WRITE_CAPACITY_UNITS)
+            cohort_day = response[ATTRIBUTES]
+            break
+        except Exception as error:
+            if error_code(error) != CONDITIONAL_CHECK_FAILED or attempt == MAX_CONFLICT_RETRIES:
+                raise
+            count(CONFLICTS_METRIC)
+            cohort_day = error.response.get(ITEM, {})
+            stored = cohort_day.get(member)
+            expected = (Decimal(stored[MAP][SUM][NUMBER]), Decimal(stored[MAP][COUNT][NUMBER])) if stored else None
+            if expected and expected[1] > day_count:
+                return None
+            if expected == (total, day_count):
+                # Added before; the rollups are refreshed in case the update that added it failed after it
+                break
+    totals = attribute_value(cohort_day, SUM), attribute_value(cohort_day, COUNT), attribute_value(cohort_day, MEMBERS)
+    update_rollups(partition_key, metric_code_context, date, unit, *totals)
+    return totals
+
+# Function to save the aggregated data. The condition fails, and the key is retried, if another
+# invocation updated the item after it was read: records of other shards of the user move the
+# quantity, not the sequence numbers of this total's partition keys.
+def save_to_dynamodb(user_id, metric_code, total, quantity, applied, stored_quantity, referred_count=None):
+    sequence_clauses, condition, expression_names, expression_values = sequence_guard(total, applied)
+    update_expression = f"SET #quantity = :quantity, #unit = :unit, {sequence_clauses}"
+    expression_values.update({':quantity': quantity, ':unit': total.unit})
+    expression_names.update({'#quantity': 'quantity', '#unit': 'unit'})
+
+    if referred_count is not None:
+        update_expression += ", #count = :referred_count"
+        expression_values[':referred_count'] = str(referred_count)
+        expression_names['#count'] = HD_REFF_COUNT
+
+    if stored_quantity is None:
+        condition += " AND attribute_not_exists(#quantity)"
+    else:
+        condition += " AND #quantity = :stored_quantity"
+        expression_values[':stored_quantity'] = stored_quantity
+
+    with stage(WRITE_STAGE):
+        response = table(DAILY_AGGREGATED_TABLE).update_item(
             Key={USERID: user_id, HD_CTX_DATE: metric_code},
             UpdateExpression=update_expression,
+            ConditionExpression=condition,
             ExpressionAttributeValues=expression_values,
-            ExpressionAttributeNames=expression_names
+            ExpressionAttributeNames=expression_names,
+            ReturnConsumedCapacity=TOTAL_CAPACITY
         )
-    except:
-        errorMsg = process_error()
-        logger.error(f"{errorMsg} - Error saving data for {user_id} and {metric_code}")    
+    record_capacity(response, WRITE_CAPACITY_UNITS)
@@ -1,21 +1,25 @@
+import os
 import sys
 import traceback
-import boto3 # type: ignore
 import logging
 import json
-from boto3.dynamodb.conditions import Key # type: ignore
-from datetime import datetime, timedelta
+import itertools
+import concurrent.futures
+from datetime import datetime, timedelta, timezone
 from calendar import monthrange
-from decimal import Decimal
 from constants import *
+from aggregates import expand_rollup
+from cohorts import cohort_key, is_cohort_key, member_average, merge_shard_days, shard_keys
+from insight_engine import PERIOD_GRANULARITY, period_values, summary_stats
+from insight_cache import caches_from_environment
+from runtime import configure, dynamodb, table
+from metrics import count, instrumented, record_capacity, stage
 
-# Initialize DynamoDB resource
-dynamodb = boto3.resource(DYNAMODB)
-table = dynamodb.Table(DAILY_AGGREGATED_TABLE)
+# The DynamoDB table is created on first use and shared by warm invocations (see runtime.py)
 
 # Set up logging
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get(LOG_LEVEL_ENV, "INFO"))
 
 # Function to process errors that occur during the execution of the lambda function.
 def process_error() -> dict:
@@ -30,47 +34,322 @@ def process_error() -> dict:
     )
     return errorMsg
 
-# Function to retrieve a user's health data for a specific metric code over a defined duration.
-def query_dynamodb(user_id, metric_code_context, start_date, end_date):
-    response = table.query(
-        KeyConditionExpression=Key(USERID).eq(user_id) &
-                              Key(HD_CTX_DATE).between(
-                                  f"{metric_code_context}{DELIMETER}{start_date}",
-                                  f"{metric_code_context}{DELIMETER}{end_date}"
-                              ),
-        ProjectionExpression='#date, #quantity, #unit',
-        ExpressionAttributeNames={
-            '#date': HD_CTX_DATE,
-            '#quantity': QUANTITY,
-            '#unit': UNIT
-        }
-    )
-    return response.get(ITEMS, [])
+# Rollup granularity read for the insight types that group days by month or by week
+ROLLUP_GRANULARITY = {YEARLY: MONTHLY, SIXMONTHLY: WEEKLY}
+
+# Number of threads fetching the sub-ranges of a long date range. The pool is created once
+# per container and reused by warm invocations.
+QUERY_THREADS = 6
+query_executor = concurrent.futures.ThreadPoolExecutor(max_workers=QUERY_THREADS)
+
+# Entries of a batch request are built concurrently on their own pool, so they never wait
+# for month queries queued behind them on the query pool
+BATCH_THREADS = 8
+MAX_BATCH_ENTRIES = 50
+batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_THREADS)
+
+# The shards of a cohort are read concurrently on their own pool, which waits for the month
+# queries of the query pool
+SHARD_THREADS = 8
+shard_executor = concurrent.futures.ThreadPoolExecutor(max_workers=SHARD_THREADS)
+
+# Every query and shard thread of every batch entry can hold a connection
+configure((QUERY_THREADS + SHARD_THREADS) * BATCH_THREADS)
+
+# Caches kept across warm invocations: entries for periods that ended before today are served
+# for INSIGHT_CACHE_TTL_SECONDS, entries that include today for INSIGHT_CACHE_OPEN_TTL_SECONDS
+closed_cache, open_cache = caches_from_environment()
+
+# Attributes read from the daily items
+DAILY_PROJECTION = {
+    'ProjectionExpression': '#date, #quantity, #refcount, #sum, #count, #unit, #members',
+    'ExpressionAttributeNames': {
+        '#date': HD_CTX_DATE,
+        '#quantity': QUANTITY,
+        '#refcount': HD_REFF_COUNT,
+        '#sum': SUM,
+        '#count': COUNT,
+        '#unit': UNIT,
+        '#members': MEMBERS
+    }
+}
+
+# Function to query the aggregated items of a user between two sort keys, following
+# LastEvaluatedKey until every page of the range is read.
+def query_range(user_id, start_key, end_key, projection=None):
+    from boto3.dynamodb.conditions import Key # type: ignore
+    query_args = {
+        'KeyConditionExpression': Key(USERID).eq(user_id) & Key(HD_CTX_DATE).between(start_key, end_key),
+        'ReturnConsumedCapacity': TOTAL_CAPACITY,
+        **(projection or {})
+    }
+    items = []
+    while True:
+        with stage(READ_STAGE):
+            response = table(DAILY_AGGREGATED_TABLE).query(**query_args)
+        record_capacity(response, READ_CAPACITY_UNITS)
+        count(ITEMS_METRIC, len(response.get(ITEMS, [])))
+        items.extend(response.get(ITEMS, []))
+        if LAST_EVALUATED_KEY not in response:
+            return items
+        query_args[EXCLUSIVE_START_KEY] = response[LAST_EVALUATED_KEY]
 
-# Function to calculate deep aggrgations
-def calculate_aggregates(items, insight_type, metric_code_context):
-    data_by_period = {}
+# Function to read the data version of a metric context; it changes whenever a past day is updated.
+# The version of a cohort is the sum of the versions of its shards.
+def fetch_version(user_id, metric_code_context):
+    if is_cohort_key(user_id):
+        return fetch_cohort_version(user_id, metric_code_context)
+    with stage(READ_STAGE):
+        response = table(DAILY_AGGREGATED_TABLE).get_item(
+            Key={USERID: user_id, HD_CTX_DATE: f"{metric_code_context}{DELIMETER}{VERSION}"},
+            ProjectionExpression='#version',
+            ExpressionAttributeNames={'#version': VERSION},
+            ReturnConsumedCapacity=TOTAL_CAPACITY
+        )
+    record_capacity(response, READ_CAPACITY_UNITS)
+    return int(response.get(ITEM, {}).get(VERSION, 0))
 
-    for item in items:
-        date_str = item[HD_CTX_DATE].split(DELIMETER)[-1]
-        date = datetime.strptime(date_str, DATEFORMAT).date()
+# Function to read and sum the data versions of the shards of a cohort with a single BatchGetItem.
+def fetch_cohort_version(cohort, metric_code_context):
+    sort_key = f"{metric_code_context}{DELIMETER}{VERSION}"
+    request = {DAILY_AGGREGATED_TABLE: {
+        'Keys': [{USERID: shard_key, HD_CTX_DATE: sort_key} for shard_key in shard_keys(cohort)],
+        'ProjectionExpression': '#version',
+        'ExpressionAttributeNames': {'#version': VERSION}
+    }}
+    version = 0
+    while request:
+        with stage(READ_STAGE):
+            response = dynamodb().batch_get_item(RequestItems=request, ReturnConsumedCapacity=TOTAL_CAPACITY)
+        record_capacity(response, READ_CAPACITY_UNITS)
+        version += sum(int(item.get(VERSION, 0)) for item in response.get(RESPONSES, {}).get(DAILY_AGGREGATED_TABLE, []))
+        request = response.get(UNPROCESSED_KEYS)
+    return version
 
-        if insight_type == YEARLY:
-            period_key = date.replace(day=1)  # Group by month
-        elif insight_type == SIXMONTHLY:
-            week_start = date - timedelta(days=date.weekday())  # Group by week
-            period_key = week_start
+# Function to select the cache of a period: closed periods only change through late writes,
+# which bump the version; periods that include today change with every new reading.
+def period_cache(end_date):
+    return closed_cache if end_date < datetime.now(timezone.utc).strftime(DATEFORMAT) else open_cache
+
+# Function to read the daily items of a month through the cache.
+def query_month(user_id, metric_code_context, start_date, end_date, version):
+    cache = period_cache(end_date)
+    cache_key = (DAILY, user_id, metric_code_context, start_date, end_date, version)
+    items = cache.get(cache_key)
+    if items is None:
+        prefix = f"{metric_code_context}{DELIMETER}"
+        items = query_range(user_id, f"{prefix}{start_date}", f"{prefix}{end_date}", DAILY_PROJECTION)
+        cache.put(cache_key, items)
+    return items
+
+# Function to split a date range into sub-ranges of at most one calendar month.
+def split_by_month(start_date, end_date):
+    start = datetime.strptime(start_date, DATEFORMAT).date()
+    end = datetime.strptime(end_date, DATEFORMAT).date()
+    ranges = []
+    while start <= end:
+        month_end = start.replace(day=monthrange(start.year, start.month)[1])
+        ranges.append((start.strftime(DATEFORMAT), min(month_end, end).strftime(DATEFORMAT)))
+        start = month_end + timedelta(days=1)
+    return ranges
+
+# Function to read the daily items of a date range. Ranges longer than a month are split by month
+# and the months are queried concurrently; the items are yielded in date order as each month arrives.
+# Each month is cached on its own, so overlapping requests share the months they have in common.
+def query_daily(user_id, metric_code_context, start_date, end_date, version=None):
+    ranges = split_by_month(start_date, end_date)
+    if len(ranges) == 1:
+        yield from query_month(user_id, metric_code_context, start_date, end_date, version)
+        return
+    futures = [query_executor.submit(query_month, user_id, metric_code_context, start, end, version)
+               for start, end in ranges]
+    for future in futures:
+        yield from future.result()
+
+# Function to split a date range into the months or weeks of the rollup items that cover it, as
+# (first day of the rollup, first day in the range, last day in the range).
+def rollup_periods(start_date, end_date, granularity):
+    start = datetime.strptime(start_date, DATEFORMAT).date()
+    end = datetime.strptime(end_date, DATEFORMAT).date()
+    periods = []
+    while start <= end:
+        if granularity == MONTHLY:
+            period_start = start.replace(day=1)
+            period_end = start.replace(day=monthrange(start.year, start.month)[1])
         else:
-            period_key = date  # W and M group by day
+            period_start = start - timedelta(days=start.weekday())
+            period_end = period_start + timedelta(days=6)
+        periods.append((period_start.strftime(DATEFORMAT), start.strftime(DATEFORMAT), min(period_end, end).strftime(DATEFORMAT)))
+        start = period_end + timedelta(days=1)
+    return periods
+
+# Function to read the days of a date range from the monthly or weekly rollup items, in date order.
+# The days of the months or weeks without a rollup item, e.g. before rollups were deployed and
+# backfilled, are read from the daily items; consecutive ones in a single range.
+def query_rollups(user_id, metric_code_context, start_date, end_date, granularity, version=None):
+    periods = rollup_periods(start_date, end_date, granularity)
+    prefix = f"{metric_code_context}{DELIMETER}{granularity}{DELIMETER}"
+    rollups = {item[HD_CTX_DATE][len(prefix):]: item
+               for item in query_range(user_id, f"{prefix}{periods[0][0]}", f"{prefix}{end_date}")}
+    missing = None
+    for period_start, first_day, last_day in periods:
+        rollup = rollups.get(period_start)
+        if rollup is None:
+            missing = (missing[0] if missing else first_day, last_day)
+            continue
+        if missing:
+            yield from query_daily(user_id, metric_code_context, *missing, version)
+            missing = None
+        yield from expand_rollup(rollup, metric_code_context, first_day, last_day)
+    if missing:
+        yield from query_daily(user_id, metric_code_context, *missing, version)
+
+# Function to retrieve a user's health data for a specific metric code over a defined duration.
+# Yearly and 6-month insights read the monthly or weekly rollup items (about 12 or 26) and expand
+# the days within the range from them; the other insights read the daily items.
+# The items are returned as an iterator in date order.
+def query_dynamodb(user_id, metric_code_context, start_date, end_date, insight_type=None, version=None):
+    granularity = ROLLUP_GRANULARITY.get(insight_type)
+    if granularity:
+        return query_rollups(user_id, metric_code_context, start_date, end_date, granularity, version)
+    return query_daily(user_id, metric_code_context, start_date, end_date, version)
+
+# Function to read the days of a cohort from all of its shards concurrently, summed per day.
+def query_cohort(cohort, metric_code_context, start_date, end_date, insight_type=None, version=None):
+    def query_shard(shard_key):
+        return list(query_dynamodb(shard_key, metric_code_context, start_date, end_date, insight_type, version))
+
+    futures = [shard_executor.submit(query_shard, shard_key) for shard_key in shard_keys(cohort)]
+    return merge_shard_days([future.result() for future in futures])
 
-        if period_key not in data_by_period:
-            data_by_period[period_key] = []
+# Function to build the insights of a metric context over a date range.
+# The daily values are bucketed into one bar per day (W, M), week (6M) or month (Y) by the insight engine.
+# The days of a cohort are those of its average member.
+def build_insights(insight_type, user_id, metric_code_context, start_date, end_date, version=None):
+    metric = metric_code_context.split(DELIMETER)[0]
 
-        data_by_period[period_key].append(Decimal(item[QUANTITY]))
-    
-    return data_by_period
+    # Query data from DynamoDB using the provided start_date and end_date
+    if is_cohort_key(user_id):
+        items = query_cohort(user_id, metric_code_context, start_date, end_date, insight_type, version)
+        items = (member_average(item, metric) for item in items)
+    else:
+        items = query_dynamodb(user_id, metric_code_context, start_date, end_date, insight_type, version)
+    first_item = next(items, None)
+    unit = first_item[UNIT] if first_item else NA
+
+    # Calculate aggregates based on the insight_type, while the remaining items are still being fetched
+    # (the Aggregate stage includes waiting for them)
+    if first_item:
+        items = itertools.chain([first_item], items)
+    with stage(AGGREGATE_STAGE):
+        periods = period_values(items, metric, PERIOD_GRANULARITY.get(insight_type, DAILY))
+
+    bars = []
+    bar_values = []
+    for period_key, average in periods:
+        start_date_str = period_key.strftime(DATEFORMAT)
+
+        label = period_key.strftime('%d %b')
+
+        if insight_type in [YEARLY, SIXMONTHLY]:  # For Y and 6M, we need startDate and endDate
+            if insight_type == YEARLY:
+                last_day_of_month = monthrange(period_key.year, period_key.month)[1]
+                end_date = period_key.replace(day=last_day_of_month).strftime(DATEFORMAT)
+            elif insight_type == SIXMONTHLY:
+                last_date_of_week = period_key + timedelta(days=6 - period_key.weekday())
+                end_date = last_date_of_week.strftime(DATEFORMAT)
+
+            bars.append({
+                LABEL: label,  
+                START_DATE: start_date_str,
+                END_DATE: end_date,
+                VALUE: str(average)
+            })
+            bar_values.append(average)
+
+        elif insight_type in [WEEKLY, MONTHLY]:  # For W and M, only include `date`
+            bars.append({
+                LABEL: label,
+                DATE: start_date_str,  
+                VALUE: str(average)
+            })
+            bar_values.append(average)
+
+    # Compute the average, minimum, maximum and the `change` between the first and last bars
+    # from the bar values directly, without parsing the formatted values back
+    average, min_value, max_value, change = summary_stats(bar_values)
+
+    return {
+        INSIGHT_TYPE: insight_type,
+        USERID: user_id,
+        HD_CTX: metric_code_context,
+        UNIT: unit,  
+        AVG: str(average),
+        MIN: str(min_value),
+        MAX: str(max_value),
+        CHANGE: str(change),  
+        DATA: bars
+    }
+
+# Function to return the insights of a metric context over a date range, from the cache when possible.
+# Cached insights are keyed by the data version of the metric context, which
+# hdi-dailyaggregate bumps whenever a past day changes
+def cached_insights(insight_type, user_id, metric_code_context, start_date, end_date):
+    version = fetch_version(user_id, metric_code_context)
+    cache = period_cache(end_date)
+    cache_key = (user_id, metric_code_context, insight_type, start_date, end_date, version)
+    insights = cache.get(cache_key)
+    count(REQUESTS_METRIC)
+    if insights is None:
+        count(CACHE_MISSES_METRIC)
+        insights = build_insights(insight_type, user_id, metric_code_context, start_date, end_date, version)
+        cache.put(cache_key, insights)
+    else:
+        count(CACHE_HITS_METRIC)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Insights of {metric_code_context} for {user_id}: {insights}")
+    return insights
+
+# Function to return the population insights of a cohort, read from its rollups like the insights
+# of a user (see cohorts.py). The result names the cohort instead of a user.
+def cohort_insights(insight_type, cohort_id, metric_code_context, start_date, end_date):
+    insights = cached_insights(insight_type, cohort_key(cohort_id), metric_code_context, start_date, end_date)
+    return {COHORT: cohort_id, **{name: value for name, value in insights.items() if name != USERID}}
+
+# Function to return the insights of one entry of a batch request, for a user or a cohort.
+def entry_insights(entry, insight_type, start_date, end_date):
+    if COHORT in entry:
+        return cohort_insights(insight_type, entry[COHORT], entry[HD_CTX], start_date, end_date)
+    return cached_insights(insight_type, entry[USERID], entry[HD_CTX], start_date, end_date)
+
+# Function to build the insights of every (userid, hd-context) entry of a batch request concurrently.
+# Each entry gets its own result or error, in the order of the request.
+def batch_insights(request):
+    insight_type = request[INSIGHT_TYPE]
+    start_date = request[FROMDATE]
+    end_date = request[TODATE]
+    entries = request[REQUESTS]
+    if len(entries) > MAX_BATCH_ENTRIES:
+        raise ValueError(f"A batch request accepts at most {MAX_BATCH_ENTRIES} entries, got {len(entries)}")
+
+    futures = [batch_executor.submit(entry_insights, entry, insight_type, start_date, end_date) for entry in entries]
+    results = []
+    for entry, future in zip(entries, futures):
+        try:
+            results.append(dict(future.result()))
+        except Exception as error:
+            errorMsg = process_error()
+            logger.error(f"{errorMsg} - Error building insights for {entry.get(USERID)} and {entry.get(HD_CTX)}")
+            subject = {COHORT: entry[COHORT]} if COHORT in entry else {USERID: entry.get(USERID)}
+            results.append({**subject, HD_CTX: entry.get(HD_CTX), ERROR_TYPE: type(error).__name__, ERROR_MESSAGE: str(error)})
+    return {INSIGHT_TYPE: insight_type, FROMDATE: start_date, TODATE: end_date, RESULTS: results}
 
 # Lambda handler
+# Accepts a single request ({"insight-type", "userid", "hd-context", "fromDate", "toDate"}) or a
+# batch request that replaces "userid" and "hd-context" with a "requests" list of
+# {"userid", "hd-context"} entries sharing the insight type and date range. A "cohort" in place
+# of the "userid" of a request or entry asks for the population insights of that cohort.
+@instrumented("hdi-deepinsights")
 def lambda_handler(event, context):
     try:
         if REQUEST_BODY in event:
@@ -78,110 +357,45 @@ def lambda_handler(event, context):
             try:
                 if (body[INSIGHT_TYPE]) and (body[INSIGHT_TYPE] is not None):
                     insight_type = body[INSIGHT_TYPE]
-                    user_id = body[USERID]
-                    metric_code_context = body[HD_CTX]
+                    if REQUESTS not in body:
+                        cohort_id = body.get(COHORT)
+                        user_id = body[USERID] if cohort_id is None else None
+                        metric_code_context = body[HD_CTX]
                     start_date = body[FROMDATE]
                     end_date = body[TODATE]
             except:
                 errorMsg = process_error()
                 logger.error(errorMsg)
+            request = body
         # Extract request data
         else:
             insight_type = event.get(INSIGHT_TYPE)
+            cohort_id = event.get(COHORT)
             user_id = event.get(USERID)
             metric_code_context = event.get(HD_CTX)
             start_date = event.get(FROMDATE)
             end_date = event.get(TODATE)
-        
-        response_bars = {}
-        data_by_period = {}
-
-        # Query data from DynamoDB using the provided start_date and end_date
-        items = query_dynamodb(user_id, metric_code_context, start_date, end_date)
-        unit = items[0][UNIT] if items else NA
-        
-        # Calculate aggregates based on the insight_type
-        data_by_period = calculate_aggregates(items, insight_type, metric_code_context)
-
-        bars = []
-        for period_key, vals in data_by_period.items():
-            average = sum(vals) / len(vals)
-            start_date_str = period_key.strftime(DATEFORMAT)
-
-            label = period_key.strftime('%d %b')
-
-            if insight_type in [YEARLY, SIXMONTHLY]:  # For Y and 6M, we need startDate and endDate
-                if insight_type == YEARLY:
-                    last_day_of_month = monthrange(period_key.year, period_key.month)[1]
-                    end_date = period_key.replace(day=last_day_of_month).strftime(DATEFORMAT)
-                elif insight_type == SIXMONTHLY:
-                    last_date_of_week = period_key + timedelta(days=6 - period_key.weekday())
-                    end_date = last_date_of_week.strftime(DATEFORMAT)
-
-                bars.append({
-                    LABEL: label,  
-                    START_DATE: start_date_str,
-                    END_DATE: end_date,
-                    VALUE: str(average)
-                })
-
-            elif insight_type in [WEEKLY, MONTHLY]:  # For W and M, only include `date`
-                bars.append({
-                    LABEL: label,
-                    DATE: start_date_str,  
-                    VALUE: str(average)
-                })
-
-        # Calculate the `change` as the difference between the first and last values in the data
-        if bars:
-            first_value = Decimal(bars[0][VALUE])
-            last_value = Decimal(bars[-1][VALUE])
-            change = last_value - first_value
-        else:
-            change = Decimal(0)
-
-        response_bars = {DATA: bars}
+            request = event
 
-        # Compute the minimum and maximum values from the response_bars
-        values_list = [Decimal(bar[VALUE]) for bar in response_bars[DATA]]
-        min_value = min(values_list) if values_list else Decimal(0)
-        max_value = max(values_list) if values_list else Decimal(0)
+        if REQUESTS in request:
+            insights = batch_insights(request)
+        elif cohort_id is not None:
+            insights = cohort_insights(insight_type, cohort_id, metric_code_context, start_date, end_date)
+        else:
+            insights = cached_insights(insight_type, user_id, metric_code_context, start_date, end_date)
+        logger.info(f"Insight cache: closed periods {closed_cache.stats()}, open periods {open_cache.stats()}")
 
-        # Compute the average
-        average = sum(values_list) / len(values_list) if values_list else Decimal(0)
-        
         # This will enable testing from API Gateway / Other Clients like Postman
         # as well as from within Lambda console.
         if REQUEST_BODY in event:
-            data =  {
-                INSIGHT_TYPE: insight_type,
-                USERID: user_id,
-                HD_CTX: metric_code_context,
-                UNIT: unit,  
-                AVG: str(average),
-                MIN: str(min_value),
-                MAX: str(max_value),
-                CHANGE: str(change),  
-                **response_bars
-            }
-            responsebody = json.dumps(data)
+            responsebody = json.dumps(insights)
             return {
                 STATUS_CODE: 200,
                 MESSAGE_BODY: responsebody,
             }
             
         else:
-            return {
-                INSIGHT_TYPE: insight_type,
-                USERID: user_id,
-                HD_CTX: metric_code_context,
-                UNIT: unit,  
-                AVG: str(average),
-                MIN: str(min_value),
-                MAX: str(max_value),
-                CHANGE: str(change),  
-                **response_bars
-            }
+            return dict(insights)
     except:
         errorMsg = process_error()
         logger.error(errorMsg)
@@ -1,29 +1,61 @@
+import csv
 import json
 import sys
 import traceback
-import boto3
-import pandas as pd
-import concurrent.futures
-import io
+import os
 import time
+import concurrent.futures
 import logging
+from collections import deque
+from urllib.parse import unquote_plus
 from constants import *
-
-# Initialize the DynamoDB client
-dynamodb = boto3.resource(DYNAMODB)
-table = dynamodb.Table(HEALTH_RAW_DATA_TABLE)
+from batch_writer import chunk_items, merge_write_counts, new_write_counts, write_batch
+from stream_reader import iter_lines
+from input_readers import is_splittable, read_object_rows, to_key_row
+from reading_blocks import chunk_blocks, is_packable, write_blocks
+from sharding import shard_item
+from rate_limiter import AdaptiveRateLimiter
+from range_import import (create_checkpoints, load_checkpoint, read_header, read_range_rows,
+                          save_checkpoint, split_ranges)
+from runtime import client, configure, limited_dynamodb, limited_table, table
+from metrics import count, instrumented, timed
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.environ.get(LOG_LEVEL_ENV, "INFO"))
 
 # Number of threads to use for parallel processing
 THREADS = 10
 
-# Constants for controlling the write rate
-WRITE_LIMIT_PER_SECOND = 100
+# Number of objects of one event read concurrently; their batches share the THREADS writer threads
+FILE_THREADS = 4
+
+# Maximum number of batches queued for the writer threads, which bounds memory use
+MAX_PENDING_BATCHES = THREADS * 2
+
+# The DynamoDB and S3 clients are created on first use and shared by all threads of the
+# container (see runtime.py); every writer and reader thread can hold a connection
+configure(THREADS + FILE_THREADS)
+
+# Objects of at least FANOUT_MIN_BYTES are split into IMPORT_WORKERS line-aligned byte ranges,
+# each imported by its own worker: an asynchronous invocation of this function ("lambda")
+# or a process of a local process pool ("local")
+IMPORT_WORKERS = int(os.environ.get(IMPORT_WORKERS_ENV, 8))
+FANOUT_MIN_BYTES = int(os.environ.get(FANOUT_MIN_BYTES_ENV, 64 * 1024 * 1024))
+IMPORT_WORKER_MODE = os.environ.get(IMPORT_WORKER_MODE_ENV, WORKER_MODE_LAMBDA)
 
-# Delay between writes to maintain the rate limit
-SECONDS_DELAY = 1 / WRITE_LIMIT_PER_SECOND  
+# A range worker saves its committed offset at this interval, and hands the rest of its range
+# to a new invocation when less than RESUME_MARGIN_MILLIS of its time budget is left
+CHECKPOINT_INTERVAL_SECONDS = 10
+RESUME_MARGIN_MILLIS = 30000
+
+# "item" stores every reading as its own item; "block" packs the readings of a user, metric
+# context and hour into one item (see reading_blocks.py). Either is written to the shard of
+# its key when RAW_SHARD_COUNT is above 1 (see sharding.py).
+RAW_STORAGE_MODE = os.environ.get(RAW_STORAGE_MODE_ENV, ITEM_STORAGE_MODE)
+
+# Write rate limiter shared by all writer threads. It adapts to DynamoDB throttling
+# and keeps the learned rate across invocations of a warm container.
+write_limiter = AdaptiveRateLimiter.from_environment()
 
 
 # Function to process errors that occur during the execution of the lambda function.
@@ -39,47 +71,247 @@ def process_error() -> dict:
     )
     return errorMsg
 
-# Function to insert a single item into DynamoDB
-def insert_item_to_dynamodb(item):
-    try:
+# Function to write one batch of items into DynamoDB using BatchWriteItem
+def insert_batch_to_dynamodb(items, duplicates):
+    return write_batch(limited_dynamodb(), HEALTH_RAW_DATA_TABLE, items, duplicates, write_limiter)
+
+# Function to merge a group of blocks into the blocks stored in DynamoDB
+def insert_blocks_to_dynamodb(blocks, duplicates):
+    return write_blocks(limited_table(HEALTH_RAW_DATA_TABLE), blocks, duplicates, write_limiter)
+
+# Function to convert parsed rows into items, counting rows without a key as failed.
+def rows_to_items(rows, counts):
+    for row in rows:
         # All values are of type string
-        item = {k: str(v) for k, v in item.items()}
-        table.put_item(Item=item)
-        print(f"Successfully inserted: {item}")
-        # Throttle to maintain 100 writes per second
-        time.sleep(SECONDS_DELAY)  
-    except:
-        errorMsg = process_error()
-        logger.error(errorMsg)
+        item = {k: str(v) for k, v in row.items() if k and v is not None}
+        if not (item.get(USERID) and item.get(HD_CTX_TIME)):
+            counts[ROWS] += 1
+            counts[FAILED] += 1
+            logger.error(f"Skipping row without {USERID} or {HD_CTX_TIME}: {row}")
+        elif RAW_STORAGE_MODE == BLOCK_STORAGE_MODE and not is_packable(item):
+            counts[ROWS] += 1
+            counts[FAILED] += 1
+            logger.error(f"Skipping row without a numeric {QUANTITY} or a YYYY-MM-DD HH:MM:SS timestamp: {row}")
+        else:
+            yield item
+
+# Function to feed fixed-size batches of items, or groups of blocks, to the writer threads while keeping
+# only a bounded number in flight. Batches are retired in submission order; when a position is given,
+# on_commit receives the offset up to which all rows are written once the batch is retired.
+# Returns False when should_stop asked to stop before all items were submitted.
+def insert_items_to_dynamodb(items, executor, counts, position=None, on_commit=None, should_stop=None):
+    pending = deque()
+    completed = True
+    if RAW_STORAGE_MODE == BLOCK_STORAGE_MODE:
+        batches, insert = chunk_blocks(items, position), insert_blocks_to_dynamodb
+    else:
+        batches = ((batch, duplicates, position[0] if position else None)
+                   for batch, duplicates in chunk_items(map(shard_item, items)))
+        insert = insert_batch_to_dynamodb
+    # Reading the object and parsing its rows happen while the next batch is produced
+    for batch, duplicates, offset in timed(batches, PARSE_STAGE):
+        pending.append((executor.submit(insert, batch, duplicates), offset))
+        while len(pending) > MAX_PENDING_BATCHES or (pending and pending[0][0].done()):
+            retire_batch(pending, counts, on_commit)
+        if should_stop and should_stop():
+            completed = False
+            break
+    while pending:
+        retire_batch(pending, counts, on_commit)
+    return completed
+
+# Function to wait for the oldest batch in flight and record its counts.
+def retire_batch(pending, counts, on_commit):
+    future, offset = pending.popleft()
+    merge_write_counts(counts, future.result())
+    if on_commit:
+        on_commit(offset)
+
+# Function to stream an object from S3 and insert into DynamoDB using the shared writer threads
+def process_object_from_s3(bucket_name, key, executor, counts):
+    # Stream the object from S3, decompressing it if needed, and parse it row by row
+    rows = read_object_rows(client(S3), bucket_name, key)
+    insert_items_to_dynamodb(rows_to_items(rows, counts), executor, counts)
+    logger.info(f"Processed s3://{bucket_name}/{key}: {counts}, write rate: {write_limiter.stats()}")
+    return counts
+
+# Function to import one line-aligned byte range of a CSV object, resuming from its checkpoint.
+# When the invocation is about to time out, the committed offset is saved and the remainder
+# of the range is handed to a new asynchronous invocation.
+def process_range_from_s3(import_range, context=None):
+    bucket_name = import_range[S3BUCKET]
+    key = import_range[S3KEY]
+    import_id = import_range[IMPORT_ID]
+    start = import_range[RANGE_START]
+    end = import_range[RANGE_END]
+    header = import_range[HEADER]
 
-# Function to read CSV from S3 and insert into DynamoDB in parallel
-def process_csv_from_s3(bucket_name, key):
+    counts = new_write_counts()
+    saved_counts = new_write_counts()
+    committed, status = load_checkpoint(table(IMPORT_CHECKPOINT_TABLE), import_id, start, end)
+    if status == COMPLETE:
+        logger.info(f"Range {start}-{end} of s3://{bucket_name}/{key} is already imported")
+        return counts
+    saved_at = time.monotonic()
+
+    # Function to save the committed offset together with the counts written since the last save
+    def save(status):
+        nonlocal saved_at
+        delta = {name: counts[name] - saved_counts[name] for name in counts}
+        save_checkpoint(table(IMPORT_CHECKPOINT_TABLE), import_id, start, end, committed, status, delta)
+        saved_counts.update(counts)
+        saved_at = time.monotonic()
+
+    def on_commit(offset):
+        nonlocal committed
+        committed = offset
+        if time.monotonic() - saved_at >= CHECKPOINT_INTERVAL_SECONDS:
+            save(IN_PROGRESS)
+
+    def should_stop():
+        return context is not None and context.get_remaining_time_in_millis() < RESUME_MARGIN_MILLIS
+
+    position = [committed]
+    # The data start and any committed offset are line boundaries; a fresh range start usually is not
+    aligned = committed > start or start == import_range[DATA_START]
+    rows = read_range_rows(client(S3), bucket_name, key, header, committed, end, position, aligned)
     try:
-        # Download the CSV from S3
-        s3 = boto3.client(S3)
-        response = s3.get_object(Bucket=bucket_name, Key=key)
-        csv_content = response[BODY].read().decode(UTF8)
-        
-        # Read CSV into pandas DataFrame
-        df = pd.read_csv(io.StringIO(csv_content))
-        
-        # Convert each row to a dictionary and insert it in parallel
         with concurrent.futures.ThreadPoolExecutor(max_workers=THREADS) as executor:
-            futures = [executor.submit(insert_item_to_dynamodb, row.to_dict()) for _, row in df.iterrows()]
-            # Wait for all futures to complete
-            concurrent.futures.wait(futures)
+            completed = insert_items_to_dynamodb(rows_to_items(map(to_key_row, rows), counts), executor, counts,
+                                                 position, on_commit, should_stop)
+    except:
+        # Keep the progress made so far; the asynchronous retry of this invocation resumes from it
+        save(IN_PROGRESS)
+        raise
+    finally:
+        rows.close()
+
+    if completed:
+        save(COMPLETE)
+    else:
+        save(IN_PROGRESS)
+        invoke_range_worker(import_range)
+        logger.info(f"Range {start}-{end} of s3://{bucket_name}/{key} continues from offset {committed}")
+
+    logger.info(f"Processed range {start}-{end} of s3://{bucket_name}/{key}: {counts}, write rate: {write_limiter.stats()}")
+    return counts
+
+# Function to hand a byte range to a new asynchronous invocation of this function.
+def invoke_range_worker(import_range):
+    client(LAMBDA).invoke(
+        FunctionName=os.environ[AWS_LAMBDA_FUNCTION_NAME],
+        InvocationType=INVOCATION_TYPE_EVENT,
+        Payload=json.dumps({IMPORT_RANGE: import_range})
+    )
+
+# Function to split a large CSV object into line-aligned byte ranges and hand each one to a worker.
+# With the "lambda" worker mode the ranges are imported asynchronously and only dispatched here;
+# with the "local" mode they are imported by a process pool and their counts are returned.
+def fan_out_csv_from_s3(bucket_name, key, size, etag):
+    counts = new_write_counts()
+    header, data_start = read_header(client(S3), bucket_name, key)
+    ranges = split_ranges(data_start, size, IMPORT_WORKERS)
+
+    # The ETag identifies the object version, so a re-uploaded file is imported again
+    etag = etag.strip('"')
+    import_id = f"{bucket_name}/{key}#{etag}"
+    create_checkpoints(table(IMPORT_CHECKPOINT_TABLE), import_id, ranges)
+
+    import_ranges = [{
+        S3BUCKET: bucket_name, S3KEY: key, IMPORT_ID: import_id, HEADER: header,
+        DATA_START: data_start, RANGE_START: start, RANGE_END: end
+    } for start, end in ranges]
+
+    if IMPORT_WORKER_MODE == WORKER_MODE_LOCAL:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(import_ranges)) as executor:
+            for range_counts in executor.map(process_range_from_s3, import_ranges):
+                merge_write_counts(counts, range_counts)
+    else:
+        for import_range in import_ranges:
+            invoke_range_worker(import_range)
+
+    logger.info(f"Split s3://{bucket_name}/{key} ({size} bytes) into {len(ranges)} ranges for {IMPORT_WORKER_MODE} workers")
+    return {**counts, RANGES: len(ranges)}
+
+# Function to import an object, fanning large uncompressed CSV objects out to range workers.
+def import_object_from_s3(bucket_name, key, executor, counts):
+    if IMPORT_WORKERS > 1:
+        head = client(S3).head_object(Bucket=bucket_name, Key=key)
+        if head[CONTENT_LENGTH] >= FANOUT_MIN_BYTES and is_splittable(client(S3), bucket_name, key):
+            return fan_out_csv_from_s3(bucket_name, key, head[CONTENT_LENGTH], head[ETAG])
+    return process_object_from_s3(bucket_name, key, executor, counts)
+
+# Function to import one object and summarise the outcome, so one failing object does not stop the others.
+def import_object(bucket_name, key, executor):
+    counts = new_write_counts()
+    try:
+        counts = import_object_from_s3(bucket_name, key, executor, counts)
+        return {S3BUCKET: bucket_name, S3KEY: key, **counts}
     except:
         errorMsg = process_error()
-        logger.error(errorMsg)
+        logger.error(f"{errorMsg} - Error importing s3://{bucket_name}/{key}")
+        return {S3BUCKET: bucket_name, S3KEY: key, **counts, ERROR_MESSAGE: str(sys.exc_info()[1])}
+
+# Function to list the objects named by a manifest, one "key" or "bucket,key" entry per line.
+def list_manifest_objects(manifest):
+    response = client(S3).get_object(Bucket=manifest[S3BUCKET], Key=manifest[S3KEY])
+    for entry in csv.reader(iter_lines(response[BODY])):
+        if len(entry) >= 2:
+            yield entry[0], entry[1]
+        elif entry and entry[0]:
+            yield manifest[S3BUCKET], entry[0]
+
+# Function to list the objects stored under a prefix.
+def list_prefix_objects(listing):
+    paginator = client(S3).get_paginator(LIST_OBJECTS_V2)
+    for page in paginator.paginate(Bucket=listing[S3BUCKET], Prefix=listing.get(PREFIX, "")):
+        for content in page.get(CONTENTS, []):
+            if not content[KEYNAME].endswith("/"):
+                yield listing[S3BUCKET], content[KEYNAME]
+
+# Function to collect the (bucket, key) pairs of every S3 record in the event, plus the objects
+# of an optional manifest or prefix listing.
+def collect_objects(event):
+    objects = []
+    for record in event.get(RECORDS, []):
+        # Object keys in S3 event notifications are URL encoded
+        objects.append((record[S3][S3BUCKET][NAME], unquote_plus(record[S3][OBJECT][S3KEY])))
+    if MANIFEST in event:
+        objects.extend(list_manifest_objects(event[MANIFEST]))
+    if PREFIX in event:
+        objects.extend(list_prefix_objects(event[PREFIX]))
+    return list(dict.fromkeys(objects))
+
+# Function to add the write counts of the invocation to its metrics.
+def count_writes(counts):
+    for name, metric_name in [(ROWS, ROWS_METRIC), (WRITTEN, WRITTEN_METRIC), (DUPLICATES, DUPLICATES_METRIC),
+                              (FAILED, FAILURES_METRIC)]:
+        count(metric_name, counts[name])
 
 # Lambda handler
+@instrumented("hdi-importdata")
 def lambda_handler(event, context):
-    # Extract S3 bucket and key from the event
-    bucket_name = event[RECORDS][0][S3][S3BUCKET][NAME]
-    key = event[RECORDS][0][S3][OBJECT][S3KEY]
-    
-    # Process the CSV from S3
-    process_csv_from_s3(bucket_name, key)
-    
-    return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps(FILE_PROCESSING_SUCCESSFULL)}
+    # Byte range handed to this invocation by a coordinator
+    if IMPORT_RANGE in event:
+        counts = process_range_from_s3(event[IMPORT_RANGE], context)
+        count_writes(counts)
+        return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps({MESSAGE: FILE_PROCESSING_SUCCESSFULL, **counts, RATE_LIMITER: write_limiter.stats()})}
+
+    # Extract the S3 objects from the event
+    objects = collect_objects(event)
+
+    # Read the objects concurrently; all of them feed the same pool of writer threads
+    with concurrent.futures.ThreadPoolExecutor(max_workers=THREADS) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=FILE_THREADS) as file_executor:
+            summaries = list(file_executor.map(lambda obj: import_object(*obj, executor), objects))
+
+    totals = new_write_counts()
+    for summary in summaries:
+        merge_write_counts(totals, {name: summary[name] for name in totals})
+    failed_objects = sum(1 for summary in summaries if ERROR_MESSAGE in summary)
+    count_writes(totals)
     
+    return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps({
+        MESSAGE: FILE_PROCESSING_SUCCESSFULL, **totals, FAILED_OBJECTS: failed_objects,
+        OBJECTS: summaries, RATE_LIMITER: write_limiter.stats()
+    })}
@@ -0,0 +1,129 @@
+import argparse
+import json
+import sys
+import traceback
+import concurrent.futures
+import logging
+from constants import *
+from batch_writer import error_code
+from rate_limiter import AdaptiveRateLimiter
+from reading_blocks import ReadingBlock, is_block, write_block
+from runtime import configure, limited_table, table
+import sharding
+from sharding import shard_key, user_of
+
+# Migration of hdi-health-data items to the partitions of the current write sharding (see
+# sharding.py): items written before sharding was enabled, or with another RAW_SHARD_COUNT or
+# RAW_SHARD_SCHEME, are copied to the partition of their shard and then deleted.
+# Run it after hdi-import-data is deployed with the new settings. The copies carry the
+# shard_migrated flag, so hdi-daily-aggregate does not count their readings again, and the stream
+# records of the deletes are ignored. Readers query the unsharded partition and every shard, so
+# the data stays readable while the migration runs; items written with another shard count are
+# only read again once moved. Pause imports of data already imported while it runs: a reading
+# imported again is counted once more.
+#
+#   RAW_SHARD_COUNT=8 python src/hdi-migrate-shards.py --segments 8
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Default number of Scan segments, each read and migrated by its own thread
+DEFAULT_SEGMENTS = 8
+
+write_limiter = AdaptiveRateLimiter.from_environment()
+
+# Function to process errors that occur during the execution of the lambda function.
+def process_error() -> dict:
+    exType, exValue, exTraceback = sys.exc_info()
+    tracebackString = traceback.format_exception(exType, exValue, exTraceback)
+    errorMsg = json.dumps(
+        {
+            ERROR_TYPE: exType.__name__,
+            ERROR_MESSAGE: str(exValue),
+            STACK_TRACE: tracebackString,
+        }
+    )
+    return errorMsg
+
+# Function to copy an item to the partition of its shard. A block is merged into the block
+# stored there; a single reading is only copied when the shard holds no newer one.
+def copy_item(item, partition_key):
+    copy = {**item, USERID: partition_key, SHARD_MIGRATED: True}
+    if is_block(item):
+        write_block(limited_table(HEALTH_RAW_DATA_TABLE), ReadingBlock.from_item(copy), write_limiter)
+        return
+    write_limiter.acquire(1)
+    try:
+        table(HEALTH_RAW_DATA_TABLE).put_item(
+            Item=copy,
+            ConditionExpression="attribute_not_exists(#userid)",
+            ExpressionAttributeNames={'#userid': USERID}
+        )
+    except Exception as error:
+        if error_code(error) != CONDITIONAL_CHECK_FAILED:
+            raise
+
+# Function to move one item to the partition of its shard. The delete is conditional on the
+# scanned readings, so an item changed in the meantime is kept and moved by the next run.
+def migrate_item(item, partition_key):
+    attribute = READINGS if is_block(item) else QUANTITY
+    try:
+        copy_item(item, partition_key)
+        write_limiter.acquire(1)
+        table(HEALTH_RAW_DATA_TABLE).delete_item(
+            Key={USERID: item[USERID], HD_CTX_TIME: item[HD_CTX_TIME]},
+            ConditionExpression="#value = :value",
+            ExpressionAttributeValues={':value': item[attribute]},
+            ExpressionAttributeNames={'#value': attribute}
+        )
+        return MIGRATED
+    except Exception as error:
+        if error_code(error) == CONDITIONAL_CHECK_FAILED:
+            return SKIPPED
+        errorMsg = process_error()
+        logger.error(f"{errorMsg} - Error migrating {item[USERID]} and {item[HD_CTX_TIME]}")
+        return FAILED
+
+# Function to scan one segment of the raw table and move the items that are not in the partition of their shard.
+def migrate_segment(segment, segments):
+    counts = {MIGRATED: 0, SKIPPED: 0, FAILED: 0}
+    scan_args = {'Segment': segment, 'TotalSegments': segments}
+    while True:
+        response = table(HEALTH_RAW_DATA_TABLE).scan(**scan_args)
+        for item in response.get(ITEMS, []):
+            partition_key = shard_key(user_of(item[USERID]), item[HD_CTX_TIME])
+            if partition_key != item[USERID]:
+                counts[migrate_item(item, partition_key)] += 1
+        if LAST_EVALUATED_KEY not in response:
+            return counts
+        scan_args[EXCLUSIVE_START_KEY] = response[LAST_EVALUATED_KEY]
+
+# Function to migrate the raw table with parallel Scan segments.
+def migrate_table(segments=DEFAULT_SEGMENTS):
+    configure(segments)
+    counts = {MIGRATED: 0, SKIPPED: 0, FAILED: 0}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+        for future in [executor.submit(migrate_segment, segment, segments) for segment in range(segments)]:
+            for outcome, value in future.result().items():
+                counts[outcome] += value
+    return counts
+
+# Lambda handler
+def lambda_handler(event, context):
+    try:
+        counts = migrate_table(int(event.get(SEGMENTS, DEFAULT_SEGMENTS)))
+        logger.info(f"Migrated {HEALTH_RAW_DATA_TABLE} to {sharding.RAW_SHARD_COUNT} {sharding.RAW_SHARD_SCHEME} shards: {counts}")
+        return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps(counts)}
+    except:
+        errorMsg = process_error()
+        logger.error(errorMsg)
+
+    return {STATUS_CODE: 500, MESSAGE_BODY: json.dumps(PROCESSING_FAILED)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Move {HEALTH_RAW_DATA_TABLE} items to the partitions of their shard")
+    parser.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS, help="number of parallel Scan segments")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    print(lambda_handler({SEGMENTS: args.segments}, None))
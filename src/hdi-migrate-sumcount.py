@@ -0,0 +1,99 @@
+import json
+import sys
+import traceback
+import concurrent.futures
+import logging
+from constants import *
+from aggregates import item_sum_count, rollup_sort_keys, set_rollup_days
+from batch_writer import error_code
+from runtime import configure, table
+
+# One-shot migration of hdi-aggregated-daily items written by the "average" aggregation mode
+# to the "sum_count" mode: `quantity` and `hd_referred_count` are folded into the running
+# `sum` and `count` attributes. Run it after hdi-daily-aggregate is switched to AGGREGATION_MODE=sum_count;
+# items already updated by the new mode keep their increments because the legacy totals are ADDed.
+# The day of every migrated item is set in its monthly and weekly rollups, unless the stream
+# already set it with more readings.
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# Number of threads to use for parallel updates
+THREADS = 10
+configure(THREADS)
+
+# Function to process errors that occur during the execution of the lambda function.
+def process_error() -> dict:
+    exType, exValue, exTraceback = sys.exc_info()
+    tracebackString = traceback.format_exception(exType, exValue, exTraceback)
+    errorMsg = json.dumps(
+        {
+            ERROR_TYPE: exType.__name__,
+            ERROR_MESSAGE: str(exValue),
+            STACK_TRACE: tracebackString,
+        }
+    )
+    return errorMsg
+
+# Function to move the legacy daily value of one item into its running sum and count.
+# The condition on the scanned quantity makes the update a no-op if the item was changed
+# or migrated in the meantime.
+def migrate_item(item):
+    metric, data_context, date = item[HD_CTX_DATE].split(DELIMETER)
+    legacy_item = {name: item[name] for name in (QUANTITY, HD_REFF_COUNT) if name in item}
+    legacy_sum, legacy_count = item_sum_count(legacy_item, metric)
+    try:
+        response = table(DAILY_AGGREGATED_TABLE).update_item(
+            Key={USERID: item[USERID], HD_CTX_DATE: item[HD_CTX_DATE]},
+            UpdateExpression="ADD #sum :sum, #count :count REMOVE #quantity, #refcount",
+            ConditionExpression="#quantity = :quantity",
+            ExpressionAttributeValues={':sum': legacy_sum, ':count': legacy_count, ':quantity': item[QUANTITY]},
+            ExpressionAttributeNames={'#sum': SUM, '#count': COUNT, '#quantity': QUANTITY, '#refcount': HD_REFF_COUNT},
+            ReturnValues="ALL_NEW"
+        )
+        migrated = response[ATTRIBUTES]
+        day = {SUM: migrated[SUM], COUNT: migrated[COUNT]}
+        for sort_key in rollup_sort_keys(f"{metric}{DELIMETER}{data_context}", date):
+            set_rollup_days(table(DAILY_AGGREGATED_TABLE), item[USERID], sort_key, migrated.get(UNIT), {date: day}, only_newer=True)
+        return MIGRATED
+    except Exception as error:
+        if error_code(error) == CONDITIONAL_CHECK_FAILED:
+            return SKIPPED
+        errorMsg = process_error()
+        logger.error(f"{errorMsg} - Error migrating {item[USERID]} and {item[HD_CTX_DATE]}")
+        return FAILED
+
+# Function to scan the aggregated table for legacy items and migrate them page by page.
+def migrate_table():
+    counts = {MIGRATED: 0, SKIPPED: 0, FAILED: 0}
+    scan_args = {
+        'FilterExpression': "attribute_exists(#quantity)",
+        'ProjectionExpression': "#userid, #date, #quantity, #refcount",
+        'ExpressionAttributeNames': {'#userid': USERID, '#date': HD_CTX_DATE, '#quantity': QUANTITY, '#refcount': HD_REFF_COUNT},
+    }
+    with concurrent.futures.ThreadPoolExecutor(max_workers=THREADS) as executor:
+        while True:
+            response = table(DAILY_AGGREGATED_TABLE).scan(**scan_args)
+            for outcome in executor.map(migrate_item, response.get(ITEMS, [])):
+                counts[outcome] += 1
+            if LAST_EVALUATED_KEY not in response:
+                break
+            scan_args[EXCLUSIVE_START_KEY] = response[LAST_EVALUATED_KEY]
+    return counts
+
+# Lambda handler
+def lambda_handler(event, context):
+    try:
+        counts = migrate_table()
+        logger.info(f"Migrated {DAILY_AGGREGATED_TABLE} to running sum and count: {counts}")
+        return {STATUS_CODE: 200, MESSAGE_BODY: json.dumps(counts)}
+    except:
+        errorMsg = process_error()
+        logger.error(errorMsg)
+
+    return {STATUS_CODE: 500, MESSAGE_BODY: json.dumps(PROCESSING_FAILED)}
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    print(lambda_handler({}, None))
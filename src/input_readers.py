@@ -0,0 +1,318 @@
+import io
+import json
+import re
+import zlib
+from datetime import datetime
+from constants import *
+from runtime import optional_module
+from stream_reader import CHUNK_SIZE, iter_lines, iter_text, read_csv_rows
+
+# Readers of the object formats the import accepts: CSV, JSON arrays, JSON Lines and Parquet,
+# optionally compressed with gzip or zstd. Every reader yields rows in the key format of the
+# hdi-health-data table; records with health_metric, metric_context and timestamp fields are
+# given their hd-context-time key as they are read.
+
+# Magic bytes at the start of compressed and Parquet objects
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+PARQUET_MAGIC = b"PAR1"
+UTF8_BOM = b"\xef\xbb\xbf"
+
+# zlib window size that expects a gzip header
+GZIP_WBITS = zlib.MAX_WBITS | 16
+
+# Number of compressed bytes read from S3 at a time; text compresses about tenfold, so a
+# decompressed chunk is about the size of an uncompressed one
+COMPRESSED_CHUNK_SIZE = 128 * 1024
+
+# Number of bytes fetched to detect the compression and format of an object
+SNIFF_BYTES = 4096
+
+COMPRESSION_SUFFIXES = {".gz": GZIP, ".gzip": GZIP, ".zst": ZSTD, ".zstd": ZSTD}
+FORMAT_SUFFIXES = {".csv": CSV_FORMAT, ".txt": CSV_FORMAT, ".json": JSON_FORMAT, ".jsonl": JSONL_FORMAT,
+                   ".ndjson": JSONL_FORMAT, ".parquet": PARQUET_FORMAT}
+
+WHITESPACE = re.compile(r"\s*")
+# Characters that can continue a number a chunk ends in, e.g. the "." of "1." or the "e" of "2e"
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+
+
+# Body that returns bytes already read from another body before the rest of it, so the first
+# chunk of an object can be inspected without a second request.
+class PrefixedBody:
+
+    def __init__(self, prefix, body):
+        self.prefix = prefix
+        self.body = body
+
+    def read(self, size=-1):
+        if self.prefix:
+            prefix, self.prefix = self.prefix, b""
+            return prefix
+        return self.body.read(size)
+
+
+# Body that decompresses another body as it is read. Concatenated gzip members and zstd frames
+# are decompressed one after the other.
+class DecompressingBody:
+
+    def __init__(self, body, new_decompressor):
+        self.body = body
+        self.new_decompressor = new_decompressor
+        self.decompressor = new_decompressor()
+
+    def read(self, size=-1):
+        while True:
+            chunk = self.body.read(COMPRESSED_CHUNK_SIZE)
+            if not chunk:
+                if not self.decompressor.eof:
+                    raise ValueError("Compressed object is truncated")
+                return b""
+            data = self.decompress(chunk)
+            if data:
+                return data
+
+    def decompress(self, chunk):
+        output = []
+        while chunk:
+            if self.decompressor.eof:
+                self.decompressor = self.new_decompressor()
+            output.append(self.decompressor.decompress(chunk))
+            chunk = self.decompressor.unused_data
+        return b"".join(output)
+
+
+# File over the byte ranges of an S3 object, for readers that need random access (Parquet keeps
+# its schema and row group offsets in a footer at the end of the object).
+class S3ObjectFile(io.RawIOBase):
+
+    def __init__(self, s3, bucket_name, key, size):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or not len(buffer):
+            return 0
+        end = min(self.position + len(buffer), self.size) - 1
+        response = self.s3.get_object(Bucket=self.bucket_name, Key=self.key, Range=f"bytes={self.position}-{end}")
+        data = response[BODY].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+# Function to return the compression and format named by the suffixes of a key, e.g. data.jsonl.gz.
+def key_suffixes(key):
+    name = key.rsplit("/", 1)[-1].lower()
+    compression = None
+    for suffix, suffix_compression in COMPRESSION_SUFFIXES.items():
+        if name.endswith(suffix):
+            compression = suffix_compression
+            name = name[:-len(suffix)]
+            break
+    data_format = next((fmt for suffix, fmt in FORMAT_SUFFIXES.items() if name.endswith(suffix)), None)
+    return compression, data_format
+
+# Function to detect the compression of an object from its first bytes.
+def detect_compression(head):
+    if head.startswith(GZIP_MAGIC):
+        return GZIP
+    if head.startswith(ZSTD_MAGIC):
+        return ZSTD
+    return None
+
+# Function to detect the format of an uncompressed object from its first bytes.
+def detect_format(head):
+    if head.startswith(PARQUET_MAGIC):
+        return PARQUET_FORMAT
+    text = head[len(UTF8_BOM):] if head.startswith(UTF8_BOM) else head
+    text = text.lstrip()
+    if text.startswith(b"["):
+        return JSON_FORMAT
+    if text.startswith(b"{"):
+        return JSONL_FORMAT
+    return CSV_FORMAT
+
+def zstd_decompressor():
+    # Python 3.14 ships zstd; earlier runtimes need the zstandard package
+    zstd = optional_module(COMPRESSION_ZSTD)
+    if zstd is not None:
+        return zstd.ZstdDecompressor()
+    zstandard = optional_module(ZSTANDARD)
+    if zstandard is None:
+        raise ValueError("zstd compressed objects need the zstandard package")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+# Function to return a body that reads an object decompressed, detecting the compression from its magic bytes.
+def decompressed(body):
+    head = body.read(COMPRESSED_CHUNK_SIZE)
+    body = PrefixedBody(head, body)
+    compression = detect_compression(head)
+    if compression == GZIP:
+        return DecompressingBody(body, lambda: zlib.decompressobj(GZIP_WBITS))
+    if compression == ZSTD:
+        return DecompressingBody(body, zstd_decompressor)
+    return body
+
+# Function to parse the elements of a JSON array one at a time. Only the element being parsed
+# and the current chunk are held in memory.
+def read_json_array(body, chunk_size=CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+    chunks = iter_text(body, chunk_size)
+    buffer = ""
+    position = 0
+    # What may come next: "[" to open the array, a value or "]", "," or "]", or a value only
+    expected = "["
+
+    def read_more():
+        nonlocal buffer, position
+        text = next(chunks, None)
+        if text is None:
+            return False
+        buffer = buffer[position:] + text
+        position = 0
+        return True
+
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            if read_more():
+                continue
+            raise ValueError("JSON array is not closed")
+        char = buffer[position]
+        if expected == "[":
+            if char != "[":
+                raise ValueError("JSON object is not an array")
+            position += 1
+            expected = "value or ]"
+        elif char == "]" and expected != "value":
+            return
+        elif expected == ", or ]":
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {char!r}")
+            position += 1
+            expected = "value"
+        else:
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The element continues in the next chunk
+                if read_more():
+                    continue
+                raise
+            # A number at the end of the buffer may also continue in the next chunk, including one
+            # parsed short of a trailing "1." or "2e" that only the next chunk completes
+            if NUMBER_TAIL.fullmatch(buffer, end) and read_more():
+                continue
+            position = end
+            expected = ", or ]"
+            yield element
+
+# Function to parse JSON Lines, one record per line; blank lines are skipped.
+def read_json_lines(body, chunk_size=CHUNK_SIZE):
+    for number, line in enumerate(iter_lines(body, chunk_size), 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as error:
+                raise ValueError(f"Invalid JSON on line {number}: {error}")
+
+# Function to read a Parquet file one row group at a time. The key columns are built from the
+# columns of the row group before it is turned into rows.
+def read_parquet_rows(source):
+    parquet = optional_module(PYARROW_PARQUET)
+    if parquet is None:
+        raise ValueError("Parquet objects need the pyarrow package")
+    parquet_file = parquet.ParquetFile(source)
+    for row_group in range(parquet_file.num_row_groups):
+        group = parquet_file.read_row_group(row_group)
+        columns = to_key_columns({name: group.column(name).to_pylist() for name in group.column_names})
+        for values in zip(*columns.values()):
+            yield dict(zip(columns, values))
+
+# Function to format a value the way it is stored: timestamps as in the sample data, anything else as given.
+def format_value(value):
+    if isinstance(value, datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    return value
+
+# Function to build the hd-context-time key from a metric, its context and a timestamp.
+def context_time_key(health_metric, metric_context, timestamp):
+    if health_metric is None or timestamp is None:
+        return None
+    return f"{health_metric}{DELIMETER}{metric_context or NA}{DELIMETER}{format_value(timestamp)}"
+
+# Function to map a record into the key format of the raw table. Records that already have an
+# hd-context-time key are left as they are.
+def to_key_row(record):
+    if not isinstance(record, dict):
+        raise ValueError(f"Expected a JSON object for each record, found {type(record).__name__}")
+    if HD_CTX_TIME in record or HEALTH_METRIC not in record:
+        return record
+    row = dict(record)
+    key = context_time_key(row.pop(HEALTH_METRIC), row.pop(METRIC_CONTEXT, None), row.pop(TIMESTAMP, None))
+    if key:
+        row[HD_CTX_TIME] = key
+    return row
+
+# Function to map the columns of a row group into the key format of the raw table.
+def to_key_columns(columns):
+    if HD_CTX_TIME in columns or HEALTH_METRIC not in columns:
+        return columns
+    metrics = columns.pop(HEALTH_METRIC)
+    contexts = columns.pop(METRIC_CONTEXT, None) or [None] * len(metrics)
+    timestamps = columns.pop(TIMESTAMP, None) or [None] * len(metrics)
+    columns[HD_CTX_TIME] = [context_time_key(*values) for values in zip(metrics, contexts, timestamps)]
+    return columns
+
+# Readers of the streamed formats; each takes a decompressed body and yields records
+READERS = {
+    CSV_FORMAT: read_csv_rows,
+    JSON_FORMAT: read_json_array,
+    JSONL_FORMAT: read_json_lines,
+}
+
+# Function to read the rows of an S3 object in any accepted format and compression. The format
+# is taken from the key suffix, or detected from the first bytes of the object.
+def read_object_rows(s3, bucket_name, key):
+    compression, data_format = key_suffixes(key)
+    if data_format == PARQUET_FORMAT and compression is None:
+        # Parquet is read in place: only the footer and the column chunks are fetched
+        size = s3.head_object(Bucket=bucket_name, Key=key)[CONTENT_LENGTH]
+        return read_parquet_rows(io.BufferedReader(S3ObjectFile(s3, bucket_name, key, size), CHUNK_SIZE))
+
+    response = s3.get_object(Bucket=bucket_name, Key=key)
+    body = decompressed(response[BODY])
+    if data_format is None:
+        head = body.read(SNIFF_BYTES)
+        body = PrefixedBody(head, body)
+        data_format = detect_format(head)
+    if data_format == PARQUET_FORMAT:
+        # A compressed Parquet file cannot be read in place and is decompressed into memory
+        return read_parquet_rows(io.BytesIO(b"".join(iter(lambda: body.read(CHUNK_SIZE), b""))))
+    return (to_key_row(record) for record in READERS[data_format](body))
+
+# Function to tell whether an object is uncompressed CSV, which can be split into byte ranges.
+def is_splittable(s3, bucket_name, key):
+    compression, data_format = key_suffixes(key)
+    if compression is not None or data_format not in (CSV_FORMAT, None):
+        return False
+    head = s3.get_object(Bucket=bucket_name, Key=key, Range=f"bytes=0-{SNIFF_BYTES - 1}")[BODY].read()
+    return detect_compression(head) is None and detect_format(head) == CSV_FORMAT
@@ -0,0 +1,65 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from constants import *
+
+# Default cache settings: the number of entries kept per cache, and how long an entry is served
+# for periods that are closed (entirely before today) and for periods that are still open
+DEFAULT_CACHE_ENTRIES = 512
+DEFAULT_CLOSED_TTL_SECONDS = 3600
+DEFAULT_OPEN_TTL_SECONDS = 60
+
+
+# Bounded LRU cache whose entries expire after a fixed time to live. It lives at module level,
+# so it is shared by the threads of an invocation and kept across warm invocations.
+class InsightCache:
+
+    def __init__(self, max_entries=DEFAULT_CACHE_ENTRIES, ttl_seconds=DEFAULT_CLOSED_TTL_SECONDS):
+        self.max_entries = int(max_entries)
+        self.ttl_seconds = float(ttl_seconds)
+        self.hit_count = 0
+        self.miss_count = 0
+        self.eviction_count = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Function to return the cached value of a key, or None if it is missing or expired.
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.miss_count += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hit_count += 1
+            return entry[1]
+
+    # Function to store a value, evicting the least recently used entries beyond the size bound.
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.eviction_count += 1
+
+    # Function to report the size and the hit, miss and eviction counts.
+    def stats(self):
+        with self._lock:
+            return {
+                ENTRIES: len(self._entries),
+                HITS: self.hit_count,
+                MISSES: self.miss_count,
+                EVICTIONS: self.eviction_count,
+            }
+
+
+# Function to build the caches for closed and open periods from the INSIGHT_CACHE_* environment variables.
+def caches_from_environment():
+    max_entries = int(os.environ.get(INSIGHT_CACHE_ENTRIES, DEFAULT_CACHE_ENTRIES))
+    closed_cache = InsightCache(max_entries, float(os.environ.get(INSIGHT_CACHE_TTL_SECONDS, DEFAULT_CLOSED_TTL_SECONDS)))
+    open_cache = InsightCache(max_entries, float(os.environ.get(INSIGHT_CACHE_OPEN_TTL_SECONDS, DEFAULT_OPEN_TTL_SECONDS)))
+    return closed_cache, open_cache
@@ -0,0 +1,105 @@
+import os
+from datetime import date
+from decimal import Decimal
+from constants import *
+from aggregates import AVERAGED_METRICS, item_value
+from runtime import optional_module
+
+# NumPy is not part of the Lambda Python runtime; hdi-deep-insights gets it from the hdi-numpy
+# layer of the template. The float mode falls back to the scalar path when it is not available,
+# and only the float mode imports it.
+
+# "decimal" keeps the exact Decimal arithmetic and output of the original insights;
+# "float" computes in binary floating point, vectorized with NumPy for large ranges
+PRECISION = os.environ.get(INSIGHT_PRECISION_ENV, DECIMAL_PRECISION)
+
+# Ranges with at least this many daily items use the columnar NumPy path in float mode
+COLUMNAR_MIN_ITEMS = 2000
+
+# Bar granularity of the insight types; W and M have one bar per day
+PERIOD_GRANULARITY = {YEARLY: MONTHLY, SIXMONTHLY: WEEKLY}
+
+# Offset that turns a NumPy day number (days since Thursday 1970-01-01) into a Monday-based weekday
+EPOCH_WEEKDAY_OFFSET = 3
+
+
+# Function to read the daily value of an item as a float without going through Decimal.
+def float_value(item, metric):
+    if QUANTITY in item:
+        return float(item_value(item, metric))
+    total = float(item.get(SUM, 0))
+    if metric in AVERAGED_METRICS:
+        count = int(item.get(COUNT, 0))
+        return total / count if count else 0.0
+    return total
+
+# Function to return the key of the period a "YYYY-MM-DD" day belongs to: the day itself,
+# the first day of its month, or the proleptic ordinal of the Monday of its week.
+def period_key(date_str, granularity):
+    if granularity == MONTHLY:
+        return date_str[:8] + "01"
+    if granularity == WEEKLY:
+        ordinal = date.fromisoformat(date_str).toordinal()
+        # Ordinal 1 (0001-01-01) is a Monday
+        return ordinal - (ordinal - 1) % 7
+    return date_str
+
+# Function to convert a period key back to the date of the start of the period.
+def period_start(key):
+    return date.fromordinal(key) if isinstance(key, int) else date.fromisoformat(key)
+
+# Function to average the daily values of each period, in the order the periods first appear.
+# Items arrive in date order, so the sums are accumulated in the same order as the original
+# per-period lists and the Decimal results are identical.
+def period_values(items, metric, granularity, precision=None):
+    precision = precision or PRECISION
+    if precision == FLOAT_PRECISION:
+        items = items if isinstance(items, list) else list(items)
+        if len(items) >= COLUMNAR_MIN_ITEMS and optional_module(NUMPY) is not None:
+            return period_values_columnar(items, metric, granularity)
+
+    value_of = float_value if precision == FLOAT_PRECISION else item_value
+    buckets = {}
+    for item in items:
+        key = period_key(item[HD_CTX_DATE][-10:], granularity)
+        value = value_of(item, metric)
+        bucket = buckets.get(key)
+        if bucket is None:
+            buckets[key] = [value, 1]
+        else:
+            bucket[0] += value
+            bucket[1] += 1
+    return [(period_start(key), total / count) for key, (total, count) in buckets.items()]
+
+# Function to average the daily values of each period column-wise: the dates are parsed and
+# bucketed by NumPy and the values are summed per bucket with bincount.
+def period_values_columnar(items, metric, granularity):
+    numpy = optional_module(NUMPY)
+    days = numpy.array([item[HD_CTX_DATE][-10:] for item in items], dtype="datetime64[D]")
+    values = numpy.array([float_value(item, metric) for item in items], dtype=numpy.float64)
+    if granularity == MONTHLY:
+        keys = days.astype("datetime64[M]").astype("datetime64[D]")
+    elif granularity == WEEKLY:
+        day_numbers = days.astype(numpy.int64)
+        keys = (day_numbers - (day_numbers + EPOCH_WEEKDAY_OFFSET) % 7).astype("datetime64[D]")
+    else:
+        keys = days
+    periods, bucket_ids = numpy.unique(keys, return_inverse=True)
+    sums = numpy.bincount(bucket_ids, weights=values, minlength=len(periods))
+    counts = numpy.bincount(bucket_ids, minlength=len(periods))
+    return [(period.item(), float(total / count)) for period, total, count in zip(periods, sums, counts)]
+
+# Function to compute the average, minimum, maximum and change (last minus first) of the
+# period values in a single pass.
+def summary_stats(values):
+    if not values:
+        return Decimal(0), Decimal(0), Decimal(0), Decimal(0)
+    total = 0
+    min_value = max_value = values[0]
+    for value in values:
+        total += value
+        if value < min_value:
+            min_value = value
+        if value > max_value:
+            max_value = value
+    return total / len(values), min_value, max_value, values[-1] - values[0]
@@ -0,0 +1,144 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from constants import *
+
+# Metrics of one handler invocation: the time spent in named stages, counters, and the DynamoDB
+# capacity consumed. They are written as a single CloudWatch Embedded Metric Format (EMF) line
+# when the invocation ends, and CloudWatch extracts the metrics from the log; no PutMetricData
+# call is made. A container runs one invocation at a time, so the metrics of the current
+# invocation are kept at module level and shared by all of its threads.
+
+METRICS_NAMESPACE = os.environ.get(METRICS_NAMESPACE_ENV, "HealthDataInsights")
+METRICS_ENABLED = os.environ.get(METRICS_ENABLED_ENV, "true").lower() == "true"
+
+# Dimension of the metrics: the handler that emitted them
+HANDLER_DIMENSION = "Handler"
+DURATION_METRIC = "Duration"
+MILLISECONDS = "Milliseconds"
+COUNT_UNIT = "Count"
+
+
+class InvocationMetrics:
+
+    def __init__(self, handler_name=None, request_id=None):
+        self.handler_name = handler_name
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.stage_millis = {}
+        self.counts = {}
+        self.capacity = {READ_CAPACITY_UNITS: 0.0, WRITE_CAPACITY_UNITS: 0.0}
+        self._lock = threading.Lock()
+
+    # Function to add time to a stage. Stages that run in several threads add up their time.
+    def add_time(self, stage_name, millis):
+        with self._lock:
+            self.stage_millis[stage_name] = self.stage_millis.get(stage_name, 0.0) + millis
+
+    def add_count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    # Function to add the ConsumedCapacity of a DynamoDB response (one table, or a list of tables
+    # for batch calls) to the read or write capacity units.
+    def add_capacity(self, capacity_name, response):
+        consumed = response.get(CONSUMED_CAPACITY) if response else None
+        if not consumed:
+            return
+        if isinstance(consumed, dict):
+            consumed = [consumed]
+        units = sum(float(table_capacity.get(CAPACITY_UNITS, 0)) for table_capacity in consumed)
+        with self._lock:
+            self.capacity[capacity_name] += units
+
+    # Function to build the EMF document of the invocation.
+    def document(self):
+        with self._lock:
+            values = {DURATION_METRIC: round((time.perf_counter() - self.started) * 1000, 3)}
+            units = {DURATION_METRIC: MILLISECONDS}
+            for stage_name, millis in self.stage_millis.items():
+                values[f"{stage_name}Time"] = round(millis, 3)
+                units[f"{stage_name}Time"] = MILLISECONDS
+            for name, value in {**self.counts, **self.capacity}.items():
+                values[name] = round(value, 3)
+                units[name] = COUNT_UNIT
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [[HANDLER_DIMENSION]],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit in units.items()],
+                }],
+            },
+            HANDLER_DIMENSION: self.handler_name,
+            "RequestId": self.request_id,
+            **values,
+        }
+
+
+# Metrics of the invocation in progress; calls outside an invocation (e.g. the backfill
+# command line) are collected here and never emitted
+_current = InvocationMetrics()
+
+# Function to start collecting the metrics of a new invocation.
+def start_invocation(handler_name, context=None):
+    global _current
+    _current = InvocationMetrics(handler_name, getattr(context, "aws_request_id", None))
+    return _current
+
+# Function to return the metrics of the invocation in progress.
+def current():
+    return _current
+
+# Function to time a stage of the invocation: with stage(WRITE_STAGE): ...
+@contextmanager
+def stage(stage_name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current.add_time(stage_name, (time.perf_counter() - started) * 1000)
+
+# Function to iterate over an iterable, adding the time spent producing its elements (e.g. reading
+# and parsing rows in a generator) to a stage.
+def timed(iterable, stage_name):
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            element = next(iterator)
+        except StopIteration:
+            _current.add_time(stage_name, (time.perf_counter() - started) * 1000)
+            return
+        _current.add_time(stage_name, (time.perf_counter() - started) * 1000)
+        yield element
+
+def count(name, value=1):
+    _current.add_count(name, value)
+
+def record_capacity(response, capacity_name):
+    _current.add_capacity(capacity_name, response)
+
+# Function to write the metrics of the invocation as one EMF line. It is printed rather than
+# logged, as CloudWatch only extracts metrics from lines that are a JSON document.
+def emit():
+    if METRICS_ENABLED:
+        print(json.dumps(_current.document()), flush=True)
+
+# Decorator of a Lambda handler that collects the metrics of each invocation and emits them
+# when it returns or raises.
+def instrumented(handler_name):
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            start_invocation(handler_name, context)
+            try:
+                return handler(event, context)
+            finally:
+                emit()
+        return wrapper
+    return decorate
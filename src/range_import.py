@@ -0,0 +1,115 @@
+import csv
+import time
+import logging
+from constants import *
+from batch_writer import error_code
+from stream_reader import CHUNK_SIZE
+
+logger = logging.getLogger()
+
+# Number of bytes fetched to find the header line of a CSV object
+HEADER_PROBE_BYTES = 64 * 1024
+
+# Function to read the CSV header and return its column names and the offset where data starts.
+def read_header(s3, bucket_name, key):
+    response = s3.get_object(Bucket=bucket_name, Key=key, Range=f"bytes=0-{HEADER_PROBE_BYTES - 1}")
+    probe = response[BODY].read()
+    header_end = probe.find(b"\n")
+    if header_end < 0:
+        raise ValueError(f"No header line found in the first {HEADER_PROBE_BYTES} bytes of s3://{bucket_name}/{key}")
+    header = next(csv.reader([probe[:header_end].decode(UTF8_SIG).rstrip("\r")]))
+    return header, header_end + 1
+
+# Function to split the data part of an object into contiguous byte ranges of about the same size.
+# The ranges are nominal: a worker owns every line that starts inside its range.
+def split_ranges(data_start, size, parts):
+    parts = max(1, min(parts, size - data_start))
+    step = (size - data_start) // parts
+    bounds = [data_start + step * i for i in range(parts)] + [size]
+    return [(bounds[i], bounds[i + 1]) for i in range(parts) if bounds[i] < bounds[i + 1]]
+
+# Function to yield the lines that start within [start, end) from a body that begins at body_start.
+# When body_start is before start, the first (partial) line belongs to the previous range and is skipped.
+# position[0] is kept at the offset just after the last line yielded, which is where a resume starts.
+def iter_range_lines(body, body_start, start, end, position, chunk_size=CHUNK_SIZE):
+    offset = body_start
+    skipping = body_start < start
+    remainder = b""
+    position[0] = start
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        for line in lines:
+            line_start = offset
+            offset += len(line) + 1
+            if skipping:
+                skipping = False
+                position[0] = offset
+                continue
+            if line_start >= end:
+                return
+            position[0] = offset
+            yield line.decode(UTF8)
+    if remainder and not skipping and offset < end:
+        position[0] = offset + len(remainder)
+        yield remainder.decode(UTF8)
+
+# Function to parse the CSV rows of a byte range into dictionaries keyed by the header columns.
+# A range starting at a line boundary (the data start or a committed checkpoint) is read from
+# that offset; any other range is read from one byte earlier so the partial first line can be skipped.
+def read_range_rows(s3, bucket_name, key, header, start, end, position, aligned=False):
+    body_start = start if aligned else start - 1
+    response = s3.get_object(Bucket=bucket_name, Key=key, Range=f"bytes={body_start}-")
+    body = response[BODY]
+    try:
+        for values in csv.reader(iter_range_lines(body, body_start, start, end, position)):
+            if values:
+                yield dict(zip(header, values))
+    finally:
+        body.close()
+
+# Function to build the key of the checkpoint item of a byte range.
+def checkpoint_key(import_id, start, end):
+    return {IMPORT_ID: import_id, BYTE_RANGE: f"{start:015d}-{end:015d}"}
+
+# Function to create the checkpoint items of an import, keeping the progress of ranges that already exist
+# so that a redelivered S3 notification does not restart the file.
+def create_checkpoints(checkpoint_table, import_id, ranges):
+    for start, end in ranges:
+        try:
+            checkpoint_table.put_item(
+                Item={**checkpoint_key(import_id, start, end), COMMITTED_OFFSET: start, CHECKPOINT_STATUS: IN_PROGRESS},
+                ConditionExpression="attribute_not_exists(#id)",
+                ExpressionAttributeNames={'#id': IMPORT_ID}
+            )
+        except Exception as error:
+            if error_code(error) != CONDITIONAL_CHECK_FAILED:
+                raise
+
+# Function to load the committed offset and status of a byte range.
+def load_checkpoint(checkpoint_table, import_id, start, end):
+    response = checkpoint_table.get_item(Key=checkpoint_key(import_id, start, end), ConsistentRead=True)
+    item = response.get(ITEM, {})
+    return int(item.get(COMMITTED_OFFSET, start)), item.get(CHECKPOINT_STATUS, IN_PROGRESS)
+
+# Function to record the committed offset of a byte range and add the counts written since the last save.
+def save_checkpoint(checkpoint_table, import_id, start, end, offset, status, counts):
+    update_expression = "SET #offset = :offset, #status = :status, #updated = :updated"
+    expression_values = {':offset': offset, ':status': status, ':updated': int(time.time())}
+    expression_names = {'#offset': COMMITTED_OFFSET, '#status': CHECKPOINT_STATUS, '#updated': UPDATED_AT}
+
+    counters = [name for name, value in counts.items() if value]
+    if counters:
+        update_expression += " ADD " + ", ".join(f"#{name} :{name}" for name in counters)
+        expression_values.update({f":{name}": counts[name] for name in counters})
+        expression_names.update({f"#{name}": name for name in counters})
+
+    checkpoint_table.update_item(
+        Key=checkpoint_key(import_id, start, end),
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_values,
+        ExpressionAttributeNames=expression_names
+    )
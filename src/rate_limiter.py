@@ -0,0 +1,96 @@
+import os
+import threading
+import time
+from constants import *
+
+# Default limiter settings, in items written per second
+DEFAULT_WRITE_RATE = 1000
+DEFAULT_MIN_WRITE_RATE = 25
+DEFAULT_MAX_WRITE_RATE = 40000
+
+# Additive increase applied after a period without throttling, and the multiplicative decrease on throttling
+INCREASE_STEP = 100
+DECREASE_FACTOR = 0.5
+
+# Minimum number of seconds between two rate adjustments, so a burst of throttled
+# calls from many threads only backs the rate off once
+ADJUST_INTERVAL_SECONDS = 1.0
+
+
+# Token bucket shared by all writer threads. The refill rate follows AIMD: it grows by
+# a fixed step while calls succeed and is cut by a factor whenever DynamoDB throttles.
+class AdaptiveRateLimiter:
+
+    def __init__(self, rate=DEFAULT_WRITE_RATE, burst=None, min_rate=DEFAULT_MIN_WRITE_RATE,
+                 max_rate=DEFAULT_MAX_WRITE_RATE, increase_step=INCREASE_STEP, decrease_factor=DECREASE_FACTOR):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.increase_step = float(increase_step)
+        self.decrease_factor = float(decrease_factor)
+        self.throttle_count = 0
+        self.success_count = 0
+        self.waited_seconds = 0.0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._adjusted = self._updated
+        self._lock = threading.Lock()
+
+    # Function to build a limiter from the WRITE_RATE_* environment variables.
+    @classmethod
+    def from_environment(cls):
+        rate = float(os.environ.get(WRITE_RATE_PER_SECOND, DEFAULT_WRITE_RATE))
+        return cls(
+            rate=rate,
+            burst=float(os.environ.get(WRITE_BURST, rate)),
+            min_rate=float(os.environ.get(WRITE_RATE_MIN, DEFAULT_MIN_WRITE_RATE)),
+            max_rate=float(os.environ.get(WRITE_RATE_MAX, DEFAULT_MAX_WRITE_RATE)),
+        )
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    # Function to block until the requested number of tokens is available.
+    # Requests larger than the burst are admitted once the bucket is full and leave it in debt.
+    def acquire(self, tokens=1):
+        needed = min(tokens, self.burst)
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= needed:
+                    self._tokens -= tokens
+                    return
+                wait = (needed - self._tokens) / self.rate
+                self.waited_seconds += wait
+            time.sleep(wait)
+
+    # Function to record a call that was not throttled.
+    def on_success(self):
+        with self._lock:
+            self.success_count += 1
+            now = time.monotonic()
+            if now - self._adjusted >= ADJUST_INTERVAL_SECONDS:
+                self.rate = min(self.max_rate, self.rate + self.increase_step)
+                self._adjusted = now
+
+    # Function to record a throttled call and back the rate off.
+    def on_throttle(self):
+        with self._lock:
+            self.throttle_count += 1
+            now = time.monotonic()
+            if now - self._adjusted >= ADJUST_INTERVAL_SECONDS:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self._tokens = min(self._tokens, 0.0)
+                self._adjusted = now
+
+    # Function to report the current rate and the success and throttle counts.
+    def stats(self):
+        with self._lock:
+            return {
+                RATE: round(self.rate, 2),
+                SUCCESSES: self.success_count,
+                THROTTLES: self.throttle_count,
+                WAITED_SECONDS: round(self.waited_seconds, 3),
+            }
@@ -0,0 +1,341 @@
+import heapq
+import logging
+import zlib
+from decimal import Decimal, InvalidOperation
+from constants import *
+from batch_writer import error_code, new_write_counts, sdk_retried, THROTTLING_ERRORS
+from metrics import record_capacity, stage
+from sharding import partition_keys, shard_key
+
+# Packed storage of raw readings: with RAW_STORAGE_MODE=block, the readings of a user, metric
+# context and hour are stored in one hdi-health-data item instead of one item per reading.
+#
+#   userid          1234567
+#   hd-context-time heart_rate#NA#2024-10-01 05    (the hour of the readings)
+#   readings        the second of the hour and the quantity of every reading, delta encoded
+#   sum, count      the sum and number of the readings, read by the aggregation without decoding
+#   unit, device attributes of the latest reading
+#
+# A block key sorts just before the readings of its hour, so blocks and single readings can
+# live in the same table, and range reads return both. With write sharding (see sharding.py)
+# a block is stored in the shard of its hour's key.
+
+logger = logging.getLogger()
+
+# First byte of the readings attribute: the varint payload as is, or zlib compressed
+RAW_PAYLOAD = 1
+ZLIB_PAYLOAD = 2
+
+# Most decimal places kept for a quantity; readings with more are not packed
+MAX_SCALE = 9
+
+# Length of the "YYYY-MM-DD HH:MM:SS" timestamps of the readings and of their "YYYY-MM-DD HH" hour
+TIMESTAMP_LENGTH = 19
+HOUR_LENGTH = 13
+
+# Readings buffered by the import before their blocks are written; readings of an hour that
+# arrive in later buffers are merged into the stored block
+BUFFER_READINGS = 50000
+
+# Number of blocks handed to a writer thread at a time
+BLOCK_GROUP_SIZE = 25
+
+# Attempts to write a block that is stored already, or that another writer changed in the meantime
+MAX_CONFLICT_RETRIES = 5
+
+
+# The readings of one user, metric context and hour: the quantity of each second of the hour
+# that has a reading, and the attributes of the latest reading.
+class ReadingBlock:
+    __slots__ = ("user_id", "block_key", "readings", "unit", "attributes", "encoded")
+
+    def __init__(self, user_id, block_key, readings=None, unit=None, attributes=None, encoded=None):
+        self.user_id = user_id
+        self.block_key = block_key
+        self.readings = readings if readings is not None else {}
+        self.unit = unit
+        self.attributes = attributes or {}
+        # The readings attribute as stored, for blocks read from the table
+        self.encoded = encoded
+
+    # Function to build the block stored in an hdi-health-data item.
+    @classmethod
+    def from_item(cls, item):
+        attributes = {name: value for name, value in item.items()
+                      if name not in (USERID, HD_CTX_TIME, READINGS, SUM, COUNT, UNIT)}
+        encoded = bytes(item[READINGS])
+        return cls(item[USERID], item[HD_CTX_TIME], dict(decode_readings(encoded)), item.get(UNIT), attributes, encoded)
+
+    # Function to build the hdi-health-data item of the block.
+    def to_item(self):
+        item = {**self.attributes, USERID: self.user_id, HD_CTX_TIME: self.block_key,
+                READINGS: encode_readings(self.readings), SUM: sum(self.readings.values(), Decimal(0)),
+                COUNT: len(self.readings)}
+        if self.unit is not None:
+            item[UNIT] = self.unit
+        return item
+
+    # Function to return the key of the block's item.
+    def key(self):
+        return {USERID: self.user_id, HD_CTX_TIME: self.block_key}
+
+
+def write_varint(output, value):
+    while value >= 0x80:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+# Functions to map signed integers to unsigned ones so small negative deltas stay small
+def zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+# Function to encode the readings of a block: the number of decimal places of the quantities,
+# the number of readings, the deltas between their seconds and the deltas between their
+# quantities as integers of that many decimal places. The payload is compressed when that
+# makes it smaller.
+def encode_readings(readings):
+    offsets = sorted(readings)
+    scale = max((max(0, -readings[offset].as_tuple().exponent) for offset in offsets), default=0)
+    payload = bytearray()
+    write_varint(payload, scale)
+    write_varint(payload, len(offsets))
+    previous = 0
+    for offset in offsets:
+        write_varint(payload, offset - previous)
+        previous = offset
+    previous = 0
+    for offset in offsets:
+        value = int(readings[offset].scaleb(scale))
+        write_varint(payload, zigzag(value - previous))
+        previous = value
+    compressed = zlib.compress(payload, 9)
+    if len(compressed) < len(payload):
+        return bytes([ZLIB_PAYLOAD]) + compressed
+    return bytes([RAW_PAYLOAD]) + payload
+
+# Function to decode the readings of a block into (second of the hour, quantity) pairs in time order.
+def decode_readings(data):
+    payload = zlib.decompress(data[1:]) if data[0] == ZLIB_PAYLOAD else data[1:]
+    scale, position = read_varint(payload, 0)
+    size, position = read_varint(payload, position)
+    offsets = []
+    offset = 0
+    for _ in range(size):
+        delta, position = read_varint(payload, position)
+        offset += delta
+        offsets.append(offset)
+    readings = []
+    value = 0
+    for offset in offsets:
+        delta, position = read_varint(payload, position)
+        value += unzigzag(delta)
+        readings.append((offset, Decimal(value).scaleb(-scale)))
+    return readings
+
+# Function to split the hd-context-time of a reading into the key of its block and its second
+# of the hour. Raises ValueError for a timestamp that is not "YYYY-MM-DD HH:MM:SS".
+def block_position(context_time):
+    prefix, timestamp = context_time.rsplit(DELIMETER, 1)
+    if len(timestamp) != TIMESTAMP_LENGTH or timestamp[13] != ":" or timestamp[16] != ":":
+        raise ValueError(f"Timestamp {timestamp!r} is not YYYY-MM-DD HH:MM:SS")
+    minute, second = int(timestamp[14:16]), int(timestamp[17:19])
+    if minute > 59 or second > 59:
+        raise ValueError(f"Timestamp {timestamp!r} is not YYYY-MM-DD HH:MM:SS")
+    return f"{prefix}{DELIMETER}{timestamp[:HOUR_LENGTH]}", minute * 60 + second
+
+# Function to parse the quantity of a reading. Raises ValueError for a quantity that cannot be packed.
+def reading_quantity(quantity):
+    try:
+        value = Decimal(quantity)
+    except InvalidOperation:
+        raise ValueError(f"Quantity {quantity!r} is not a number")
+    if not value.is_finite() or -value.as_tuple().exponent > MAX_SCALE:
+        raise ValueError(f"Quantity {quantity!r} cannot be packed")
+    return value
+
+# Function to tell whether an imported item can be packed into a block.
+def is_packable(item):
+    try:
+        block_position(item[HD_CTX_TIME])
+        reading_quantity(item[QUANTITY])
+        return True
+    except (KeyError, ValueError):
+        return False
+
+# Function to tell whether an hdi-health-data item is a block.
+def is_block(item):
+    return READINGS in item
+
+# Function to add imported items to the blocks of their hour. A later reading of the same second
+# replaces an earlier one. Returns the number of replaced readings.
+def pack_readings(items, blocks):
+    duplicates = 0
+    for item in items:
+        block_key, offset = block_position(item[HD_CTX_TIME])
+        block = blocks.get((item[USERID], block_key))
+        if block is None:
+            block = blocks[(item[USERID], block_key)] = ReadingBlock(shard_key(item[USERID], block_key), block_key)
+        if offset in block.readings:
+            duplicates += 1
+        block.readings[offset] = reading_quantity(item[QUANTITY])
+        block.unit = item.get(UNIT, block.unit)
+        block.attributes = {name: value for name, value in item.items() if name not in (USERID, HD_CTX_TIME, QUANTITY, UNIT)}
+    return duplicates
+
+# Function to group imported items into groups of group_size blocks, buffering buffer_readings
+# readings at a time. Yields (blocks, duplicates, offset), where offset is the position in the
+# object up to which every row is written once the group and the groups before it are written:
+# all groups of a buffer but the last carry the offset of the previous buffer.
+def chunk_blocks(items, position=None, buffer_readings=BUFFER_READINGS, group_size=BLOCK_GROUP_SIZE):
+    blocks = {}
+    buffered = 0
+    duplicates = 0
+    committed = position[0] if position else None
+
+    def flush():
+        groups = list(blocks.values())
+        groups = [groups[i:i + group_size] for i in range(0, len(groups), group_size)] or [[]]
+        offset = position[0] if position else None
+        for number, group in enumerate(groups):
+            yield group, duplicates if number == 0 else 0, offset if number == len(groups) - 1 else committed
+
+    for item in items:
+        duplicates += pack_readings([item], blocks)
+        buffered += 1
+        if buffered >= buffer_readings:
+            yield from flush()
+            committed = position[0] if position else None
+            blocks = {}
+            buffered = 0
+            duplicates = 0
+    if blocks or duplicates:
+        yield from flush()
+
+# Function to build a block from an item returned in the low-level attribute value format,
+# as on a failed condition check.
+def block_from_attribute_values(attribute_values):
+    from boto3.dynamodb.types import TypeDeserializer # type: ignore
+    deserializer = TypeDeserializer()
+    return ReadingBlock.from_item({name: deserializer.deserialize(value) for name, value in attribute_values.items()})
+
+# Function to merge new readings into a stored block. Returns the merged block and the number of
+# new readings that were already stored with the same quantity.
+def merge_block(block, stored):
+    if stored is None:
+        return block, 0
+    merged = ReadingBlock(block.user_id, block.block_key, dict(stored.readings),
+                          block.unit if block.unit is not None else stored.unit, block.attributes)
+    unchanged = 0
+    for offset, value in block.readings.items():
+        if merged.readings.get(offset) == value:
+            unchanged += 1
+        merged.readings[offset] = value
+    return merged, unchanged
+
+# Function to write one block, merged with the stored one. The block is first written as new;
+# when one is stored already, the failed condition check returns it, and the merged block is
+# written conditional on the stored readings, so a block another writer changed in the meantime
+# is merged again. Returns the number of new readings that were already stored.
+def write_block(table, block, limiter=None):
+    stored = None
+    for attempt in range(MAX_CONFLICT_RETRIES + 1):
+        merged, unchanged = merge_block(block, stored)
+        if stored is not None and unchanged == len(block.readings) and merged.unit == stored.unit:
+            # Nothing new: the block is not written, and no stream record is produced
+            return unchanged
+        if stored is None:
+            condition = {'ConditionExpression': "attribute_not_exists(#readings)",
+                         'ExpressionAttributeNames': {'#readings': READINGS}}
+        else:
+            condition = {'ConditionExpression': "#readings = :readings",
+                         'ExpressionAttributeNames': {'#readings': READINGS},
+                         'ExpressionAttributeValues': {':readings': stored.encoded}}
+        if limiter:
+            with stage(THROTTLE_STAGE):
+                limiter.acquire(1)
+        try:
+            with stage(WRITE_STAGE):
+                response = table.put_item(Item=merged.to_item(), ReturnValuesOnConditionCheckFailure="ALL_OLD",
+                                          ReturnConsumedCapacity=TOTAL_CAPACITY, **condition)
+            record_capacity(response, WRITE_CAPACITY_UNITS)
+            if limiter:
+                if sdk_retried(response):
+                    limiter.on_throttle()
+                else:
+                    limiter.on_success()
+            return unchanged
+        except Exception as error:
+            if limiter and error_code(error) in THROTTLING_ERRORS:
+                limiter.on_throttle()
+            if error_code(error) != CONDITIONAL_CHECK_FAILED or attempt == MAX_CONFLICT_RETRIES:
+                raise
+            item = error.response.get(ITEM)
+            stored = block_from_attribute_values(item) if item else None
+
+# Function to write a group of blocks, each merged with its stored block. Counts every reading
+# as written, as a duplicate when it was already stored, or as failed with its block.
+def write_blocks(table, blocks, duplicates=0, limiter=None):
+    counts = new_write_counts()
+    counts[ROWS] = sum(len(block.readings) for block in blocks) + duplicates
+    counts[DUPLICATES] = duplicates
+    for block in blocks:
+        try:
+            unchanged = write_block(table, block, limiter)
+            counts[WRITTEN] += len(block.readings) - unchanged
+            counts[DUPLICATES] += unchanged
+        except Exception as error:
+            logger.error(f"{error} - Error writing block {block.block_key} of {block.user_id} to {table.name}")
+            counts[FAILED] += len(block.readings)
+    return counts
+
+# Function to read the readings of a user and metric context between two "YYYY-MM-DD HH:MM:SS"
+# timestamps, from blocks and single reading items alike. Yields (timestamp, quantity, unit) in
+# key order, the readings of a block in time order; the shards of a user are merged by timestamp.
+def query_readings(table, user_id, metric_code_context, start_time, end_time):
+    keys = partition_keys(user_id, start_time, end_time)
+    if len(keys) == 1:
+        return query_partition_readings(table, keys[0], metric_code_context, start_time, end_time)
+    return heapq.merge(*(query_partition_readings(table, key, metric_code_context, start_time, end_time) for key in keys),
+                       key=lambda reading: reading[0])
+
+# Function to read the readings of one partition of hdi-health-data between two timestamps, in key
+# order; the readings of a block are in time order.
+def query_partition_readings(table, partition_key, metric_code_context, start_time, end_time):
+    from boto3.dynamodb.conditions import Key # type: ignore
+    prefix = f"{metric_code_context}{DELIMETER}"
+    # The block of the first hour sorts before the first reading of that hour
+    query_args = {
+        'KeyConditionExpression': Key(USERID).eq(partition_key) &
+                                  Key(HD_CTX_TIME).between(f"{prefix}{start_time[:HOUR_LENGTH]}", f"{prefix}{end_time}"),
+    }
+    while True:
+        with stage(READ_STAGE):
+            response = table.query(**query_args)
+        for item in response.get(ITEMS, []):
+            timestamp = item[HD_CTX_TIME][len(prefix):]
+            if is_block(item):
+                readings = [(f"{timestamp}:{offset // 60:02d}:{offset % 60:02d}", value)
+                            for offset, value in decode_readings(bytes(item[READINGS]))]
+            else:
+                readings = [(timestamp, Decimal(str(item[QUANTITY])))]
+            for reading_time, value in readings:
+                if start_time <= reading_time <= end_time:
+                    yield reading_time, value, item.get(UNIT)
+        if LAST_EVALUATED_KEY not in response:
+            return
+        query_args[EXCLUSIVE_START_KEY] = response[LAST_EVALUATED_KEY]
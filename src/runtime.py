@@ -0,0 +1,101 @@
+import importlib
+import os
+import threading
+from constants import *
+
+# Shared AWS clients and optional modules of the Lambda handlers. Nothing is created or imported
+# until a handler first needs it, and everything is then kept for the life of the container.
+
+# Default size of the HTTP connection pool of each client. Handlers that call AWS from more
+# threads raise it with configure() before their first call.
+DEFAULT_POOL_CONNECTIONS = 10
+
+# Retry settings: adaptive mode adds client-side rate limiting on top of the standard retries
+RETRY_MODE = "adaptive"
+MAX_ATTEMPTS = 10
+
+# Retry settings of the clients whose writes an AdaptiveRateLimiter paces: the SDK retries a
+# throttled call at most once, without a rate limiter of its own, so throttling reaches the
+# limiter instead of being absorbed by the SDK's backoff
+LIMITED_RETRY_MODE = "standard"
+LIMITED_MAX_ATTEMPTS = 2
+
+_settings = {MAX_POOL_CONNECTIONS: int(os.environ.get(MAX_POOL_CONNECTIONS_ENV, DEFAULT_POOL_CONNECTIONS))}
+_clients = {}
+_modules = {}
+_lock = threading.RLock()
+_pid = os.getpid()
+
+# Function to raise the connection pool size to the number of threads a handler calls AWS from.
+# It only affects clients created after the call.
+def configure(max_pool_connections):
+    with _lock:
+        _settings[MAX_POOL_CONNECTIONS] = max(_settings[MAX_POOL_CONNECTIONS], int(max_pool_connections))
+
+# Function to return a client or resource created once per container (and per process, as
+# connections must not be shared with a forked worker).
+def _shared(key, factory):
+    global _pid
+    client = _clients.get(key)
+    if client is not None and _pid == os.getpid():
+        return client
+    with _lock:
+        if _pid != os.getpid():
+            _clients.clear()
+            _pid = os.getpid()
+        if key not in _clients:
+            _clients[key] = factory()
+        return _clients[key]
+
+def _session():
+    import boto3 # type: ignore
+    return boto3.session.Session()
+
+def _config(retry_mode=RETRY_MODE, max_attempts=MAX_ATTEMPTS):
+    from botocore.config import Config # type: ignore
+    return Config(
+        max_pool_connections=_settings[MAX_POOL_CONNECTIONS],
+        retries={'mode': retry_mode, 'max_attempts': max_attempts},
+        tcp_keepalive=True,
+    )
+
+# Function to make the handlers use another session, e.g. the in-memory stand-in of the
+# benchmarks. The clients created from the previous session are dropped.
+def use_session(session):
+    with _lock:
+        _clients.clear()
+        _clients[SESSION] = session
+
+# Function to return the shared low-level client of an AWS service, e.g. client(S3).
+def client(service_name):
+    session = _shared(SESSION, _session)
+    return _shared((CLIENT, service_name), lambda: session.client(service_name, config=_config()))
+
+# Function to return the shared DynamoDB service resource.
+def dynamodb():
+    session = _shared(SESSION, _session)
+    return _shared((RESOURCE, DYNAMODB), lambda: session.resource(DYNAMODB, config=_config()))
+
+# Function to return the shared Table resource of a DynamoDB table.
+def table(table_name):
+    return _shared((TABLE, table_name), lambda: dynamodb().Table(table_name))
+
+# Function to return the shared DynamoDB service resource for writes paced by a rate limiter,
+# with the retry settings of LIMITED_RETRY_MODE.
+def limited_dynamodb():
+    session = _shared(SESSION, _session)
+    return _shared((RESOURCE, DYNAMODB, LIMITED_RETRY_MODE),
+                   lambda: session.resource(DYNAMODB, config=_config(LIMITED_RETRY_MODE, LIMITED_MAX_ATTEMPTS)))
+
+# Function to return the shared Table resource of a DynamoDB table for writes paced by a rate limiter.
+def limited_table(table_name):
+    return _shared((TABLE, table_name, LIMITED_RETRY_MODE), lambda: limited_dynamodb().Table(table_name))
+
+# Function to import an optional dependency on first use, returning None if it is not installed.
+def optional_module(module_name):
+    if module_name not in _modules:
+        try:
+            _modules[module_name] = importlib.import_module(module_name)
+        except ImportError:
+            _modules[module_name] = None
+    return _modules[module_name]
@@ -0,0 +1,58 @@
+import os
+import zlib
+from datetime import date, timedelta
+from constants import *
+
+# Write sharding of hdi-health-data. With RAW_SHARD_COUNT above 1, the partition key of a raw
+# item is the user id followed by a shard number, e.g. 1234567#3, so the readings of one user
+# are spread over RAW_SHARD_COUNT partitions instead of hammering one during a bulk import:
+#   "hash"  the shard is a hash of the sort key; every write of an import, however it is
+#           ordered, goes to any of the shards
+#   "day"   the shard follows the day of the reading; a time-ordered import writes one shard
+#           at a time, but a range read only queries the shards of its days
+# Readers query every shard of a user, and the unsharded user id, which holds the items written
+# before sharding was enabled until hdi-migrate-shards.py moves them. hdi-aggregated-daily is
+# not sharded; the aggregation strips the shard from the keys of the raw items.
+# The count and scheme are read by the import and by the readers, and must be the same for
+# both; after changing them, run hdi-migrate-shards.py.
+
+RAW_SHARD_COUNT = max(1, int(os.environ.get(RAW_SHARD_COUNT_ENV, 1)))
+RAW_SHARD_SCHEME = os.environ.get(RAW_SHARD_SCHEME_ENV, HASH_SHARDING)
+
+
+# Function to return the shard of a raw item from its hd-context-time (the key of a reading or of a block).
+def shard_number(context_time):
+    if RAW_SHARD_SCHEME == DAY_SHARDING:
+        try:
+            return date.fromisoformat(context_time.rsplit(DELIMETER, 1)[-1][:10]).toordinal() % RAW_SHARD_COUNT
+        except ValueError:
+            pass
+    return zlib.crc32(context_time.encode()) % RAW_SHARD_COUNT
+
+# Function to return the partition key a raw item of a user is written to.
+def shard_key(user_id, context_time):
+    if RAW_SHARD_COUNT <= 1:
+        return user_id
+    return f"{user_id}{DELIMETER}{shard_number(context_time)}"
+
+# Function to move an imported item to the partition of its shard.
+def shard_item(item):
+    item[USERID] = shard_key(item[USERID], item[HD_CTX_TIME])
+    return item
+
+# Function to return the user id of a raw item's partition key, sharded or not.
+def user_of(partition_key):
+    return partition_key.split(DELIMETER, 1)[0]
+
+# Function to return the partition keys that hold the raw items of a user: the unsharded key and
+# every shard, or with "day" sharding and a date range only the shards of the days in the range.
+def partition_keys(user_id, start_date=None, end_date=None):
+    if RAW_SHARD_COUNT <= 1:
+        return [user_id]
+    shards = range(RAW_SHARD_COUNT)
+    if RAW_SHARD_SCHEME == DAY_SHARDING and start_date and end_date:
+        first, last = date.fromisoformat(start_date[:10]), date.fromisoformat(end_date[:10])
+        if (last - first).days < RAW_SHARD_COUNT:
+            shards = sorted({(first + timedelta(days=day)).toordinal() % RAW_SHARD_COUNT
+                             for day in range((last - first).days + 1)})
+    return [user_id] + [f"{user_id}{DELIMETER}{shard}" for shard in shards]
@@ -0,0 +1,37 @@
+import codecs
+import csv
+from constants import *
+
+# Number of bytes read from the S3 StreamingBody at a time
+CHUNK_SIZE = 1024 * 1024
+
+# Function to decode a byte stream into text one chunk at a time.
+# A leading UTF-8 byte order mark, as written by spreadsheet exports, is dropped.
+def iter_text(body, chunk_size=CHUNK_SIZE, encoding=UTF8_SIG):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+# Function to decode a byte stream into text lines one chunk at a time.
+# Only the current chunk and the trailing partial line are held in memory.
+def iter_lines(body, chunk_size=CHUNK_SIZE, encoding=UTF8_SIG):
+    remainder = ""
+    for text in iter_text(body, chunk_size, encoding):
+        lines = (remainder + text).split("\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if remainder:
+        yield remainder
+
+# Function to parse CSV rows incrementally from a byte stream, using the first line as the header.
+def read_csv_rows(body, chunk_size=CHUNK_SIZE):
+    return csv.DictReader(iter_lines(body, chunk_size))
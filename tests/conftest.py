@@ -0,0 +1,39 @@
+# Tests of the handlers against the in-memory DynamoDB and S3 stand-ins of benchmarks/fakes.py.
+# boto3 must be installed: the handlers build their key conditions with it.
+#
+#   python -m pytest tests
+
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SRC = os.path.join(ROOT, "src")
+sys.path[:0] = [SRC, os.path.join(ROOT, "benchmarks")]
+
+import metrics
+import runtime
+from fakes import FakeDynamoDB, FakeS3, FakeSession
+
+metrics.METRICS_ENABLED = False
+
+
+# Fixture of an empty in-memory DynamoDB the handlers use instead of AWS.
+@pytest.fixture
+def dynamodb():
+    fake = FakeDynamoDB()
+    runtime.use_session(FakeSession(fake, FakeS3()))
+    return fake
+
+# Fixture to load a handler module of src under its own name, e.g. load("hdi-dailyaggregate"),
+# so every test starts from a fresh module as a new Lambda container does.
+@pytest.fixture
+def load(dynamodb):
+    def load_module(name):
+        spec = importlib.util.spec_from_file_location(name.replace("-", "_"), os.path.join(SRC, f"{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    return load_module
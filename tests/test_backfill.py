@@ -0,0 +1,147 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+import cohorts
+import fakes
+import runtime
+from constants import *
+from datagen import stream_image
+from reading_blocks import ReadingBlock
+
+DAY = "2024-10-01"
+
+
+# Function to store a raw reading and return its INSERT stream record.
+def put_reading(dynamodb, metric, quantity, minute, sequence):
+    item = {USERID: "u1", HD_CTX_TIME: f"{metric}#NA#{DAY} 10:{minute:02d}:00", QUANTITY: str(quantity), UNIT: "unit"}
+    dynamodb.Table(HEALTH_RAW_DATA_TABLE).put_item(Item=item)
+    return {EVENTNAME: INSERT, DYNAMODB: {SEQUENCE_NUMBER: str(sequence), NEWIMAGE: stream_image(item)}}
+
+def daily_item(dynamodb, metric):
+    return dynamodb.Table(DAILY_AGGREGATED_TABLE).get_item(Key={USERID: "u1", HD_CTX_DATE: f"{metric}#NA#{DAY}"})[ITEM]
+
+
+# With AGGREGATION_MODE=average the backfill writes the quantity items of that mode, which the
+# stream function keeps adding readings to afterwards.
+@pytest.mark.parametrize("metric, expected", [("heart_rate", Decimal(70)), ("step_count", Decimal(420))])
+def test_average_mode_backfill_writes_items_the_stream_function_updates(dynamodb, load, metric, expected):
+    put_reading(dynamodb, metric, 60, 0, 1)
+    put_reading(dynamodb, metric, 80, 1, 2)
+    backfill = load("hdi-backfill")
+    backfill.AGGREGATION_MODE = AVERAGE_MODE
+    backfill.backfill(user_id="u1", start_date=DAY, end_date=DAY, threads=1)
+
+    item = daily_item(dynamodb, metric)
+    assert SUM not in item
+    assert not any(name.startswith(f"{metric}#NA#{MONTHLY}") for name in
+                   (stored[HD_CTX_DATE] for stored in dynamodb.Table(DAILY_AGGREGATED_TABLE).all_items()))
+
+    aggregate = load("hdi-dailyaggregate")
+    aggregate.AGGREGATION_MODE = AVERAGE_MODE
+    record = put_reading(dynamodb, metric, 280 if metric == "step_count" else 70, 2, 3)
+    assert aggregate.lambda_handler({RECORDS: [record]}, None)[BATCH_ITEM_FAILURES] == []
+    assert Decimal(daily_item(dynamodb, metric)[QUANTITY]) == expected
+
+# A month whose rollup was started by the stream only holds the days written since; rebuilding
+# the rollups from the daily items adds the days written before, so Y insights read them too.
+def test_rollup_backfill_adds_the_days_missing_from_a_rollup(dynamodb, load):
+    aggregated = dynamodb.Table(DAILY_AGGREGATED_TABLE)
+    for date, steps in [("2024-01-10", 100), ("2024-01-20", 200)]:
+        aggregated.put_item(Item={USERID: "u1", HD_CTX_DATE: f"step_count#NA#{date}", SUM: Decimal(steps), COUNT: 1, UNIT: "count"})
+    aggregated.put_item(Item={USERID: "u1", HD_CTX_DATE: f"step_count#NA#{MONTHLY}#2024-01-01", UNIT: "count",
+                              "2024-01-20": {SUM: Decimal(200), COUNT: 1}})
+
+    assert load("hdi-backfill").backfill_rollups(segments=2, threads=1) == {ROLLUPS: 3}
+
+    request = {USERID: "u1", HD_CTX: "step_count#NA", FROMDATE: "2024-01-01", TODATE: "2024-01-31"}
+    insights = load("hdi-deepinsights")
+    assert insights.lambda_handler({**request, INSIGHT_TYPE: MONTHLY}, None)[AVG] == "150"
+    assert insights.lambda_handler({**request, INSIGHT_TYPE: YEARLY}, None)[DATA][0][VALUE] == "150"
+
+# Rebuilt rollup days do not replace days the stream wrote with more readings in the meantime.
+def test_rollup_backfill_keeps_newer_days(dynamodb, load):
+    aggregated = dynamodb.Table(DAILY_AGGREGATED_TABLE)
+    aggregated.put_item(Item={USERID: "u1", HD_CTX_DATE: "step_count#NA#2024-01-20", SUM: Decimal(200), COUNT: 1, UNIT: "count"})
+    aggregated.put_item(Item={USERID: "u1", HD_CTX_DATE: f"step_count#NA#{MONTHLY}#2024-01-01", UNIT: "count",
+                              "2024-01-20": {SUM: Decimal(500), COUNT: 2}})
+
+    load("hdi-backfill").backfill_rollups(segments=1, threads=1)
+
+    rollup = aggregated.get_item(Key={USERID: "u1", HD_CTX_DATE: f"step_count#NA#{MONTHLY}#2024-01-01"})[ITEM]
+    assert rollup["2024-01-20"] == {SUM: 500, COUNT: 2}
+
+# With RAW_STORAGE_MODE=block the backfill decodes the blocks it reads, so it rebuilds a day
+# from the readings of a block even when the sum and count stored next to them are stale.
+def test_backfill_rebuilds_days_from_the_readings_of_blocks(dynamodb, load):
+    block = ReadingBlock("u1", f"step_count#NA#{DAY} 10", {0: Decimal(100), 60: Decimal(250)}, "count")
+    dynamodb.Table(HEALTH_RAW_DATA_TABLE).put_item(Item={**block.to_item(), SUM: Decimal(100), COUNT: 1})
+    put_reading(dynamodb, "step_count", 50, 30, 1)
+
+    load("hdi-backfill").backfill(segments=2, threads=1)
+
+    item = daily_item(dynamodb, "step_count")
+    assert (item[SUM], item[COUNT]) == (400, 3)
+
+# The backfill replaces the contributions of the members it rebuilds in the days of their cohort
+# shards; the members a targeted backfill leaves out keep theirs.
+def test_backfill_rebuilds_the_cohort_days_of_its_members(dynamodb, load, tmp_path, monkeypatch):
+    mapping = tmp_path / "cohorts.json"
+    mapping.write_text(json.dumps({"clinic-a": ["u1", "u2"]}))
+    monkeypatch.setattr(cohorts, "COHORT_MAPPING", str(mapping))
+    monkeypatch.setattr(cohorts, "_loaded_at", None)
+    monkeypatch.setattr(cohorts, "COHORT_SHARD_COUNT", 1)
+    aggregate = load("hdi-dailyaggregate")
+    records = [put_reading(dynamodb, "step_count", 100, 0, 1)]
+    item = {USERID: "u2", HD_CTX_TIME: f"step_count#NA#{DAY} 10:00:00", QUANTITY: "300", UNIT: "unit"}
+    dynamodb.Table(HEALTH_RAW_DATA_TABLE).put_item(Item=item)
+    records.append({EVENTNAME: INSERT, DYNAMODB: {SEQUENCE_NUMBER: "2", NEWIMAGE: stream_image(item)}})
+    assert aggregate.lambda_handler({RECORDS: records}, None)[BATCH_ITEM_FAILURES] == []
+    # A reading of u1 the stream never aggregated
+    put_reading(dynamodb, "step_count", 50, 1, 3)
+
+    counts = load("hdi-backfill").backfill(user_id="u1", start_date=DAY, end_date=DAY, threads=1)
+
+    shard_day = dynamodb.Table(DAILY_AGGREGATED_TABLE).get_item(
+        Key={USERID: "cohort#clinic-a#0", HD_CTX_DATE: f"step_count#NA#{DAY}"})[ITEM]
+    assert counts[COHORT_DAYS] == 1
+    assert (shard_day[SUM], shard_day[COUNT], shard_day[MEMBERS]) == (450, 3, 2)
+    assert shard_day["m#u1"] == {SUM: 150, COUNT: 2}
+    rollup = dynamodb.Table(DAILY_AGGREGATED_TABLE).get_item(
+        Key={USERID: "cohort#clinic-a#0", HD_CTX_DATE: f"step_count#NA#{MONTHLY}#2024-10-01"})[ITEM]
+    assert rollup[DAY] == {SUM: 450, COUNT: 3, MEMBERS: 2}
+
+# Context of an invocation with the given remaining time.
+class Context:
+
+    def __init__(self, remaining_millis):
+        self.aws_request_id = "request-1"
+        self.remaining_millis = remaining_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_millis
+
+# A Scan the function cannot finish in time saves its progress, with its totals in several chunks,
+# and continues in a new invocation that counts every reading once.
+def test_function_resumes_a_scan_from_its_checkpoint(dynamodb, load, monkeypatch):
+    monkeypatch.setattr(fakes, "PAGE_BYTES", 1)
+    monkeypatch.setenv(AWS_LAMBDA_FUNCTION_NAME, "hdi-backfill")
+    for minute in range(4):
+        put_reading(dynamodb, "step_count", 10 ** minute, minute, minute)
+    backfill = load("hdi-backfill")
+    backfill.CHECKPOINT_CHUNK_BYTES = 20
+
+    event = {SEGMENTS: 1}
+    for _ in range(3):
+        response = backfill.lambda_handler(event, Context(1000))
+        assert json.loads(response[MESSAGE_BODY]) == {CHECKPOINT_STATUS: IN_PROGRESS, CHECKPOINT_ID: "request-1"}
+        event = json.loads(runtime.client(LAMBDA).invocations[-1][2])
+    assert event == {SEGMENTS: 1, CHECKPOINT_ID: "request-1"}
+    assert dynamodb.Table(DAILY_AGGREGATED_TABLE).all_items() == []
+    chunks = [item for item in dynamodb.Table(IMPORT_CHECKPOINT_TABLE).all_items() if item[BYTE_RANGE] != STATE]
+    assert len(chunks) > 1 and len({item[BYTE_RANGE].split("#")[1] for item in chunks}) == 1
+
+    backfill.lambda_handler(event, Context(900000))
+    item = daily_item(dynamodb, "step_count")
+    assert (item[SUM], item[COUNT]) == (1111, 4)
@@ -0,0 +1,79 @@
+import pytest
+
+import batch_writer
+from batch_writer import MAX_BATCH_RETRIES, chunk_items, write_batch
+from constants import *
+
+
+def reading(second, quantity="1"):
+    return {USERID: "u1", HD_CTX_TIME: f"step_count#NA#2024-10-01 10:00:{second:02d}", QUANTITY: quantity}
+
+def put_request(item):
+    return {PUT_REQUEST: {ITEM: item}}
+
+# DynamoDB stand-in whose BatchWriteItem calls return the given responses, or raise the given
+# errors, in turn; it records the requests of every call.
+class ScriptedDynamoDB:
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.requests.append(RequestItems[HEALTH_RAW_DATA_TABLE])
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+class ScriptedError(Exception):
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+def unprocessed(*items):
+    return {UNPROCESSED_ITEMS: {HEALTH_RAW_DATA_TABLE: [put_request(item) for item in items]}}
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(batch_writer, "backoff_delay", lambda attempt: 0)
+
+
+# Unprocessed items are resubmitted until DynamoDB takes them; each resubmission counts as a retry.
+def test_unprocessed_items_are_retried_and_counted():
+    items = [reading(second) for second in range(3)]
+    dynamodb = ScriptedDynamoDB(unprocessed(items[1], items[2]), unprocessed(items[2]), {UNPROCESSED_ITEMS: {}})
+    counts = write_batch(dynamodb, HEALTH_RAW_DATA_TABLE, items, duplicates=2)
+
+    assert counts == {ROWS: 5, WRITTEN: 3, DUPLICATES: 2, RETRIED: 3, FAILED: 0}
+    assert dynamodb.requests[1:] == [[put_request(items[1]), put_request(items[2])], [put_request(items[2])]]
+
+def test_items_still_unprocessed_after_the_last_retry_fail():
+    items = [reading(0), reading(1)]
+    dynamodb = ScriptedDynamoDB(*[unprocessed(items[1])] * (MAX_BATCH_RETRIES + 1))
+    counts = write_batch(dynamodb, HEALTH_RAW_DATA_TABLE, items)
+
+    assert (counts[WRITTEN], counts[RETRIED], counts[FAILED]) == (1, MAX_BATCH_RETRIES, 1)
+    assert len(dynamodb.requests) == MAX_BATCH_RETRIES + 1
+
+# A throttled call is retried whole; any other error fails the items without retrying them.
+def test_throttled_call_is_retried_and_other_errors_fail_the_batch():
+    items = [reading(0), reading(1)]
+    throttled = ScriptedDynamoDB(ScriptedError("ProvisionedThroughputExceededException"), {UNPROCESSED_ITEMS: {}})
+    assert write_batch(throttled, HEALTH_RAW_DATA_TABLE, items)[WRITTEN] == 2
+
+    failing = ScriptedDynamoDB(ScriptedError("ValidationException"))
+    counts = write_batch(failing, HEALTH_RAW_DATA_TABLE, items)
+    assert (counts[WRITTEN], counts[RETRIED], counts[FAILED]) == (0, 0, 2)
+    assert len(failing.requests) == 1
+
+# Within a batch the last item of a key wins; keys of recent batches are dropped as duplicates
+# until they fall out of the dedupe window.
+def test_chunks_drop_duplicate_keys_within_the_dedupe_window():
+    items = [reading(0, "1"), reading(0, "2"), reading(1), reading(0), reading(2), reading(3), reading(1)]
+    chunks = list(chunk_items(items, batch_size=2, dedupe_window=2))
+
+    assert [([item[HD_CTX_TIME][-2:] for item in batch], duplicates) for batch, duplicates in chunks] == [
+        (["00", "01"], 1), (["02", "03"], 1), (["01"], 0)]
+    assert chunks[0][0][0][QUANTITY] == "2"
@@ -0,0 +1,47 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+import cohorts
+from constants import *
+from datagen import stream_image
+
+DAY = "2024-10-01"
+MEMBERS_STEPS = {str(user_id): user_id for user_id in range(1, 41)}
+
+
+# Function to return the INSERT stream record of a member's step count of the day.
+def steps_record(user_id, sequence):
+    item = {USERID: user_id, HD_CTX_TIME: f"step_count#NA#{DAY} 10:00:00", QUANTITY: str(MEMBERS_STEPS[user_id]), UNIT: "count"}
+    return {EVENTNAME: INSERT, DYNAMODB: {SEQUENCE_NUMBER: str(sequence), NEWIMAGE: stream_image(item)}}
+
+@pytest.fixture
+def cohort(tmp_path, monkeypatch):
+    mapping = tmp_path / "cohorts.json"
+    mapping.write_text(json.dumps({"clinic-a": list(MEMBERS_STEPS)}))
+    monkeypatch.setattr(cohorts, "COHORT_MAPPING", str(mapping))
+    monkeypatch.setattr(cohorts, "_loaded_at", None)
+    return "clinic-a"
+
+
+# The members of a cohort are added to the items of their shards, which only hold the attributes
+# of their own members, and the insights of the cohort sum the shards.
+def test_cohort_days_are_sharded_and_summed_by_insights(dynamodb, load, cohort):
+    aggregate = load("hdi-dailyaggregate")
+    records = [steps_record(user_id, sequence) for sequence, user_id in enumerate(MEMBERS_STEPS, 1)]
+    assert aggregate.lambda_handler({RECORDS: records}, None)[BATCH_ITEM_FAILURES] == []
+
+    shard_items = [item for item in dynamodb.Table(DAILY_AGGREGATED_TABLE).all_items()
+                   if item[USERID].startswith(f"{COHORT}{DELIMETER}") and item[HD_CTX_DATE] == f"step_count#NA#{DAY}"]
+    assert len(shard_items) > 1
+    assert {item[USERID] for item in shard_items} <= set(cohorts.shard_keys(cohorts.cohort_key(cohort)))
+    for item in shard_items:
+        members = [name[len(cohorts.MEMBER_PREFIX):] for name in item if name.startswith(cohorts.MEMBER_PREFIX)]
+        assert {cohorts.member_shard_key(cohort, user_id) for user_id in members} == {item[USERID]}
+        assert item[MEMBERS] == len(members)
+    assert sum(item[SUM] for item in shard_items) == sum(MEMBERS_STEPS.values())
+
+    insights = load("hdi-deepinsights").lambda_handler(
+        {INSIGHT_TYPE: MONTHLY, COHORT: cohort, HD_CTX: "step_count#NA", FROMDATE: DAY, TODATE: DAY}, None)
+    assert Decimal(insights[DATA][0][VALUE]) == Decimal(sum(MEMBERS_STEPS.values())) / len(MEMBERS_STEPS)
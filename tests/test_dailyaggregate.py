@@ -0,0 +1,124 @@
+from decimal import Decimal
+
+import pytest
+
+from constants import *
+from datagen import stream_image
+
+DAY = "2024-10-01"
+
+
+# Function to return the INSERT stream record of a step count reading written to a partition key.
+def reading_record(partition_key, sequence, quantity, minute=0):
+    item = {USERID: partition_key, HD_CTX_TIME: f"step_count#NA#{DAY} 10:{minute:02d}:00", QUANTITY: str(quantity), UNIT: "count"}
+    return {EVENTNAME: INSERT, DYNAMODB: {SEQUENCE_NUMBER: str(sequence), NEWIMAGE: stream_image(item)}}
+
+def daily_item(dynamodb, user_id="u1"):
+    return dynamodb.Table(DAILY_AGGREGATED_TABLE).get_item(Key={USERID: user_id, HD_CTX_DATE: f"step_count#NA#{DAY}"})[ITEM]
+
+def daily_total(dynamodb, mode):
+    item = daily_item(dynamodb)
+    return item[SUM] if mode == SUM_COUNT_MODE else Decimal(item[QUANTITY])
+
+@pytest.fixture(params=[SUM_COUNT_MODE, AVERAGE_MODE])
+def aggregate(request, load):
+    module = load("hdi-dailyaggregate")
+    module.AGGREGATION_MODE = request.param
+    return module
+
+
+# Shards of a user are read from different stream shards, whose sequence numbers cannot be
+# compared: a record of one shard with a lower sequence number than the one applied from another
+# shard is still counted, and a replayed record of either is not.
+def test_records_of_two_shards_of_one_day_are_counted_once(dynamodb, aggregate):
+    for record in [reading_record("u1#1", 500, 10), reading_record("u1#2", 300, 7, 1),
+                   reading_record("u1#2", 300, 7, 1), reading_record("u1#1", 500, 10)]:
+        assert aggregate.lambda_handler({RECORDS: [record]}, None)[BATCH_ITEM_FAILURES] == []
+
+    assert daily_total(dynamodb, aggregate.AGGREGATION_MODE) == 17
+    assert daily_item(dynamodb)[f"{LAST_SEQUENCE}#1"].endswith("500")
+    assert daily_item(dynamodb)[f"{LAST_SEQUENCE}#2"].endswith("300")
+
+# A batch of records of two shards that was partly applied before only adds the records after
+# the sequence number applied from each shard.
+def test_partly_applied_batch_of_two_shards_adds_the_rest(dynamodb, aggregate):
+    records = [reading_record("u1#1", 100, 1), reading_record("u1#2", 101, 2, 1),
+               reading_record("u1#1", 102, 4, 2), reading_record("u1#2", 103, 8, 3)]
+    aggregate.lambda_handler({RECORDS: records[:2]}, None)
+    aggregate.lambda_handler({RECORDS: [reading_record("u1", 50, 16, 4)]}, None)
+
+    assert aggregate.lambda_handler({RECORDS: records}, None)[BATCH_ITEM_FAILURES] == []
+    assert aggregate.lambda_handler({RECORDS: records}, None)[BATCH_ITEM_FAILURES] == []
+    assert daily_total(dynamodb, aggregate.AGGREGATION_MODE) == 31
+
+# The records of one partition key must come in order; a record that breaks it is reported as a
+# failure of its own instead of being skipped by the replay guard, and the other records apply.
+def test_record_out_of_order_is_reported_on_its_own(dynamodb, aggregate):
+    records = [reading_record("u1#1", 200, 1), reading_record("u1#1", 100, 2, 1), reading_record("u2", 150, 4)]
+    response = aggregate.lambda_handler({RECORDS: records}, None)
+
+    assert response[BATCH_ITEM_FAILURES] == [{ITEM_IDENTIFIER: "100"}]
+    assert daily_total(dynamodb, aggregate.AGGREGATION_MODE) == 1
+    item = daily_item(dynamodb, "u2")
+    assert (item[SUM] if aggregate.AGGREGATION_MODE == SUM_COUNT_MODE else Decimal(item[QUANTITY])) == 4
+
+# After a partition split the records of a partition key continue in a child stream shard, whose
+# sequence numbers may be lower than those of its parent: they are counted, as positions are only
+# compared within a stream shard, and a replayed window of the child is not counted twice.
+def test_window_of_a_child_stream_shard_is_counted_once(dynamodb, aggregate):
+    window = {WINDOW: {"start": "0", "end": "1"}, STATE: {}, IS_FINAL_INVOKE_FOR_WINDOW: True}
+    parent = {**window, SHARD_ID: "shardId-parent", RECORDS: [reading_record("u1", 900, 10)]}
+    child = {**window, SHARD_ID: "shardId-child", RECORDS: [reading_record("u1", 100, 5, 1)]}
+    for event in [parent, child, child]:
+        assert aggregate.lambda_handler(event, None)[BATCH_ITEM_FAILURES] == []
+
+    assert daily_total(dynamodb, aggregate.AGGREGATION_MODE) == 15
+    assert daily_item(dynamodb)[LAST_SEQUENCE].startswith("shardId-child#")
+
+# A window whose key was partly written before, e.g. by a flush that failed on another key and
+# was retried with more records, adds the records the earlier invocations of the window carried
+# after the stored sequence number, not only those of its final invocation.
+def test_window_completes_a_partly_written_key_from_its_state(dynamodb, aggregate):
+    records = [reading_record("u1", sequence, 2 ** sequence, sequence) for sequence in range(1, 6)]
+    aggregate.lambda_handler({RECORDS: records[:3]}, None)
+
+    window = {WINDOW: {"start": "0", "end": "1"}}
+    response = aggregate.lambda_handler({**window, RECORDS: records[:4], STATE: {}, IS_FINAL_INVOKE_FOR_WINDOW: False}, None)
+    response = aggregate.lambda_handler({**window, RECORDS: records[4:], STATE: response[STATE],
+                                         IS_FINAL_INVOKE_FOR_WINDOW: True}, None)
+
+    assert response[BATCH_ITEM_FAILURES] == []
+    assert daily_total(dynamodb, aggregate.AGGREGATION_MODE) == 2 + 4 + 8 + 16 + 32
+
+# A window that Lambda terminates early writes its state instead of carrying it on.
+def test_window_terminated_early_writes_its_state(dynamodb, aggregate):
+    window = {WINDOW: {"start": "0", "end": "1"}}
+    response = aggregate.lambda_handler({**window, RECORDS: [reading_record("u1", 1, 5)], STATE: {},
+                                         IS_FINAL_INVOKE_FOR_WINDOW: False, IS_WINDOW_TERMINATED_EARLY: True}, None)
+
+    assert response[STATE] == {}
+    assert daily_total(dynamodb, aggregate.AGGREGATION_MODE) == 5
+
+# The rollups of a day that still holds a legacy average include the readings behind it, as the
+# daily items read by W and M insights do.
+def test_rollups_include_the_legacy_quantity_of_a_day(dynamodb, load):
+    aggregated = dynamodb.Table(DAILY_AGGREGATED_TABLE)
+    aggregated.put_item(Item={USERID: "u1", HD_CTX_DATE: f"heart_rate#NA#{DAY}", QUANTITY: "70", HD_REFF_COUNT: "10", UNIT: "bpm"})
+    item = {USERID: "u1", HD_CTX_TIME: f"heart_rate#NA#{DAY} 10:00:00", QUANTITY: "81", UNIT: "bpm"}
+    record = {EVENTNAME: INSERT, DYNAMODB: {SEQUENCE_NUMBER: "1", NEWIMAGE: stream_image(item)}}
+    assert load("hdi-dailyaggregate").lambda_handler({RECORDS: [record]}, None)[BATCH_ITEM_FAILURES] == []
+
+    rollup = aggregated.get_item(Key={USERID: "u1", HD_CTX_DATE: f"heart_rate#NA#{MONTHLY}#2024-10-01"})[ITEM]
+    assert (rollup[DAY][SUM], rollup[DAY][COUNT]) == (781, 11)
+
+# In average mode, a rewritten reading of a day without a daily item adds no readings and is
+# skipped instead of failing its key on every retry.
+def test_average_mode_skips_a_rewrite_of_a_day_without_readings(dynamodb, load):
+    aggregate = load("hdi-dailyaggregate")
+    aggregate.AGGREGATION_MODE = AVERAGE_MODE
+    old = {USERID: "u1", HD_CTX_TIME: f"heart_rate#NA#{DAY} 10:00:00", QUANTITY: "70", UNIT: "bpm"}
+    record = {EVENTNAME: MODIFY, DYNAMODB: {SEQUENCE_NUMBER: "1", NEWIMAGE: stream_image({**old, QUANTITY: "75"}),
+                                            OLDIMAGE: stream_image(old)}}
+
+    assert aggregate.lambda_handler({RECORDS: [record]}, None)[BATCH_ITEM_FAILURES] == []
+    assert ITEM not in dynamodb.Table(DAILY_AGGREGATED_TABLE).get_item(Key={USERID: "u1", HD_CTX_DATE: f"heart_rate#NA#{DAY}"})
@@ -0,0 +1,85 @@
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pytest
+
+import insight_engine
+from constants import *
+
+CONTEXT = "step_count#NA"
+
+
+# Function to store the daily item of a day, and optionally its entry in a monthly or weekly rollup.
+def put_day(dynamodb, date, steps, rollup=None):
+    aggregated = dynamodb.Table(DAILY_AGGREGATED_TABLE)
+    aggregated.put_item(Item={USERID: "u1", HD_CTX_DATE: f"{CONTEXT}#{date}", SUM: Decimal(steps), COUNT: 1, UNIT: "count"})
+    if rollup:
+        aggregated.update_item(
+            Key={USERID: "u1", HD_CTX_DATE: f"{CONTEXT}#{rollup}"},
+            UpdateExpression="SET #day = :day, #unit = :unit",
+            ExpressionAttributeValues={':day': {SUM: Decimal(steps), COUNT: 1}, ':unit': "count"},
+            ExpressionAttributeNames={'#day': date, '#unit': UNIT}
+        )
+
+def bars(load, insight_type, start_date, end_date):
+    module = load("hdi-deepinsights")
+    response = module.lambda_handler({INSIGHT_TYPE: insight_type, USERID: "u1", HD_CTX: CONTEXT,
+                                      FROMDATE: start_date, TODATE: end_date}, None)
+    return [(bar[START_DATE], Decimal(bar[VALUE])) for bar in response[DATA]]
+
+
+# Months without a rollup item, e.g. from before rollups were deployed, are read from their daily
+# items instead of being left out of the chart.
+def test_yearly_insights_read_months_without_rollups_from_daily_items(dynamodb, load):
+    put_day(dynamodb, "2024-01-15", 100)
+    put_day(dynamodb, "2024-02-15", 200, f"{MONTHLY}#2024-02-01")
+    put_day(dynamodb, "2024-03-15", 300)
+    put_day(dynamodb, "2024-04-15", 400)
+
+    assert bars(load, YEARLY, "2024-01-01", "2024-04-30") == [
+        ("2024-01-01", 100), ("2024-02-01", 200), ("2024-03-01", 300), ("2024-04-01", 400)]
+
+def test_six_month_insights_read_weeks_without_rollups_from_daily_items(dynamodb, load):
+    put_day(dynamodb, "2024-01-02", 100, f"{WEEKLY}#2024-01-01")
+    put_day(dynamodb, "2024-01-09", 200)
+    put_day(dynamodb, "2024-01-16", 300, f"{WEEKLY}#2024-01-15")
+
+    assert bars(load, SIXMONTHLY, "2024-01-01", "2024-01-21") == [
+        ("2024-01-01", 100), ("2024-01-08", 200), ("2024-01-15", 300)]
+
+# The results of a batch request follow the order of its entries whichever finishes first, and an
+# entry that fails gets an error of its own instead of failing the batch.
+def test_batch_results_keep_the_order_of_the_entries(dynamodb, load):
+    for user_id, steps in [("u1", 100), ("u2", 200), ("u3", 300)]:
+        dynamodb.Table(DAILY_AGGREGATED_TABLE).put_item(
+            Item={USERID: user_id, HD_CTX_DATE: f"{CONTEXT}#2024-01-10", SUM: Decimal(steps), COUNT: 1, UNIT: "count"})
+    entries = [{USERID: "u3", HD_CTX: CONTEXT}, {USERID: "u1"}, {USERID: "u2", HD_CTX: CONTEXT}]
+    response = load("hdi-deepinsights").lambda_handler(
+        {INSIGHT_TYPE: MONTHLY, FROMDATE: "2024-01-01", TODATE: "2024-01-31", REQUESTS: entries}, None)
+
+    results = response[RESULTS]
+    assert [(result[USERID], result.get(AVG)) for result in results] == [("u3", "300"), ("u1", None), ("u2", "200")]
+    assert results[1][ERROR_TYPE] == "KeyError"
+
+def test_batch_of_more_than_50_entries_is_rejected(dynamodb, load):
+    insights = load("hdi-deepinsights")
+    request = {INSIGHT_TYPE: MONTHLY, FROMDATE: "2024-01-01", TODATE: "2024-01-31"}
+    entries = [{USERID: f"u{number}", HD_CTX: CONTEXT} for number in range(insights.MAX_BATCH_ENTRIES + 1)]
+
+    assert insights.lambda_handler({**request, REQUESTS: entries}, None)[STATUS_CODE] == 500
+    assert len(insights.lambda_handler({**request, REQUESTS: entries[1:]}, None)[RESULTS]) == 50
+
+# The columnar float path, which hdi-deep-insights runs with the hdi-numpy layer, buckets days,
+# ISO weeks and months like the scalar float path.
+@pytest.mark.parametrize("granularity", [MONTHLY, WEEKLY, "D"])
+def test_columnar_float_periods_match_the_scalar_path(monkeypatch, granularity):
+    pytest.importorskip(NUMPY)
+    first = date(2019, 12, 30)
+    items = [{HD_CTX_DATE: f"heart_rate#NA#{first + timedelta(days=day)}", SUM: Decimal(60 + day % 17), COUNT: 1}
+             for day in range(insight_engine.COLUMNAR_MIN_ITEMS)]
+    columnar = insight_engine.period_values(items, HEART_RATE, granularity, FLOAT_PRECISION)
+    monkeypatch.setattr(insight_engine, "COLUMNAR_MIN_ITEMS", len(items) + 1)
+    scalar = insight_engine.period_values(items, HEART_RATE, granularity, FLOAT_PRECISION)
+
+    assert [period for period, _ in columnar] == [period for period, _ in scalar]
+    assert [value for _, value in columnar] == pytest.approx([value for _, value in scalar])
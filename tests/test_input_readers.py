@@ -0,0 +1,20 @@
+import io
+
+import pytest
+
+from input_readers import read_json_array
+
+ELEMENTS = b'[1.5, 2e3, 12345, -7.25E-2, {"quantity": 1.25}, true, null]'
+
+
+# Numbers split by a chunk boundary, e.g. after the "." of "1." or the "e" of "2e", are read
+# whole from the next chunk instead of being cut short, at every chunk size.
+@pytest.mark.parametrize("chunk_size", range(1, len(ELEMENTS) + 1))
+def test_json_array_numbers_split_across_chunks(chunk_size):
+    assert list(read_json_array(io.BytesIO(ELEMENTS), chunk_size)) == [
+        1.5, 2000.0, 12345, -0.0725, {"quantity": 1.25}, True, None]
+
+@pytest.mark.parametrize("data", [b"[1.]", b"[2e]", b"[1 2]"])
+def test_json_array_invalid_numbers_are_rejected(data):
+    with pytest.raises(ValueError):
+        list(read_json_array(io.BytesIO(data), 2))
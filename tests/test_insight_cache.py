@@ -0,0 +1,56 @@
+from decimal import Decimal
+
+import insight_cache
+from constants import *
+from insight_cache import InsightCache
+
+CONTEXT = "step_count#NA"
+
+
+# Clock of the cache that a test moves forward by hand.
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire_after_their_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(insight_cache.time, "monotonic", clock)
+    cache = InsightCache(ttl_seconds=60)
+    cache.put("key", "value")
+
+    clock.now += 60
+    assert cache.get("key") == "value"
+    clock.now += 1
+    assert cache.get("key") is None
+    assert cache.stats() == {ENTRIES: 0, HITS: 1, MISSES: 1, EVICTIONS: 0}
+
+def test_least_recently_used_entries_are_evicted():
+    cache = InsightCache(max_entries=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    assert cache.stats()[EVICTIONS] == 1
+
+# Insights of a closed period are served from the cache until the data version of their metric
+# context changes, as hdi-dailyaggregate bumps it when a past day is updated.
+def test_cached_insights_are_rebuilt_when_the_version_changes(dynamodb, load):
+    aggregated = dynamodb.Table(DAILY_AGGREGATED_TABLE)
+    aggregated.put_item(Item={USERID: "u1", HD_CTX_DATE: f"{CONTEXT}#2024-01-10", SUM: Decimal(100), COUNT: 1, UNIT: "count"})
+    insights = load("hdi-deepinsights")
+    request = {INSIGHT_TYPE: MONTHLY, USERID: "u1", HD_CTX: CONTEXT, FROMDATE: "2024-01-01", TODATE: "2024-01-31"}
+    assert insights.lambda_handler(request, None)[AVG] == "100"
+
+    aggregated.put_item(Item={USERID: "u1", HD_CTX_DATE: f"{CONTEXT}#2024-01-20", SUM: Decimal(200), COUNT: 1, UNIT: "count"})
+    assert insights.lambda_handler(request, None)[AVG] == "100"
+
+    aggregated.put_item(Item={USERID: "u1", HD_CTX_DATE: f"{CONTEXT}#{VERSION}", VERSION: 1})
+    assert insights.lambda_handler(request, None)[AVG] == "150"
+    assert insights.closed_cache.stats()[HITS] == 1
@@ -0,0 +1,51 @@
+from decimal import Decimal
+
+import pytest
+
+import sharding
+from constants import *
+from reading_blocks import ReadingBlock, decode_readings
+
+BLOCK_KEY = "heart_rate#NA#2024-10-01 05"
+READING_KEY = "step_count#NA#2024-10-01 10:00:00"
+
+
+@pytest.fixture
+def shards(monkeypatch):
+    monkeypatch.setattr(sharding, "RAW_SHARD_COUNT", 4)
+    monkeypatch.setattr(sharding, "RAW_SHARD_SCHEME", HASH_SHARDING)
+
+def stored(dynamodb, partition_key, sort_key):
+    return dynamodb.Table(HEALTH_RAW_DATA_TABLE).get_item(Key={USERID: partition_key, HD_CTX_TIME: sort_key}).get(ITEM)
+
+
+# Items of the unsharded partition move to the partition of their shard with the shard_migrated
+# flag, a block merges into the block stored there, and migrating again changes nothing.
+def test_items_move_to_their_shard(dynamodb, load, shards):
+    raw = dynamodb.Table(HEALTH_RAW_DATA_TABLE)
+    raw.put_item(Item={USERID: "u1", HD_CTX_TIME: READING_KEY, QUANTITY: "42", UNIT: "count"})
+    raw.put_item(Item=ReadingBlock("u1", BLOCK_KEY, {0: Decimal(60)}, "bpm").to_item())
+    block_shard = sharding.shard_key("u1", BLOCK_KEY)
+    raw.put_item(Item=ReadingBlock(block_shard, BLOCK_KEY, {60: Decimal(62)}, "bpm").to_item())
+    migrate = load("hdi-migrate-shards")
+
+    assert migrate.migrate_table(segments=2) == {MIGRATED: 2, SKIPPED: 0, FAILED: 0}
+    assert migrate.migrate_table(segments=2) == {MIGRATED: 0, SKIPPED: 0, FAILED: 0}
+
+    assert stored(dynamodb, "u1", READING_KEY) is None and stored(dynamodb, "u1", BLOCK_KEY) is None
+    reading = stored(dynamodb, sharding.shard_key("u1", READING_KEY), READING_KEY)
+    assert (reading[QUANTITY], reading[SHARD_MIGRATED]) == ("42", True)
+    block = stored(dynamodb, block_shard, BLOCK_KEY)
+    assert decode_readings(bytes(block[READINGS])) == [(0, 60), (60, 62)]
+
+# A single reading whose shard already holds a newer one is not copied over it; the original is
+# still deleted, as the reading in the shard replaces it.
+def test_reading_stored_in_its_shard_is_kept(dynamodb, load, shards):
+    raw = dynamodb.Table(HEALTH_RAW_DATA_TABLE)
+    raw.put_item(Item={USERID: "u1", HD_CTX_TIME: READING_KEY, QUANTITY: "42", UNIT: "count"})
+    shard = sharding.shard_key("u1", READING_KEY)
+    raw.put_item(Item={USERID: shard, HD_CTX_TIME: READING_KEY, QUANTITY: "43", UNIT: "count"})
+
+    assert load("hdi-migrate-shards").migrate_table(segments=1) == {MIGRATED: 1, SKIPPED: 0, FAILED: 0}
+    assert stored(dynamodb, "u1", READING_KEY) is None
+    assert stored(dynamodb, shard, READING_KEY)[QUANTITY] == "43"
@@ -0,0 +1,42 @@
+from decimal import Decimal
+
+from constants import *
+
+DAY = "2024-10-01"
+
+
+# Function to store a daily item in the format of the average aggregation mode.
+def put_legacy_day(dynamodb, quantity, referred_count):
+    dynamodb.Table(DAILY_AGGREGATED_TABLE).put_item(Item={
+        USERID: "u1", HD_CTX_DATE: f"heart_rate#NA#{DAY}", QUANTITY: quantity, HD_REFF_COUNT: referred_count, UNIT: "bpm"})
+
+def stored(dynamodb, sort_key):
+    return dynamodb.Table(DAILY_AGGREGATED_TABLE).get_item(Key={USERID: "u1", HD_CTX_DATE: sort_key})[ITEM]
+
+
+# A legacy average becomes the running sum and count of its readings, and the day is set in its
+# monthly and weekly rollups; migrating again changes nothing.
+def test_legacy_items_move_to_sum_count_and_their_rollups(dynamodb, load):
+    put_legacy_day(dynamodb, "70", "10")
+    migrate = load("hdi-migrate-sumcount")
+
+    assert migrate.migrate_table() == {MIGRATED: 1, SKIPPED: 0, FAILED: 0}
+    assert migrate.migrate_table() == {MIGRATED: 0, SKIPPED: 0, FAILED: 0}
+
+    item = stored(dynamodb, f"heart_rate#NA#{DAY}")
+    assert (item[SUM], item[COUNT], QUANTITY in item) == (700, 10, False)
+    for sort_key in [f"heart_rate#NA#{MONTHLY}#2024-10-01", f"heart_rate#NA#{WEEKLY}#2024-09-30"]:
+        assert stored(dynamodb, sort_key)[DAY] == {SUM: Decimal(700), COUNT: 10}
+
+# Increments the stream added in sum_count mode before the migration are kept.
+def test_legacy_totals_are_added_to_the_stream_totals(dynamodb, load):
+    put_legacy_day(dynamodb, "70", "10")
+    dynamodb.Table(DAILY_AGGREGATED_TABLE).update_item(
+        Key={USERID: "u1", HD_CTX_DATE: f"heart_rate#NA#{DAY}"},
+        UpdateExpression="ADD #sum :sum, #count :count",
+        ExpressionAttributeValues={':sum': Decimal(81), ':count': 1},
+        ExpressionAttributeNames={'#sum': SUM, '#count': COUNT})
+
+    load("hdi-migrate-sumcount").migrate_table()
+
+    assert stored(dynamodb, f"heart_rate#NA#{MONTHLY}#2024-10-01")[DAY] == {SUM: Decimal(781), COUNT: 11}
@@ -0,0 +1,59 @@
+import io
+import itertools
+
+import pytest
+
+from constants import *
+from range_import import (create_checkpoints, iter_range_lines, load_checkpoint, save_checkpoint, split_ranges)
+
+HEADER = b"userid,hd-context-time,quantity\n"
+LINES = [f"u{number},step_count#NA#2024-10-01 10:{number % 60:02d}:00,{number * 7}" for number in range(40)]
+DATA = HEADER + "\n".join(LINES).encode() + b"\n"
+
+
+# Function to read the lines of a range as read_range_rows does: from its start when it is at a
+# line boundary, otherwise from one byte earlier.
+def range_lines(start, end, position, aligned=False, chunk_size=16):
+    body_start = start if aligned else start - 1
+    return iter_range_lines(io.BytesIO(DATA[body_start:]), body_start, start, end, position, chunk_size)
+
+
+@pytest.mark.parametrize("parts", [1, 3, 7, 10 ** 6])
+def test_ranges_cover_the_data_contiguously(parts):
+    ranges = split_ranges(len(HEADER), len(DATA), parts)
+
+    assert ranges[0][0] == len(HEADER) and ranges[-1][1] == len(DATA)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+    assert len(ranges) == min(parts, len(DATA) - len(HEADER))
+
+# Every line is read by exactly one range, the one it starts in, whatever the chunk size.
+@pytest.mark.parametrize("parts, chunk_size", list(itertools.product([1, 4, 9], [1, 5, 64])))
+def test_each_line_is_read_by_one_range(parts, chunk_size):
+    lines = []
+    for number, (start, end) in enumerate(split_ranges(len(HEADER), len(DATA), parts)):
+        lines += range_lines(start, end, [None], aligned=number == 0, chunk_size=chunk_size)
+    assert lines == LINES
+
+# A range that stops after some lines resumes from the offset it committed, at a line boundary,
+# and reads exactly the lines it had not read.
+@pytest.mark.parametrize("read_before_stop", [0, 1, 5])
+def test_range_resumes_from_its_committed_offset(read_before_stop):
+    start, end = split_ranges(len(HEADER), len(DATA), 3)[1]
+    expected = list(range_lines(start, end, [None]))
+    position = [start]
+    first = list(itertools.islice(range_lines(start, end, position), read_before_stop))
+
+    # As hdi-importdata does: a committed offset past the start of the range is a line boundary
+    rest = range_lines(position[0], end, [None], aligned=position[0] > start)
+    assert first + list(rest) == expected
+
+# Checkpoints that exist already keep their progress when an import is started again.
+def test_checkpoints_keep_their_progress(dynamodb):
+    checkpoints = dynamodb.Table(IMPORT_CHECKPOINT_TABLE)
+    ranges = [(32, 100), (100, 200)]
+    create_checkpoints(checkpoints, "import-1", ranges)
+    save_checkpoint(checkpoints, "import-1", 32, 100, 64, IN_PROGRESS, {WRITTEN: 3, FAILED: 0})
+    create_checkpoints(checkpoints, "import-1", ranges)
+
+    assert load_checkpoint(checkpoints, "import-1", 32, 100) == (64, IN_PROGRESS)
+    assert load_checkpoint(checkpoints, "import-1", 100, 200) == (100, IN_PROGRESS)
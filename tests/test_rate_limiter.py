@@ -0,0 +1,67 @@
+import pytest
+
+import rate_limiter
+import runtime
+from batch_writer import write_batch
+from constants import *
+from rate_limiter import AdaptiveRateLimiter
+
+ITEMS = [{USERID: "u1", HD_CTX_TIME: f"step_count#NA#2024-10-01 10:00:{second:02d}"} for second in range(3)]
+
+
+# DynamoDB stand-in whose BatchWriteItem calls return the given responses in turn.
+class ScriptedDynamoDB:
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        return self.responses.pop(0)
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "ADJUST_INTERVAL_SECONDS", 0.0)
+    return AdaptiveRateLimiter(rate=1000, min_rate=25)
+
+
+# Throttling the SDK retried away before the call succeeded still backs the rate off.
+def test_batch_retried_by_the_sdk_lowers_the_rate(limiter):
+    dynamodb = ScriptedDynamoDB({UNPROCESSED_ITEMS: {}, RESPONSE_METADATA: {RETRY_ATTEMPTS: 1}})
+    counts = write_batch(dynamodb, HEALTH_RAW_DATA_TABLE, ITEMS, limiter=limiter)
+
+    assert counts[WRITTEN] == 3
+    assert limiter.rate == 500
+    assert limiter.stats()[THROTTLES] == 1
+
+def test_batch_with_unprocessed_items_lowers_the_rate(limiter, monkeypatch):
+    monkeypatch.setattr("batch_writer.backoff_delay", lambda attempt: 0)
+    unprocessed = [{PUT_REQUEST: {ITEM: ITEMS[0]}}]
+    dynamodb = ScriptedDynamoDB({UNPROCESSED_ITEMS: {HEALTH_RAW_DATA_TABLE: unprocessed}}, {UNPROCESSED_ITEMS: {}})
+    write_batch(dynamodb, HEALTH_RAW_DATA_TABLE, ITEMS, limiter=limiter)
+
+    assert limiter.rate == 500 + limiter.increase_step
+    assert (limiter.stats()[THROTTLES], limiter.stats()[SUCCESSES]) == (1, 1)
+
+def test_rate_stays_within_its_bounds(limiter):
+    for _ in range(10):
+        limiter.on_throttle()
+    assert limiter.rate == limiter.min_rate
+    limiter.max_rate = limiter.min_rate + 1
+    limiter.on_success()
+    assert limiter.rate == limiter.max_rate
+
+# The clients of writes paced by a limiter leave throttling to it: standard retries, few attempts.
+def test_limited_clients_leave_throttling_to_the_limiter():
+    configs = []
+
+    class RecordingSession:
+        def resource(self, service_name, config=None):
+            configs.append(config)
+            return object()
+
+    runtime.use_session(RecordingSession())
+    runtime.dynamodb()
+    runtime.limited_dynamodb()
+
+    assert configs[0].retries == {'mode': runtime.RETRY_MODE, 'max_attempts': runtime.MAX_ATTEMPTS}
+    assert configs[1].retries == {'mode': "standard", 'max_attempts': runtime.LIMITED_MAX_ATTEMPTS}
@@ -0,0 +1,50 @@
+import random
+from decimal import Decimal
+
+import pytest
+
+from constants import *
+from reading_blocks import (RAW_PAYLOAD, ZLIB_PAYLOAD, ReadingBlock, decode_readings, encode_readings, read_varint,
+                            unzigzag, write_block, write_varint, zigzag)
+
+BLOCK_KEY = "heart_rate#NA#2024-10-01 05"
+
+
+@pytest.mark.parametrize("value", [0, 1, 127, 128, 300, 16383, 16384, 2 ** 63])
+def test_varint_round_trip(value):
+    output = bytearray(b"\x07")
+    write_varint(output, value)
+    assert read_varint(bytes(output), 1) == (value, len(output))
+
+def test_zigzag_keeps_small_deltas_small():
+    assert [zigzag(value) for value in (0, -1, 1, -2, 2)] == [0, 1, 2, 3, 4]
+    assert all(unzigzag(zigzag(value)) == value for value in range(-1000, 1000))
+
+# Readings that compress well are stored zlib compressed, the others as the plain payload; both
+# decode to the readings in time order, with negative deltas and decimal places kept.
+@pytest.mark.parametrize("readings, payload", [
+    ({offset: Decimal(70) for offset in range(0, 3600, 60)}, ZLIB_PAYLOAD),
+    ({3599: Decimal("-1.25"), 0: Decimal("98.6"), 61: Decimal(72)}, RAW_PAYLOAD),
+])
+def test_readings_round_trip(readings, payload):
+    encoded = encode_readings(readings)
+    assert encoded[0] == payload
+    assert decode_readings(encoded) == sorted(readings.items())
+
+def test_random_readings_round_trip():
+    generator = random.Random(7)
+    readings = {offset: Decimal(generator.randint(-10 ** 6, 10 ** 6)).scaleb(-generator.randint(0, 3))
+                for offset in generator.sample(range(3600), 500)}
+    assert dict(decode_readings(encode_readings(readings))) == readings
+
+# A block written over a stored one keeps the stored readings, takes the new quantity of a second
+# written again, and counts the readings it already held unchanged.
+def test_block_is_merged_into_the_stored_block(dynamodb):
+    table = dynamodb.Table(HEALTH_RAW_DATA_TABLE)
+    write_block(table, ReadingBlock("u1", BLOCK_KEY, {0: Decimal(60), 60: Decimal(62)}, "bpm"))
+    unchanged = write_block(table, ReadingBlock("u1", BLOCK_KEY, {60: Decimal(62), 120: Decimal(64), 0: Decimal(61)}, "bpm"))
+
+    item = table.get_item(Key={USERID: "u1", HD_CTX_TIME: BLOCK_KEY})[ITEM]
+    assert unchanged == 1
+    assert decode_readings(bytes(item[READINGS])) == [(0, 61), (60, 62), (120, 64)]
+    assert (item[SUM], item[COUNT]) == (187, 3)